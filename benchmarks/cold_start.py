@@ -0,0 +1,126 @@
+""" Cold start benchmark: time from a fresh interpreter to the first served request
+
+Every run starts a new Python process, imports run.py, calls create_app() and serves
+one request through the test client, the way a freshly forked-in worker would.
+
+usage: python benchmarks/cold_start.py [--runs 10] [--features todos,celebs,sandwiches] [--path /about] [--importtime]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import statistics
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# executed in the child process, prints one JSON line with the phase timings in ms
+CHILD = """
+import time, sys, json
+t0 = time.perf_counter()
+import run
+t1 = time.perf_counter()
+app = run.create_app()
+t2 = time.perf_counter()
+status = app.test_client().get(sys.argv[1]).status_code
+t3 = time.perf_counter()
+heavy = [module for module in ('pymongo', 'gridfs', 'gspread', 'google.oauth2', 'PIL.Image', 'numpy') if module in sys.modules]
+print(json.dumps({'import': (t1-t0)*1000, 'create_app': (t2-t1)*1000, 'first_request': (t3-t2)*1000,
+                  'status': status, 'heavy_modules': heavy}))
+"""
+
+# executed once before the runs, creates the SQLite database in the temporary directory
+SETUP = """
+import run, sqlite_db
+app = run.create_app()
+with app.app_context():
+    sqlite_db.init_sqlite_db()
+"""
+
+HEAVY_IMPORTS = ('pymongo', 'gridfs', 'gspread', 'google', 'PIL', 'numpy', 'cachetools', 'flask')
+FEATURES = ('todos', 'celebs', 'sandwiches')
+
+
+def child_env(features, tmp):
+    env = dict(os.environ)
+    env.setdefault("FLASK_SECRET_KEY", "benchmark")
+    env.setdefault("PORT", "5000")
+    env["APP_FEATURES"] = features
+    # the databases and uploads of the runs stay out of the working tree
+    env.update({"SQLITE_DB": os.path.join(tmp, 'benchmark.sqlite'), "UPLOAD_FOLDER": tmp,
+                "FRAGMENT_CACHE_DB": os.path.join(tmp, 'fragments.sqlite')})
+    return env
+
+
+def run_once(features, path, tmp, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', CHILD, path]
+    started = time.perf_counter()
+    result = subprocess.run(command, cwd=ROOT, env=child_env(features, tmp), capture_output=True, text=True, check=True)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    # wall clock includes the interpreter start-up
+    timings['process'] = (time.perf_counter() - started) * 1000
+    return timings, result.stderr
+
+
+def top_imports(stderr, count=15):
+    """ the slowest top level packages from the `-X importtime` report, cumulative us """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # only the first two levels, nested imports are indented by two more spaces per level
+        if name.startswith('     '):
+            continue
+        name = name.strip()
+        if name.split('.')[0] in HEAVY_IMPORTS + ('run', 'sqlite_db') + FEATURES:
+            rows.append((int(cumulative), name))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--features', default='todos,celebs,sandwiches', help="value of APP_FEATURES for the child processes")
+    parser.add_argument('--path', default='/about', help="route of the first request")
+    parser.add_argument('--importtime', action='store_true', help="also list the slowest imports of one run")
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        subprocess.run([sys.executable, '-c', SETUP], cwd=ROOT, env=child_env(args.features, tmp), capture_output=True, check=True)
+        runs = [run_once(args.features, args.path, tmp)[0] for _ in range(args.runs)]
+        if args.importtime:
+            _, stderr = run_once(args.features, args.path, tmp, importtime=True)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    # the time of an error page says nothing about the start-up
+    errors = [run['status'] for run in runs if run['status'] >= 500]
+    if errors:
+        sys.exit(f"{args.path} answered HTTP {errors[0]} in {len(errors)} of {args.runs} runs")
+    summary = {'features': args.features, 'path': args.path, 'runs': args.runs,
+               'status': runs[-1]['status'], 'heavy_modules': runs[-1]['heavy_modules']}
+    for phase in ('import', 'create_app', 'first_request', 'process'):
+        values = [run[phase] for run in runs]
+        summary[phase] = {'median_ms': round(statistics.median(values), 1), 'min_ms': round(min(values), 1), 'max_ms': round(max(values), 1)}
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"cold start of {args.features} serving {args.path} (HTTP {summary['status']}), {args.runs} runs")
+        for phase in ('import', 'create_app', 'first_request', 'process'):
+            print(f"  {phase:14} median {summary[phase]['median_ms']:8.1f} ms   min {summary[phase]['min_ms']:8.1f} ms   max {summary[phase]['max_ms']:8.1f} ms")
+        print(f"  heavy client libraries loaded: {', '.join(summary['heavy_modules']) or 'none'}")
+
+    if args.importtime:
+        print("slowest imports (cumulative):")
+        for cumulative, name in top_imports(stderr):
+            print(f"  {cumulative/1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+""" in-memory stand-ins of the gspread objects used by the sandwiches page
+
+FakeSpreadsheet can be put in place of the real client with install_fake_spreadsheet(),
+<latency> seconds are slept in every call which would be an HTTP request to Google """
+import os
+import re
+import time
+import threading
+
+
+def trim_empty(values):
+    """ drop the trailing empty cells of a row or the trailing empty rows of a range """
+    values = list(values)
+    while values and not values[-1]:
+        values.pop()
+    return values
+
+
+class FakeWorksheet:
+    def __init__(self, title, rows=(), latency=0.0):
+        self.title = title
+        self.rows = [list(map(str, row)) for row in rows]
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _request(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_all_values(self):
+        self._request()
+        with self._lock:
+            return [list(row) for row in self.rows]
+
+    def get(self, range_name=None):
+        """ A1 ranges like "A6:F" or "A1:F10", trailing empty rows and cells are left out like the API does """
+        self._request()
+        first, last = 1, None
+        if range_name:
+            match = re.fullmatch(r"[A-Z]+(\d*)(?::[A-Z]+(\d*))?", range_name.split('!')[-1])
+            first = int(match.group(1) or 1)
+            last = int(match.group(2)) if match.group(2) else None
+        with self._lock:
+            rows = [trim_empty(row) for row in self.rows[first-1:last]]
+        return trim_empty(rows)
+
+    def append_row(self, values, value_input_option='RAW'):
+        self.append_rows([values], value_input_option)
+
+    def append_rows(self, values, value_input_option='RAW'):
+        self._request()
+        with self._lock:
+            self.rows.extend([list(map(str, row)) for row in values])
+        return {'updates': {'updatedRows': len(values)}}
+
+
+class FakeSpreadsheet:
+    def __init__(self, worksheets, latency=0.0):
+        self.worksheets = {worksheet.title: worksheet for worksheet in worksheets}
+        self.latency = latency
+
+    def worksheet(self, title):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.worksheets[title]
+
+    def values_batch_get(self, ranges):
+        if self.latency:
+            time.sleep(self.latency)
+        return {'valueRanges': [{'range': title, 'values': self.worksheets[title].get()} for title in ranges]}
+
+
+def sandwich_rows(days, ncols=6, seed=0, titles=None):
+    """ a title row and <days> rows of random daily figures """
+    import random
+    rnd = random.Random(seed)
+    return [titles or [f'sale{i}' for i in range(ncols)]] + [[str(rnd.randint(10, 60)) for _ in range(ncols)] for _ in range(days)]
+
+
+def install_fake_spreadsheet(spreadsheet):
+    """ make the sandwiches blueprint of this process use the given fake instead of Google """
+    import sandwiches
+    sandwiches.reset_gsheets_client()
+    sandwiches._gsheets_spreadsheet = spreadsheet
+    sandwiches._gsheets_pid = os.getpid()
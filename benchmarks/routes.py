@@ -0,0 +1,397 @@
+""" Route benchmark: throughput, latency percentiles and peak memory of every page against local stand-ins
+
+Each (route, dataset size) is measured in a fresh Python process with its own temporary SQLite
+database and upload folder, celebrities in mongomock (or a local mongod given by --mongo) and
+worksheets of FakeWorksheet rows (see fakes.py), so the peak RSS belongs to that route alone.
+The requests go through the Flask test client, without a network or a WSGI server in between.
+
+usage: python benchmarks/routes.py [--sizes 10,1000,10000] [--routes todos_list,celebs_list] [--requests 200]
+                                   [--concurrency 1] [--save benchmarks/baseline.json] [--compare benchmarks/baseline.json]
+
+Save a baseline once, then compare every change against it, regressions make the exit code 1:
+    python benchmarks/routes.py --save benchmarks/baseline.json
+    python benchmarks/routes.py --compare benchmarks/baseline.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import resource
+import subprocess
+import threading
+from datetime import date, timedelta, datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.dirname(os.path.abspath(__file__))]
+
+from fakes import FakeWorksheet, FakeSpreadsheet, sandwich_rows, install_fake_spreadsheet
+
+WORDS = ("buy milk call mum fix bike book flight pay rent water plants walk dog clean desk read paper write report "
+         "email boss renew passport order pizza paint fence wash car mow lawn bake bread visit dentist plan trip").split()
+FIRST_NAMES = ("Tom Tina Harry Hanna Jack Julia Meryl Morgan Brad Bette Denzel Diane Keanu Kate Sean Sandra").split()
+LAST_NAMES = ("Hanks Hardy Harrison Jackson Jolie Freeman Streep Pitt Davis Washington Keaton Reeves Winslet Connery Bullock").split()
+OCCUPATIONS = ("actor", "singer", "director", "writer", "painter")
+NATIONALITIES = ("american", "british", "french", "german", "canadian")
+# uploads and celebrity pictures created with the dataset, read by the download routes
+PICTURES = 20
+
+
+def png(size=(320, 240), seed=0):
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', size, ((seed*37) % 256, (seed*91) % 256, 128)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def form_file(data=b'', name=''):
+    # every form of the app has the upload field, also when no file is chosen
+    return (io.BytesIO(data), name)
+
+
+# Datasets
+#==========
+class Dataset:
+    """ ids and names of the seeded rows, handed out to the request makers """
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.task_ids = []
+        self.uploads = []
+        self.celeb_ids = []
+        self.image_ids = []
+        self.picture = png()
+
+    def pick(self, items):
+        with self.lock:
+            return self.rnd.choice(items)
+
+    def take(self, items):
+        """ a row nobody took before, for the delete routes """
+        with self.lock:
+            return items.pop(self.rnd.randrange(len(items)))
+
+    def number(self, low, high):
+        with self.lock:
+            return self.rnd.randint(low, high)
+
+    def words(self, count):
+        with self.lock:
+            return ' '.join(self.rnd.choice(WORDS) for _ in range(count))
+
+
+def seed_todos(app, dataset):
+    import sqlite_db
+    sqlite_db.init_sqlite_db()
+    rnd = random.Random(1)
+    now = int(time.time())
+    columns = ('Content', 'Completed', 'DatTimIns')
+    for start in range(0, dataset.size, 10000):
+        rows = [{'Content': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 8))),
+                 'Completed': rnd.randint(0, 1), 'DatTimIns': now - rnd.randint(0, 86400*365)}
+                for _ in range(min(10000, dataset.size - start))]
+        sqlite_db.insert_rows(app.config["SQLITE_TABLE_TODOS"], columns, rows)
+    dataset.task_ids = [row[0] for row in sqlite_db.query_db(f"SELECT TaskId FROM {app.config['SQLITE_TABLE_TODOS']};")]
+    # some of the tasks get a picture, in the upload folder where the job of save_task_to_db() puts it
+    for i, task_id in enumerate(dataset.task_ids[:PICTURES]):
+        filename_local = f"{1600000000000+i}.png"
+        with open(os.path.join(app.config["UPLOAD_FOLDER"], filename_local), 'wb') as f:
+            f.write(png(seed=i))
+        sqlite_db.update_row(app.config["SQLITE_TABLE_TODOS"], {'SourceFileName': f"picture{i}.png", 'LocalFileName': filename_local}, task_id)
+        dataset.uploads.append(filename_local)
+
+
+def seed_celebs(app, dataset, mongo):
+    import celebs
+    if mongo == 'mongomock':
+        import mongomock
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+        celebs._mongo_client = mongomock.MongoClient()
+        celebs._mongo_client_pid = os.getpid()
+    coll = celebs.get_mongo_coll(app.config["MONGO_COLLECTION_CELEBS"])
+    coll.drop()
+    celebs.get_mongo_coll('fs.files').drop()
+    celebs.get_mongo_coll('fs.chunks').drop()
+    celebs.ensure_celebs_indexes()
+    rnd = random.Random(2)
+    for start in range(0, dataset.size, 10000):
+        coll.insert_many([{'first': rnd.choice(FIRST_NAMES), 'last': rnd.choice(LAST_NAMES),
+                           'dob': (date(1930, 1, 1) + timedelta(days=rnd.randint(0, 365*70))).isoformat(),
+                           'gender': rnd.choice(('female', 'male')), 'hair_color': rnd.choice(('black', 'brown', 'blond')),
+                           'occupation': rnd.choice(OCCUPATIONS), 'nationality': rnd.choice(NATIONALITIES), 'has_image': False}
+                          for _ in range(min(10000, dataset.size - start))], ordered=False)
+    dataset.celeb_ids = [str(celeb['_id']) for celeb in coll.find({}, {'_id': 1})]
+    for i, celeb_id in enumerate(dataset.celeb_ids[:PICTURES]):
+        from bson.objectid import ObjectId
+        image_id, image_hash = celebs.save_image_to_gridfs(io.BytesIO(png(seed=i)), f"picture{i}.png", 'image/png')
+        coll.update_one({'_id': ObjectId(celeb_id)}, {'$set': {'ImageId': image_id, 'ImageHash': image_hash, 'ImageType': 'image/png',
+                                                               'ImageDate': datetime.utcnow(), 'has_image': True}})
+        dataset.image_ids.append(celeb_id)
+
+
+def seed_sandwiches(app, dataset, latency):
+    worksheets = [FakeWorksheet(sheet, sandwich_rows(dataset.size, seed=i), latency) for i, sheet in enumerate(('stock', 'sales'))]
+    install_fake_spreadsheet(FakeSpreadsheet(worksheets, latency))
+
+
+# Routes
+#========
+def celeb_form(dataset, picture=False):
+    form = {'first': dataset.pick(FIRST_NAMES), 'last': dataset.pick(LAST_NAMES), 'dob': '1970-01-01', 'gender': 'female',
+            'hair_color': 'brown', 'occupation': dataset.pick(OCCUPATIONS), 'nationality': dataset.pick(NATIONALITIES)}
+    form['SourceFileName'] = form_file(dataset.picture, 'picture.png') if picture else form_file()
+    return form
+
+
+def celebs_search_args(dataset):
+    import celebs
+    # mongomock cannot sort by textScore, the text search is measured against a real mongod only
+    args = [args for args in celebs.CELEBS_EXPLAIN_ARGS if 'q' not in args or dataset.mongo != 'mongomock']
+    return '&'.join(f"{key}={value}" for key, value in dataset.pick(args).items())
+
+
+def sandwiches_form(dataset):
+    return {'submit': dataset.pick(('stock', 'sales')), **{f"sale{i}": str(dataset.number(10, 60)) for i in range(6)}}
+
+
+# name: (feature, request maker); a maker returns (method, path, form data or None) for a request
+ROUTES = {
+    'todos_list':        ('todos', lambda d: ('GET', f"/todos?show={d.pick(('all', 'open', 'completed'))}&after=0.{d.pick(d.task_ids)}", None)),
+    'todos_search':      ('todos', lambda d: ('GET', f"/todos?q={d.words(2)}", None)),
+    'todos_create':      ('todos', lambda d: ('POST', "/todos", {'Content': d.words(5), 'SourceFileName': form_file()})),
+    'todos_create_upload': ('todos', lambda d: ('POST', "/todos", {'Content': d.words(5), 'SourceFileName': form_file(d.picture, 'picture.png')})),
+    'todos_update':      ('todos', lambda d: ('POST', f"/todos/update/{d.pick(d.task_ids)}", {'Content': d.words(5), 'Completed': 'on',
+                                                                                              'SourceFileName': form_file()})),
+    'todos_delete':      ('todos', lambda d: ('GET', f"/todos/delete/{d.take(d.task_ids)}", None)),
+    'uploads':           ('todos', lambda d: ('GET', f"/uploads/{d.pick(d.uploads)}", None)),
+    'uploads_thumbnail': ('todos', lambda d: ('GET', f"/uploads/thumbs/{d.pick(d.uploads)}", None)),
+    'celebs_list':       ('celebs', lambda d: ('GET', f"/celebs?sort={d.pick(('last', 'first', 'dob', 'occupation', 'nationality'))}"
+                                                      f"&dir={d.pick(('asc', 'desc'))}&after={d.pick(d.celeb_ids)}", None)),
+    'celebs_search':     ('celebs', lambda d: ('GET', f"/celebs/search?{celebs_search_args(d)}", None)),
+    'celebs_create':     ('celebs', lambda d: ('POST', "/celebs", celeb_form(d))),
+    'celebs_create_image': ('celebs', lambda d: ('POST', "/celebs", celeb_form(d, picture=True))),
+    'celebs_update':     ('celebs', lambda d: ('POST', f"/celebs/update/{d.pick(d.celeb_ids)}", celeb_form(d))),
+    'celebs_delete':     ('celebs', lambda d: ('GET', f"/celebs/delete/{d.take(d.celeb_ids)}", None)),
+    'celebs_image':      ('celebs', lambda d: ('GET', f"/celebs/image/{d.pick(d.image_ids)}", None)),
+    'sandwiches':        ('sandwiches', lambda d: ('GET', "/sandwiches", None)),
+    'sandwiches_post':   ('sandwiches', lambda d: ('POST', "/sandwiches", sandwiches_form(d))),
+}
+# routes which use up a row per request
+CONSUMING = {'todos_delete': 'task_ids', 'celebs_delete': 'celeb_ids'}
+
+
+# Measurement
+#=============
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024*1024 if sys.platform == 'darwin' else 1024)
+
+
+def percentile(ordered, p):
+    """ nearest rank percentile of a sorted list """
+    return ordered[min(len(ordered)-1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def measure_route(spec):
+    """ seed a dataset and send the requests of one route, in the child process """
+    route, size, requests, concurrency, warmup = spec['route'], spec['size'], spec['requests'], spec['concurrency'], spec['warmup']
+    feature, make_request = ROUTES[route]
+    tmp = tempfile.mkdtemp(prefix='benchmark-')
+    os.environ.update({
+        'APP_FEATURES': feature, 'FLASK_SECRET_KEY': 'benchmark', 'PORT': '5000',
+        'SQLITE_DB': os.path.join(tmp, 'benchmark.sqlite'), 'UPLOAD_FOLDER': tmp,
+        'FRAGMENT_CACHE_DB': os.path.join(tmp, 'fragments.sqlite'),
+        'MONGO_DB_NAME': 'benchmark', 'GSHEETS_CREDITS': '{}', 'GSHEETS_SYNC_INTERVAL': '3600',
+        # nothing may run behind the measurement's back
+        'JOBS_CLEANUP_INTERVAL': '0',
+    })
+    import run
+    app = run.create_app()
+    dataset = Dataset(size)
+    dataset.mongo = spec['mongo']
+    started = time.perf_counter()
+    with app.app_context():
+        if feature == 'todos':
+            seed_todos(app, dataset)
+        elif feature == 'celebs':
+            if spec['mongo'] != 'mongomock':
+                import pymongo
+                import celebs
+                celebs._mongo_client = pymongo.MongoClient(spec['mongo'])
+                celebs._mongo_client_pid = os.getpid()
+            seed_celebs(app, dataset, spec['mongo'])
+        else:
+            seed_sandwiches(app, dataset, spec['latency'])
+    seed_seconds = time.perf_counter() - started
+    if route in CONSUMING:
+        requests = min(requests, len(getattr(dataset, CONSUMING[route])) - warmup)
+
+    def send(client):
+        method, path, data = make_request(dataset)
+        start = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        response.get_data()
+        return time.perf_counter() - start, response.status_code
+
+    # the first requests fill the caches and import the client libraries
+    client = app.test_client()
+    for _ in range(warmup):
+        send(client)
+    rss_before = peak_rss_mb()
+    timings, errors = [], 0
+    lock = threading.Lock()
+
+    def worker(count):
+        nonlocal errors
+        client = app.test_client()
+        for _ in range(count):
+            seconds, status = send(client)
+            with lock:
+                timings.append(seconds)
+                errors += status >= 400
+
+    shares = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(share,)) for share in shares if share]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    # the background jobs of the uploads finish outside the measurement
+    with app.app_context():
+        import jobs
+        jobs.drain(60)
+    shutil.rmtree(tmp, ignore_errors=True)
+    timings.sort()
+    return {'route': route, 'size': size, 'requests': len(timings), 'errors': errors, 'concurrency': concurrency,
+            'seconds': round(elapsed, 3), 'throughput_rps': round(len(timings) / elapsed, 1) if elapsed else None,
+            'mean_ms': round(sum(timings) / len(timings) * 1000, 2) if timings else None,
+            **{f"p{p}_ms": round(percentile(timings, p) * 1000, 2) if timings else None for p in (50, 95, 99)},
+            'peak_rss_mb': round(peak_rss_mb(), 1), 'rss_growth_mb': round(peak_rss_mb() - rss_before, 1),
+            'seed_seconds': round(seed_seconds, 2)}
+
+
+def run_child(spec):
+    """ measure one route in a new interpreter, so imports and memory of the other routes do not count """
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(spec)],
+                            cwd=ROOT, capture_output=True, text=True)
+    lines = result.stdout.strip().splitlines()
+    if result.returncode or not lines:
+        raise RuntimeError(f"{spec['route']} with {spec['size']} rows failed:\n{result.stderr[-2000:]}")
+    # the app prints to stdout as well, the result is the last line
+    return json.loads(lines[-1])
+
+
+# Reporting
+#===========
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def package_versions():
+    """ versions of the libraries which the timings depend on """
+    from importlib.metadata import version, PackageNotFoundError
+    versions = {}
+    for package in ('Flask', 'Werkzeug', 'Jinja2', 'pymongo', 'mongomock', 'gspread', 'Pillow', 'numpy'):
+        try:
+            versions[package] = version(package)
+        except PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def print_header():
+    print(f"{'route':22} {'rows':>7} {'req':>5} {'err':>4} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'peak MB':>8} {'+MB':>6}")
+
+
+def print_result(r):
+    print(f"{r['route']:22} {r['size']:>7} {r['requests']:>5} {r['errors']:>4} {r['throughput_rps'] or 0:>8.1f} "
+          f"{r['p50_ms'] or 0:>8.2f} {r['p95_ms'] or 0:>8.2f} {r['p99_ms'] or 0:>8.2f} {r['peak_rss_mb']:>8.1f} {r['rss_growth_mb']:>6.1f}")
+
+
+def compare(results, baseline, tolerance):
+    """ print the change against the baseline per route and size, return the number of regressions """
+    previous = {(r['route'], r['size']): r for r in baseline['results']}
+    regressions = 0
+    print(f"\ncompared with {baseline['meta'].get('commit') or 'baseline'} of {baseline['meta'].get('date')}, tolerance {tolerance:.0%}")
+    for r in results:
+        base = previous.get((r['route'], r['size']))
+        if not base or not base['p95_ms'] or not r['p95_ms']:
+            continue
+        p95 = r['p95_ms'] / base['p95_ms']
+        rps = r['throughput_rps'] / base['throughput_rps']
+        rss = r['peak_rss_mb'] / base['peak_rss_mb']
+        regressed = p95 > 1 + tolerance or rps < 1 / (1 + tolerance) or rss > 1 + tolerance or r['errors'] > base['errors']
+        regressions += regressed
+        print(f"{r['route']:22} {r['size']:>7}  p95 {p95:6.2f}x  req/s {rps:6.2f}x  peak RSS {rss:6.2f}x{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10,1000,10000', help="comma separated dataset sizes, e.g. 10,1000,100000")
+    parser.add_argument('--routes', default=','.join(ROUTES), help=f"comma separated subset of {', '.join(ROUTES)}")
+    parser.add_argument('--requests', type=int, default=200, help="measured requests per route and size")
+    parser.add_argument('--warmup', type=int, default=5, help="requests sent before the measurement")
+    parser.add_argument('--concurrency', type=int, default=1, help="threads sending the requests")
+    parser.add_argument('--mongo', default='mongomock', help="mongomock or the URI of a local mongod, its database 'benchmark' is overwritten")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds per fake Google Sheets API call")
+    parser.add_argument('--save', metavar='FILE', help="write the results as JSON, e.g. a new baseline")
+    parser.add_argument('--compare', metavar='FILE', help="compare with the results saved earlier, exit code 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="relative change counted as regression")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_route(json.loads(args.child))))
+        return
+
+    routes = [route.strip() for route in args.routes.split(',') if route.strip()]
+    unknown = [route for route in routes if route not in ROUTES]
+    if unknown:
+        parser.error(f"unknown route(s) {', '.join(unknown)}")
+    results = []
+    print_header()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    for size in sizes:
+        for route in routes:
+            spec = {'route': route, 'size': size, 'requests': args.requests, 'warmup': args.warmup,
+                    'concurrency': args.concurrency, 'mongo': args.mongo, 'latency': args.latency}
+            results.append(run_child(spec))
+            print_result(results[-1])
+
+    meta = {'commit': git_commit(), 'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'packages': package_versions(),
+            'sizes': sizes, 'routes': routes, 'mongo': args.mongo, 'requests': args.requests, 'warmup': args.warmup,
+            'concurrency': args.concurrency, 'latency': args.latency}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+        print(f"\nresults saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        # numbers of another machine or setup are not comparable
+        for key in ('python', 'platform', 'cpus', 'packages', 'mongo', 'requests', 'concurrency', 'latency'):
+            if key in baseline['meta'] and baseline['meta'][key] != meta[key]:
+                print(f"warning: {key} differs from the baseline: {baseline['meta'][key]} instead of {meta[key]}")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{regressions} regression(s)")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+""" Sandwiches page latency: live Google Sheets reads against the local SQLite mirror
+
+The worksheets are FakeWorksheet objects (see fakes.py) which sleep <latency> seconds per
+API call, so the numbers show how much of the page time the Sheets API would account for.
+
+usage: python benchmarks/sheets_mirror.py [--days 365] [--latency 0.25] [--requests 20]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.dirname(os.path.abspath(__file__))]
+
+from fakes import FakeWorksheet, FakeSpreadsheet, sandwich_rows, install_fake_spreadsheet
+
+
+def measure(mirror, days, latency, requests, post_every):
+    os.environ["GSHEETS_MIRROR"] = str(mirror)
+    # the cached live values would hide the API latency, expire them on every request
+    os.environ["GSHEETS_CACHE_TTL"] = "0"
+    import run
+    import sandwiches
+    with tempfile.TemporaryDirectory() as tmp:
+        # the databases and uploads stay out of the working tree
+        os.environ["SQLITE_DB"] = os.path.join(tmp, "benchmark.sqlite")
+        os.environ["FRAGMENT_CACHE_DB"] = os.path.join(tmp, "fragments.sqlite")
+        os.environ["UPLOAD_FOLDER"] = tmp
+        app = run.create_app()
+        app.secret_key = "benchmark"
+        stock = FakeWorksheet('stock', sandwich_rows(days, seed=1), latency)
+        sales = FakeWorksheet('sales', sandwich_rows(days, seed=2), latency)
+        install_fake_spreadsheet(FakeSpreadsheet([stock, sales], latency))
+        sandwiches._gsheets_values = None
+        client = app.test_client()
+        timings = {'GET': [], 'POST': []}
+        for i in range(requests):
+            start = time.perf_counter()
+            if post_every and i % post_every == post_every-1:
+                client.post('/sandwiches', data={'submit': 'sales', **{column: '1' for column in app.config["GSHEETS_PAGE"]["columns"]}})
+                timings['POST'].append(time.perf_counter() - start)
+            else:
+                client.get('/sandwiches')
+                timings['GET'].append(time.perf_counter() - start)
+        run.reset_process_resources()
+        return timings, stock.calls + sales.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, default=365, help="rows per worksheet")
+    parser.add_argument('--latency', type=float, default=0.25, help="seconds per fake API call")
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--post-every', type=int, default=5, help="every n-th request submits a row, 0 for none")
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    os.environ["APP_FEATURES"] = "sandwiches"
+    os.environ["GSHEETS_SYNC_INTERVAL"] = "3600"
+    for mirror in (False, True):
+        timings, calls = measure(mirror, args.days, args.latency, args.requests, args.post_every)
+        print(f"{'mirror' if mirror else 'live'}: {args.days} days, {args.latency*1000:.0f} ms per API call, {calls} worksheet calls")
+        for method, values in timings.items():
+            if values:
+                print(f"  {method:4} median {statistics.median(values)*1000:8.1f} ms   max {max(values)*1000:8.1f} ms   ({len(values)} requests)")
+
+
+if __name__ == "__main__":
+    main()
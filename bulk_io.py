@@ -0,0 +1,146 @@
+""" streaming NDJSON/CSV readers and writers shared by the bulk import and export of the blueprints """
+import io
+import csv
+import json
+import hmac
+import click
+from itertools import islice
+from flask import current_app, request, abort
+
+FORMATS = ('ndjson', 'csv')
+MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def get_format(fmt=None, filename=None):
+    """ the bulk format given explicitly or by the file extension, NDJSON by default """
+    if not fmt and filename and '.' in filename:
+        fmt = filename.rsplit('.', 1)[1].lower()
+        fmt = {'json':'ndjson', 'jsonl':'ndjson'}.get(fmt, fmt)
+    fmt = (fmt or 'ndjson').lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}, use one of {FORMATS}")
+    return fmt
+
+
+def check_bulk_token():
+    """ the bulk endpoints are refused unless BULK_API_TOKEN is set and sent as bearer token """
+    token = current_app.config["BULK_API_TOKEN"]
+    sent = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(sent.encode(), f"Bearer {token}".encode()):
+        abort(403)
+
+
+def decode_lines(stream, errors):
+    """ yield the lines of a binary stream as text, stops at the first line which is not UTF-8 and appends (line number, error) to <errors> """
+    for line_no, line in enumerate(stream, 1):
+        try:
+            # a byte order mark is left by spreadsheet programs in front of CSV exports
+            yield line.decode('utf-8-sig' if line_no == 1 else 'utf-8')
+        except UnicodeDecodeError as error:
+            errors.append((line_no, f"Encoding error: {error}"))
+            return
+
+
+def read_records(stream, fmt, loads=json.loads):
+    """ yield (line number, record, error) for every record of a binary stream, decoded as it is read """
+    if fmt == 'csv':
+        decode_errors = []
+        reader = csv.DictReader(decode_lines(stream, decode_errors))
+        try:
+            for record in reader:
+                yield reader.line_num, record, None
+        except csv.Error as error:
+            yield reader.line_num, None, f"CSV error: {error}"
+            return
+        # a record may span lines, nothing after a line which cannot be decoded is read
+        for line_no, error in decode_errors:
+            yield line_no, None, error
+        return
+    for line_no, line in enumerate(stream, 1):
+        try:
+            line = line.decode('utf-8-sig' if line_no == 1 else 'utf-8')
+        except UnicodeDecodeError as error:
+            yield line_no, None, f"Encoding error: {error}"
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = loads(line)
+        except ValueError as error:
+            yield line_no, None, f"JSON error: {error}"
+            continue
+        if not isinstance(record, dict):
+            yield line_no, None, "JSON error: not an object"
+            continue
+        yield line_no, record, None
+
+
+def import_records(records, prepare, insert_batch, batch_size, max_errors=100):
+    """ convert every record with <prepare> and store them in batches with <insert_batch>
+
+        prepare(record) returns the row to store or raises ValueError,
+        insert_batch(rows) stores the rows in one operation and returns (inserted, [(index, error),...]);
+        the report lists the rejected lines and the batches which failed """
+    report = {'received': 0, 'inserted': 0, 'rejected': 0, 'batches': 0, 'errors': []}
+
+    def add_error(error, rejected=1):
+        report['rejected'] += rejected
+        if len(report['errors']) < max_errors:
+            report['errors'].append(error)
+
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, batch_size))
+        if not chunk:
+            break
+        report['batches'] += 1
+        rows, lines = [], []
+        for line_no, record, error in chunk:
+            report['received'] += 1
+            if error is None:
+                try:
+                    rows.append(prepare(record))
+                    lines.append(line_no)
+                    continue
+                except (ValueError, TypeError) as prepare_error:
+                    error = str(prepare_error)
+            add_error({'batch': report['batches'], 'line': line_no, 'error': error})
+        if not rows:
+            continue
+        inserted, errors = insert_batch(rows)
+        report['inserted'] += inserted
+        for index, error in errors:
+            # index None: the whole batch failed
+            if index is None:
+                add_error({'batch': report['batches'], 'lines': [lines[0], lines[-1]], 'error': error}, len(rows) - inserted)
+            else:
+                add_error({'batch': report['batches'], 'line': lines[index], 'error': error})
+    return report
+
+
+def write_records(rows, fmt, columns, dumps=json.dumps, chunk_size=65536):
+    """ yield the rows as NDJSON lines or as CSV with a header, in chunks of about <chunk_size> characters """
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        write = lambda row: buffer.write(dumps({column: row[column] for column in columns if column in row}) + '\n')
+    for row in rows:
+        write(row)
+        if buffer.tell() >= chunk_size:
+            # hand over what was written and reuse the buffer
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def echo_report(report):
+    """ print an import report of import_records() on the console """
+    click.echo(f"{report['inserted']} of {report['received']} record(s) imported in {report['batches']} batch(es), {report['rejected']} rejected")
+    for error in report['errors']:
+        where = f"line {error['line']}" if 'line' in error else f"lines {error['lines'][0]}-{error['lines'][1]}"
+        click.echo(f"  batch {error['batch']}, {where}: {error['error']}", err=True)
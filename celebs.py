@@ -0,0 +1,748 @@
+import os
+import time
+import uuid
+import threading
+import json
+import hashlib
+import sqlite3
+import mimetypes
+from io import BytesIO
+from datetime import date, datetime
+import click
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash, jsonify, Response, abort, \
+                  stream_with_context
+from werkzeug.utils import secure_filename
+from markupsafe import Markup
+
+import jobs
+from http_cache import conditional_page
+from fragment_cache import cached_fragment, bump_version
+from bulk_io import FORMATS, MIMETYPES, get_format, check_bulk_token, read_records, import_records, write_records, echo_report
+
+# Support for mongodb+srv:// URIs requires dnspython:
+#!pip install dnspython pymongo
+# pymongo, bson and gridfs are imported inside the functions which need them,
+# a worker pays for the import on the first celebrity request and not at startup
+
+bp = Blueprint("celebs", __name__, cli_group=None)
+
+# fields typed in on the form, also the fields of the bulk import and export besides _id
+CELEB_COLUMNS = ('first','last','dob','gender','hair_color','occupation','nationality')
+# request arguments filtering the celebrity list and the search API, see build_celebs_query()
+CELEB_FILTERS = ('q','first','last','occupation','nationality','dob_from','dob_to')
+
+
+# MongoDB helpers
+#=================
+# one MongoClient (and its connection pool) per worker process, created on first use
+_mongo_client = None
+_mongo_client_pid = None
+_mongo_pool_stats = None
+_mongo_client_lock = threading.Lock()
+
+
+def get_mongo_pool_stats():
+    global _mongo_pool_stats
+    if _mongo_pool_stats is None:
+        from mongo_monitoring import MongoPoolStats
+        _mongo_pool_stats = MongoPoolStats()
+    return _mongo_pool_stats
+
+
+def get_mongo_command_timer():
+    from mongo_monitoring import MongoCommandTimer
+    return MongoCommandTimer()
+
+
+def get_mongo_client():
+    global _mongo_client, _mongo_client_pid
+    # a client inherited through fork() must not be used in the child process
+    if _mongo_client is None or _mongo_client_pid != os.getpid():
+        with _mongo_client_lock:
+            if _mongo_client is None or _mongo_client_pid != os.getpid():
+                import pymongo
+                _mongo_client = pymongo.MongoClient(
+                    current_app.config["MONGO_URI"],
+                    maxPoolSize              = current_app.config["MONGO_POOL_MAX"],
+                    minPoolSize              = current_app.config["MONGO_POOL_MIN"],
+                    maxIdleTimeMS            = current_app.config["MONGO_POOL_IDLE_MS"],
+                    waitQueueTimeoutMS       = current_app.config["MONGO_POOL_WAIT_MS"],
+                    connectTimeoutMS         = current_app.config["MONGO_CONNECT_TIMEOUT_MS"],
+                    serverSelectionTimeoutMS = current_app.config["MONGO_SELECT_TIMEOUT_MS"],
+                    event_listeners          = [get_mongo_pool_stats(), get_mongo_command_timer()],
+                    # do not start monitor threads before the first operation - keeps the client fork safe
+                    connect                  = False)
+                _mongo_client_pid = os.getpid()
+    return _mongo_client
+
+
+def reset_mongo_client():
+    """ forget the client of this process without closing it, e.g. after fork() """
+    global _mongo_client, _mongo_client_pid
+    _mongo_client = None
+    _mongo_client_pid = None
+
+
+def get_mongo_coll(collection):
+    import pymongo
+    try:
+        conn = get_mongo_client()
+    except pymongo.errors.PyMongoError as e:
+        print(f"Could not connect to MongoDB {current_app.config['MONGO_DB_NAME']}: {e}")
+        return None
+    return conn[current_app.config["MONGO_DB_NAME"]][collection]
+
+
+def init_mongo_db(load_content=False):
+    with current_app.open_resource(current_app.config["MONGO_CONTENT"], mode='r') as f:
+        collections = json.loads(f.read())
+        for coll_name,coll_docs in collections.items():
+            coll = get_mongo_coll(coll_name)
+            coll.delete_many({})
+            coll.insert_many(coll_docs)
+            bump_version(coll_name)
+    upgrade_celebs_coll()
+
+
+def ensure_celebs_indexes():
+    """ create the indexes of the celebrity list and search, the existing ones are left as they are """
+    import pymongo
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+    # one index per sort order, _id breaks the ties of the keyset cursor;
+    # they also serve the name prefix and the single field filters
+    for field in current_app.config["CELEBS_SORT_FIELDS"]:
+        coll.create_index([(field, pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+    # filter combinations: equality fields first, the dob range last
+    coll.create_index([('occupation', pymongo.ASCENDING), ('nationality', pymongo.ASCENDING), ('dob', pymongo.ASCENDING)])
+    coll.create_index([('nationality', pymongo.ASCENDING), ('dob', pymongo.ASCENDING)])
+    # names are no words of a language: no stemming and no stop words
+    coll.create_index([('first', pymongo.TEXT), ('last', pymongo.TEXT)], name='celebs_name_text',
+                      default_language='none', weights={'last': 2, 'first': 1})
+
+
+def upgrade_celebs_coll():
+    """ create the indexes of the celebrity list and flag documents stored before <has_image> existed """
+    ensure_celebs_indexes()
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+    # aggregation pipeline update evaluates the image on the server, the blob never leaves the database
+    result = coll.update_many({'has_image': {'$exists': False}},
+                              [{'$set': {'has_image': {'$gt': ['$Image', None]}}}])
+    if result.modified_count:
+        bump_version(current_app.config["MONGO_COLLECTION_CELEBS"])
+    return result.modified_count
+
+
+@bp.cli.command("celebs-upgrade")
+def celebs_upgrade_command():
+    """ Create indexes and backfill <has_image> on the celebrities collection. """
+    modified = upgrade_celebs_coll()
+    print(f"{modified} document(s) flagged with has_image")
+
+
+def build_celebs_query(args):
+    """ MongoDB filter of the CELEB_FILTERS in <args>, raises ValueError on a malformed date
+
+        q: words of the first or last name (text index), first/last: prefix of the name (case sensitive),
+        occupation/nationality: exact value, dob_from/dob_to: inclusive range of ISO dates """
+    import re
+    query = {}
+    if args.get('q'):
+        query['$text'] = {'$search': args['q']}
+    for field in ('first', 'last'):
+        if args.get(field):
+            # an anchored, case sensitive prefix is answered from the index bounds
+            query[field] = {'$regex': '^' + re.escape(args[field])}
+    for field in ('occupation', 'nationality'):
+        if args.get(field):
+            query[field] = args[field]
+    dob = {}
+    for arg, operator in (('dob_from', '$gte'), ('dob_to', '$lte')):
+        if args.get(arg):
+            # dob is stored as "YYYY-MM-DD", those compare in date order
+            dob[operator] = date.fromisoformat(args[arg]).isoformat()
+    if dob:
+        query['dob'] = dob
+    return query
+
+
+def find_celebs(query, sort='last', direction=1, after=None, limit=None):
+    """ cursor over the celebrities matching <query> in <sort> order starting behind the document <after>,
+        matches of a text search come by relevance instead; without image blobs """
+    import pymongo
+    from bson.objectid import ObjectId
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+    projection = {field:1 for field in current_app.config["CELEBS_LIST_FIELDS"]}
+    if '$text' in query:
+        projection['score'] = {'$meta': 'textScore'}
+        return coll.find(query, projection).sort([('score', {'$meta': 'textScore'})]).limit(limit or 0)
+    last = coll.find_one({'_id':ObjectId(after)}, {sort:1}) if after and ObjectId.is_valid(after) else None
+    if last:
+        # keyset condition: (sort value, _id) strictly behind the last document of the previous page
+        compare = '$gt' if direction == pymongo.ASCENDING else '$lt'
+        value = last.get(sort)
+        # documents without the field sort before every value, but no comparison with null matches them
+        if value is None:
+            behind = [{sort: {'$ne': None}}] if direction == pymongo.ASCENDING else []
+        elif direction == pymongo.ASCENDING:
+            behind = [{sort: {compare: value}}]
+        else:
+            behind = [{sort: {compare: value}}, {sort: None}]
+        keyset = {'$or': behind + [{sort: value, '_id': {compare: last['_id']}}]}
+        query = {'$and': [query, keyset]} if query else keyset
+    return coll.find(query, projection).sort([(sort, direction), ('_id', direction)]).limit(limit or 0)
+
+
+def query_celebs_page(sort='last', direction=1, after=None, query=None):
+    """ one page of celebrities in <sort> order (direction 1 or -1) starting behind the document <after>, without image blobs """
+    page_size = current_app.config["CELEBS_PAGE_SIZE"]
+    # read one extra document to find out whether there is a next page
+    celebs = list(find_celebs(query or {}, sort, direction, after, page_size+1))
+    next_cursor = None
+    if len(celebs) > page_size:
+        celebs = celebs[:page_size]
+        # the best matches of a text search are shown on one page
+        if not (query and '$text' in query):
+            next_cursor = str(celebs[-1]['_id'])
+    return celebs, next_cursor
+
+
+def get_celebs_page_args(request):
+    """ sort and pagination arguments to carry over into links of the celebrity list """
+    page_args = {'sort': request.args.get('sort', 'last'), 'dir': request.args.get('dir', 'asc'), 'after': request.args.get('after')}
+    if page_args['sort'] not in current_app.config["CELEBS_SORT_FIELDS"]:
+        page_args['sort'] = 'last'
+    if page_args['dir'] not in ('asc', 'desc'):
+        page_args['dir'] = 'asc'
+    page_args.update({arg: request.args.get(arg, '').strip() for arg in CELEB_FILTERS})
+    return {key:value for key,value in page_args.items() if value}
+
+
+def get_gridfs_bucket():
+    import gridfs
+    return gridfs.GridFSBucket(get_mongo_client()[current_app.config["MONGO_DB_NAME"]])
+
+
+def save_image_to_gridfs(stream, filename, mimetype):
+    """ stream an image into GridFS chunk by chunk, return its file id and content hash """
+    chunk_size = current_app.config["CELEBS_IMAGE_CHUNK"]
+    content_hash = hashlib.sha256()
+    grid_in = get_gridfs_bucket().open_upload_stream(filename, chunk_size_bytes=chunk_size)
+    try:
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            content_hash.update(chunk)
+            grid_in.write(chunk)
+    except:
+        grid_in.abort()
+        raise
+    # attributes set before close() are stored with the files document
+    grid_in.metadata = {'contentType': mimetype, 'sha256': content_hash.hexdigest()}
+    grid_in.close()
+    return grid_in._id, content_hash.hexdigest()
+
+
+def delete_image_from_gridfs(image_id):
+    import gridfs
+    try:
+        get_gridfs_bucket().delete(image_id)
+    except gridfs.errors.NoFile:
+        pass
+
+
+def guess_image_type(head:bytes):
+    """ mimetype of the accepted upload formats from the first bytes of the file """
+    if head.startswith(b'\x89PNG'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if head.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'application/octet-stream'
+
+
+def save_celeb_to_db(request, celeb_old):
+    celeb_new  = {column:request.form.get(column,'') for column in CELEB_COLUMNS if request.form.get(column,'') != celeb_old.get(column,'')}
+    celeb_unset = {}
+    # following instructions from https://flask.palletsprojects.com/en/1.1.x/patterns/fileuploads/
+    data = request.files['SourceFileName']
+    image_job = None
+    if data:
+        filename_source = secure_filename(data.filename)
+        extension = filename_source.rsplit('.', 1)[1] if '.' in filename_source else ''
+        if extension in current_app.config["UPLOAD_EXTENSIONS"]:
+            mimetype = mimetypes.guess_type(filename_source)[0] or 'application/octet-stream'
+            # store image
+            if current_app.config["CELEBS_IMAGE_STORAGE"] == 'gridfs':
+                # only spool it, the job "celebs.store_image" uploads it into GridFS after the document is saved
+                spool_name = f"celeb-{uuid.uuid4().hex}.{extension}"
+                os.makedirs(current_app.config["UPLOAD_INCOMING"], exist_ok=True)
+                data.save(os.path.join(current_app.config["UPLOAD_INCOMING"], spool_name))
+                image_job = {'spool_name':spool_name, 'filename':filename_source, 'mimetype':mimetype, 'uploaded':time.time()}
+            else:
+                from bson.binary import Binary
+                image = data.read()
+                celeb_new['Image'] = Binary(image)
+                celeb_new['ImageHash'] = hashlib.sha256(image).hexdigest()
+                celeb_unset['ImageId'] = ''
+                celeb_new['ImageType'] = mimetype
+                celeb_new['ImageDate'] = datetime.utcnow()
+                celeb_new['has_image'] = True
+    if not celeb_old:
+        celeb_new.setdefault('has_image', False)
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+    try:
+        if celeb_old:
+            update = {"$set":celeb_new, "$unset":celeb_unset} if celeb_unset else {"$set":celeb_new}
+            if celeb_new or celeb_unset:
+                coll.update_one({'_id':celeb_old['_id']}, update)
+            celeb_id = celeb_old['_id']
+        else:
+            celeb_id = coll.insert_one(celeb_new).inserted_id
+    except:
+        if image_job:
+            remove_spooled_image(image_job['spool_name'])
+        flash(f"Error in {'update' if celeb_old else 'insert'} operation!")
+        return celeb_new
+    bump_version(current_app.config["MONGO_COLLECTION_CELEBS"])
+    # the document is saved, a failing queue only delays the pictures
+    if 'ImageHash' in celeb_new and celeb_old.get('ImageId'):
+        try:
+            # the replaced picture is not referenced any more
+            jobs.submit("celebs.delete_image", image_id=str(celeb_old['ImageId']))
+        except sqlite3.Error as error:
+            # left to the orphan cleanup
+            flash(f"Could not queue the deletion of the replaced picture: {error}")
+    if image_job:
+        try:
+            jobs.submit("celebs.store_image", celeb_id=str(celeb_id), **image_job)
+        except sqlite3.Error as error:
+            remove_spooled_image(image_job['spool_name'])
+            flash(f"Could not queue the processing of {image_job['filename']}: {error}")
+    # create empty celeb - clear the input fields, because the update was OK
+    flash(f"One document successfully {'updated' if celeb_old else 'added'}")
+    return {}
+
+
+def remove_spooled_image(spool_name):
+    try:
+        os.remove(os.path.join(current_app.config["UPLOAD_INCOMING"], spool_name))
+    except FileNotFoundError:
+        pass
+
+
+def migrate_celeb_images():
+    """ move the inline <Image> of every document into GridFS, one document at a time """
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+    migrated = 0
+    # only the ids are listed, each blob is loaded on its own so memory stays at one image
+    for celeb_id in [celeb['_id'] for celeb in coll.find({'Image': {'$exists': True}}, {'_id':1})]:
+        celeb = coll.find_one({'_id':celeb_id, 'Image': {'$exists': True}}, {'Image':1, 'ImageType':1})
+        if not celeb:
+            continue
+        image = bytes(celeb['Image'])
+        mimetype = celeb.get('ImageType') or guess_image_type(image[:8])
+        image_id, image_hash = save_image_to_gridfs(BytesIO(image), str(celeb_id), mimetype)
+        result = coll.update_one({'_id':celeb_id, 'Image': {'$exists': True}},
+                                 {'$set': {'ImageId':image_id, 'ImageHash':image_hash, 'ImageType':mimetype,
+                                           'ImageDate':celeb_id.generation_time, 'has_image':True},
+                                  '$unset': {'Image':''}})
+        if result.modified_count:
+            migrated += 1
+        else:
+            # the document changed in the meantime
+            delete_image_from_gridfs(image_id)
+    if migrated:
+        bump_version(current_app.config["MONGO_COLLECTION_CELEBS"])
+    return migrated
+
+
+# Background jobs
+#=================
+# run by jobs.py after the request which changed the celebrity returned, safe to run twice
+@jobs.handler("celebs.store_image")
+def store_image_job(celeb_id, spool_name, filename, mimetype, uploaded):
+    """ upload a spooled picture into GridFS and link it to the celebrity, then delete the picture it replaced """
+    from bson.objectid import ObjectId
+    spool_path = os.path.join(current_app.config["UPLOAD_INCOMING"], spool_name)
+    if not os.path.isfile(spool_path):
+        # stored by an earlier attempt
+        return
+    with open(spool_path, 'rb') as f:
+        image_id, image_hash = save_image_to_gridfs(f, filename, mimetype)
+    uploaded = datetime.utcfromtimestamp(uploaded)
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+    # a picture uploaded later may have been stored first, it is not overwritten
+    celeb_old = coll.find_one_and_update({'_id':ObjectId(celeb_id), 'ImageDate': {'$not': {'$gte': uploaded}}},
+                                         {'$set': {'ImageId':image_id, 'ImageHash':image_hash, 'ImageType':mimetype,
+                                                   'ImageDate':uploaded, 'has_image':True},
+                                          '$unset': {'Image':''}},
+                                         projection={'ImageId':1})
+    if celeb_old is None:
+        # deleted or given a newer picture meanwhile
+        delete_image_from_gridfs(image_id)
+    else:
+        bump_version(current_app.config["MONGO_COLLECTION_CELEBS"])
+        if celeb_old.get('ImageId'):
+            delete_image_from_gridfs(celeb_old['ImageId'])
+    os.remove(spool_path)
+
+
+@jobs.handler("celebs.delete_image")
+def delete_image_job(image_id):
+    from bson.objectid import ObjectId
+    delete_image_from_gridfs(ObjectId(image_id))
+
+
+@jobs.handler("celebs.cleanup_images")
+def cleanup_images_job():
+    """ delete the GridFS files and spooled pictures older than JOBS_ORPHAN_AGE which no celebrity refers to """
+    cutoff = time.time() - current_app.config["JOBS_ORPHAN_AGE"]
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+    referenced = set(coll.distinct('ImageId'))
+    # files of the default bucket "fs", see get_gridfs_bucket()
+    files = get_mongo_coll('fs.files').find({'uploadDate': {'$lt': datetime.utcfromtimestamp(cutoff)}}, {'_id':1})
+    orphans = [grid_file['_id'] for grid_file in files if grid_file['_id'] not in referenced]
+    for image_id in orphans:
+        delete_image_from_gridfs(image_id)
+    spooled = 0
+    folder = current_app.config["UPLOAD_INCOMING"]
+    if os.path.isdir(folder):
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                # a picture whose job gave up
+                if entry.name.startswith('celeb-') and entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    spooled += 1
+    print(f"{len(orphans)} orphaned image(s) and {spooled} spooled picture(s) deleted")
+
+
+jobs.periodic("celebs.cleanup_images", "JOBS_CLEANUP_INTERVAL")
+
+
+@bp.cli.command("celebs-migrate-images")
+def celebs_migrate_images_command():
+    """ Move inline celebrity images out of the documents into GridFS. """
+    migrated = migrate_celeb_images()
+    print(f"{migrated} image(s) moved to GridFS")
+
+# Bulk import/export
+#====================
+# pictures are not part of the bulk files, imported celebrities have none
+def prepare_celeb(record):
+    """ celebrity document of an imported record, <_id> is kept when given as ObjectId or its hex string """
+    from bson.objectid import ObjectId
+    unknown = [str(field) for field in record if field not in CELEB_COLUMNS + ('_id',)]
+    if unknown:
+        raise ValueError(f"Unknown field(s) {', '.join(unknown)}")
+    celeb = {field: str(record[field]) for field in CELEB_COLUMNS if record.get(field) not in (None, '')}
+    if not celeb.get('first') and not celeb.get('last'):
+        raise ValueError("first and last name are missing")
+    if record.get('_id'):
+        if not ObjectId.is_valid(record['_id']):
+            raise ValueError(f"Invalid _id {record['_id']}")
+        celeb['_id'] = ObjectId(record['_id'])
+    celeb['has_image'] = False
+    return celeb
+
+
+def import_celebs(records, batch_size=None):
+    """ store the (line number, record, error) tuples of read_records() with unordered insert_many chunks, return a report """
+    from pymongo.errors import BulkWriteError, PyMongoError
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+
+    def insert_batch(celebs):
+        # unordered: a duplicate _id only rejects its own document, the server goes on with the rest
+        try:
+            return len(coll.insert_many(celebs, ordered=False).inserted_ids), []
+        except BulkWriteError as error:
+            return error.details['nInserted'], [(write_error['index'], write_error['errmsg']) for write_error in error.details['writeErrors']]
+        except PyMongoError as error:
+            return 0, [(None, str(error))]
+        finally:
+            bump_version(current_app.config["MONGO_COLLECTION_CELEBS"])
+
+    return import_records(records, prepare_celeb, insert_batch, batch_size or current_app.config["BULK_BATCH_SIZE"])
+
+
+def iter_celebs(fmt, batch_size=None):
+    """ all celebrities in _id order without pictures, fetched from the server <batch_size> documents at a time """
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+    projection = {field:1 for field in CELEB_COLUMNS}
+    for celeb in coll.find({}, projection).sort('_id', 1).batch_size(batch_size or current_app.config["BULK_BATCH_SIZE"]):
+        # CSV has no types, NDJSON keeps the ObjectId as {"$oid": ...}
+        if fmt == 'csv':
+            celeb['_id'] = str(celeb['_id'])
+        yield celeb
+
+
+def dumps_celeb(celeb):
+    from bson import json_util
+    return json_util.dumps(celeb)
+
+
+def loads_celeb(line):
+    from bson import json_util
+    return json_util.loads(line)
+
+
+@bp.route("/celebs/export")
+def export_celebs():
+    check_bulk_token()
+    try:
+        fmt = get_format(request.args.get('format'))
+    except ValueError as error:
+        abort(400, str(error))
+    response = Response(stream_with_context(write_records(iter_celebs(fmt), fmt, ('_id',)+CELEB_COLUMNS, dumps=dumps_celeb)),
+                        mimetype=MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = f"attachment; filename=celebs.{fmt}"
+    return response
+
+
+@bp.route("/celebs/import", methods=['POST'])
+def import_celebs_upload():
+    """ NDJSON or CSV as request body or as multipart upload <file>, answered with the import report """
+    check_bulk_token()
+    upload = request.files.get('file')
+    try:
+        fmt = get_format(request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else None),
+                         upload.filename if upload else None)
+    except ValueError as error:
+        abort(400, str(error))
+    report = import_celebs(read_records(upload.stream if upload else request.stream, fmt, loads=loads_celeb))
+    return jsonify(report)
+
+
+@bp.cli.command("celebs-import")
+@click.argument("file", type=click.File('rb'))
+@click.option("--format", "fmt", type=click.Choice(FORMATS), help="Default: by file extension, else ndjson.")
+@click.option("--batch-size", type=int, help="Documents per insert_many, default BULK_BATCH_SIZE.")
+def celebs_import_command(file, fmt, batch_size):
+    """ Import celebrities from an NDJSON or CSV file, '-' reads stdin. """
+    echo_report(import_celebs(read_records(file, get_format(fmt, getattr(file, 'name', None)), loads=loads_celeb), batch_size))
+
+
+@bp.cli.command("celebs-export")
+@click.argument("file", type=click.File('w', encoding='utf-8'), default='-')
+@click.option("--format", "fmt", type=click.Choice(FORMATS), help="Default: by file extension, else ndjson.")
+def celebs_export_command(file, fmt):
+    """ Export all celebrities without pictures as NDJSON or CSV, to stdout by default. """
+    fmt = get_format(fmt, getattr(file, 'name', None))
+    for chunk in write_records(iter_celebs(fmt), fmt, ('_id',)+CELEB_COLUMNS, dumps=dumps_celeb):
+        file.write(chunk)
+
+
+# Jinja2 filters
+#================
+# inspired by https://stackoverflow.com/questions/4830535/how-do-i-format-a-date-in-jinja2
+@bp.app_template_filter('isodate_to_str')
+def _jinja2_filter_isodate_to_str(isodatestr, format):
+    if isodatestr:
+        return date.fromisoformat(isodatestr).strftime(format)
+    else:
+        return str()
+
+
+# MongoDB routes
+#=================
+@bp.route("/celebs", methods=['GET','POST'])
+@conditional_page
+def celebs():
+    if request.method == 'POST':
+        celeb = save_celeb_to_db(request, {})
+    else:
+        celeb = {}
+    return render_celebs(celeb)
+
+
+@bp.route("/celebs/update/<celeb_id>", methods=['GET','POST'])
+def update_celeb(celeb_id):
+    from bson.objectid import ObjectId
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+    celeb = coll.find_one({"_id":ObjectId(celeb_id)}, {'Image':0})
+    if not celeb:
+        flash(f"Document {celeb_id} does not exist")
+        return redirect(url_for('.celebs', **get_celebs_page_args(request)))
+
+    if request.method == 'POST':
+        celeb = save_celeb_to_db(request, celeb)
+        return redirect(url_for('.celebs', **get_celebs_page_args(request)))
+
+    return render_celebs(celeb)
+
+
+@bp.route("/celebs/delete/<celeb_id>")
+def delete_celeb(celeb_id):
+    from bson.objectid import ObjectId
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+    celeb = coll.find_one_and_delete({"_id":ObjectId(celeb_id)}, {'ImageId':1})
+    if not celeb:
+        flash(f"Document {celeb_id} does not exist")
+    else:
+        bump_version(current_app.config["MONGO_COLLECTION_CELEBS"])
+        if celeb.get('ImageId'):
+            try:
+                jobs.submit("celebs.delete_image", image_id=str(celeb['ImageId']))
+            except sqlite3.Error as error:
+                # left to the orphan cleanup
+                flash(f"Could not queue the deletion of the picture: {error}")
+    return redirect(url_for('.celebs', **get_celebs_page_args(request)))
+
+
+def render_celebs(celeb):
+    page_args = get_celebs_page_args(request)
+    # same values as pymongo.DESCENDING and pymongo.ASCENDING
+    direction = -1 if page_args['dir'] == 'desc' else 1
+    try:
+        query = build_celebs_query(page_args)
+    except ValueError as error:
+        flash(f"Invalid filter: {error}")
+        query = {}
+    filter_args = {arg: page_args[arg] for arg in CELEB_FILTERS if arg in page_args}
+
+    def render_table():
+        celebs, next_cursor = query_celebs_page(page_args['sort'], direction, page_args.get('after'), query)
+        return render_template("celebs_table.html", celebs=celebs, page_args=page_args, filter_args=filter_args,
+                               next_cursor=next_cursor), None
+
+    # the table is only queried and rendered when the celebrities changed since it was cached
+    table_html = cached_fragment(current_app.config["MONGO_COLLECTION_CELEBS"], page_args, render_table)
+    # the form posts back to the current page of the list
+    request_path = url_for(request.endpoint, **request.view_args, **page_args)
+    return render_template("celebs.html", page_title="Celebrities", request_path=request_path, last_celeb=celeb,
+                           page_args=page_args, filter_args=filter_args, table_html=Markup(table_html))
+
+
+@bp.route("/celebs/search")
+def search_celebs():
+    """ JSON search API, arguments: CELEB_FILTERS, sort, dir, after (cursor of the previous answer) and limit """
+    page_args = get_celebs_page_args(request)
+    try:
+        query = build_celebs_query(page_args)
+        limit = min(int(request.args.get('limit', current_app.config["CELEBS_PAGE_SIZE"])), current_app.config["CELEBS_SEARCH_LIMIT"])
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    direction = -1 if page_args['dir'] == 'desc' else 1
+    # one extra document tells whether there is a next page
+    celebs = list(find_celebs(query, page_args['sort'], direction, page_args.get('after'), max(limit, 1)+1))
+    next_cursor = None
+    if len(celebs) > limit:
+        celebs = celebs[:limit]
+        if '$text' not in query and celebs:
+            next_cursor = str(celebs[-1]['_id'])
+    fields = CELEB_COLUMNS + ('has_image', 'score')
+    return jsonify({'celebs': [dict({'_id': str(celeb['_id'])}, **{field: celeb[field] for field in fields if field in celeb}) for celeb in celebs],
+                    'next_cursor': next_cursor})
+
+
+# representative requests of the list and the search, checked by `flask celebs-explain`
+CELEBS_EXPLAIN_ARGS = (
+    {'q': 'tom'},
+    {'q': 'tom', 'occupation': 'actor'},
+    {'first': 'To'},
+    {'last': 'Ha', 'sort': 'last'},
+    {'occupation': 'actor'},
+    {'nationality': 'american'},
+    {'occupation': 'actor', 'nationality': 'american'},
+    {'dob_from': '1950-01-01', 'dob_to': '1969-12-31', 'sort': 'dob'},
+    {'occupation': 'actor', 'dob_from': '1950-01-01', 'dob_to': '1969-12-31'},
+    {'nationality': 'american', 'dob_from': '1950-01-01'},
+    {'occupation': 'actor', 'nationality': 'american', 'dob_to': '1969-12-31'},
+) + tuple({'sort': field} for field in ('last','first','dob','occupation','nationality'))
+
+
+def plan_stages(plan):
+    """ names of all stages of an explain() plan tree, classic and slot based engine """
+    stages = [plan['stage']] if 'stage' in plan else []
+    for key in ('inputStage', 'queryPlan', 'thenStage', 'elseStage'):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        stages += plan_stages(child)
+    return stages
+
+
+def explain_celebs_queries(args_list=CELEBS_EXPLAIN_ARGS):
+    """ (args, stages of the winning plan) for every request, no stages when the server refused a text search """
+    import pymongo.errors
+    results = []
+    for args in args_list:
+        sort = args.get('sort', 'last')
+        query = build_celebs_query(args)
+        try:
+            explanation = find_celebs(query, sort, 1, None, current_app.config["CELEBS_PAGE_SIZE"]+1).explain()
+        except pymongo.errors.OperationFailure:
+            # $text needs a text index, without one the query fails instead of scanning
+            if '$text' not in query:
+                raise
+            results.append((args, []))
+            continue
+        results.append((args, plan_stages(explanation['queryPlanner']['winningPlan'])))
+    return results
+
+
+def plan_without_index(args, stages):
+    """ True if the plan of the request <args> scans the whole collection or searches text without the text index """
+    if args.get('q'):
+        # TEXT before MongoDB 4.4, TEXT_MATCH and TEXT_OR since
+        return not any(stage.startswith('TEXT') for stage in stages)
+    return 'COLLSCAN' in stages
+
+
+@bp.cli.command("celebs-explain")
+def celebs_explain_command():
+    """ Explain the list and search queries, fail if one of them is not answered from an index. """
+    missing = 0
+    for args, stages in explain_celebs_queries():
+        missing += plan_without_index(args, stages)
+        click.echo(f"{'NO INDEX' if plan_without_index(args, stages) else 'ok':8} {args}: {' <- '.join(stages)}")
+    if missing:
+        raise click.ClickException(f"{missing} query(ies) without index")
+
+
+@bp.route("/celebs/image/<celeb_id>")
+def image_celeb(celeb_id):
+    import gridfs
+    from bson.objectid import ObjectId
+    coll = get_mongo_coll(current_app.config["MONGO_COLLECTION_CELEBS"])
+    celeb = coll.find_one({"_id":ObjectId(celeb_id)}, {'ImageId':1, 'ImageHash':1, 'ImageType':1, 'ImageDate':1})
+    if not celeb or not (celeb.get('ImageId') or celeb.get('ImageHash')):
+        # documents stored before the image hash was recorded
+        celeb = coll.find_one({"_id":ObjectId(celeb_id)}, {'Image':1, 'ImageType':1, 'ImageDate':1})
+        if not celeb or not celeb.get('Image'):
+            abort(404)
+        celeb['ImageHash'] = hashlib.sha256(celeb['Image']).hexdigest()
+        celeb.setdefault('ImageType', guess_image_type(celeb['Image'][:8]))
+
+    etag = celeb['ImageHash']
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif celeb.get('ImageId'):
+        try:
+            grid_out = get_gridfs_bucket().open_download_stream(celeb['ImageId'])
+        except gridfs.errors.NoFile:
+            abort(404)
+        # iterating a GridOut yields the file chunk by chunk
+        response = Response(grid_out, direct_passthrough=True)
+        response.content_length = grid_out.length
+    else:
+        image = celeb.get('Image') or coll.find_one({"_id":celeb['_id']}, {'Image':1})['Image']
+        response = Response(bytes(image))
+    response.mimetype = celeb.get('ImageType') or 'application/octet-stream'
+    response.set_etag(etag)
+    response.last_modified = celeb.get('ImageDate') or celeb['_id'].generation_time
+    # the list links the picture with its hash, such a URL never changes content
+    if request.args.get('v') == etag:
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+@bp.route("/mongo/pool")
+def mongo_pool():
+    """ connection pool statistics of this worker process """
+    stats = get_mongo_pool_stats().snapshot()
+    stats['pid'] = os.getpid()
+    stats['max_pool_size'] = current_app.config["MONGO_POOL_MAX"]
+    return jsonify(stats)
@@ -0,0 +1,32 @@
+/* full-text index of Todos.Content, run after sqlite_schema.sql and by `flask todos-fts-rebuild`
+   external content table: the text is stored only once, in Todos, the index is kept in sync by the triggers below
+   see https://www.sqlite.org/fts5.html#external_content_tables */
+CREATE VIRTUAL TABLE IF NOT EXISTS TodosFts USING fts5(
+    Content
+   ,content='Todos'
+   ,content_rowid='TaskId'
+   ,tokenize='unicode61 remove_diacritics 2' -- case and accent insensitive words
+);
+
+/* the old text has to be handed over when a row leaves the index */
+CREATE TRIGGER IF NOT EXISTS trgTodosFtsIns
+         AFTER INSERT ON Todos
+BEGIN
+    INSERT INTO TodosFts (rowid, Content) VALUES (new.TaskId, new.Content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trgTodosFtsDel
+         AFTER DELETE ON Todos
+BEGIN
+    INSERT INTO TodosFts (TodosFts, rowid, Content) VALUES ('delete', old.TaskId, old.Content);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trgTodosFtsUpd
+         AFTER UPDATE OF Content ON Todos -- same as trgTodosUpd, the other columns are not indexed
+BEGIN
+    INSERT INTO TodosFts (TodosFts, rowid, Content) VALUES ('delete', old.TaskId, old.Content);
+    INSERT INTO TodosFts (rowid, Content) VALUES (new.TaskId, new.Content);
+END;
+
+/* index the rows which were stored before the triggers existed */
+INSERT INTO TodosFts (TodosFts) VALUES ('rebuild');
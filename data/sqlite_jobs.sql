@@ -0,0 +1,15 @@
+/* background jobs of jobs.py when JOBS_PERSIST is on, created on first use */
+CREATE TABLE IF NOT EXISTS Jobs (
+    JobId      INTEGER     PRIMARY KEY
+   ,Name       TEXT        NOT NULL -- registered with @jobs.handler(<name>)
+   ,Args       TEXT        NOT NULL -- JSON object of the keyword arguments
+   ,Status     TEXT        NOT NULL DEFAULT 'pending' -- pending, running or failed; finished jobs are deleted
+   ,Attempts   INTEGER     NOT NULL DEFAULT 0
+   ,RunAt      REAL        NOT NULL -- Unix time from which the job is due, pushed back by the retries
+   ,ClaimedBy  TEXT            NULL -- worker running the job, another one takes it over once LeaseUntil passed
+   ,LeaseUntil REAL            NULL
+   ,Error      TEXT            NULL -- of the last attempt
+   ,DatTimIns  REAL        NOT NULL
+);
+/* the dispatchers look for due jobs only */
+CREATE INDEX IF NOT EXISTS idxJobsDue ON Jobs (Status, RunAt);
@@ -0,0 +1,39 @@
+/* local mirror of the Google Sheets worksheets of the sandwiches page, see sandwiches_mirror.py
+   the tables are created on first use and survive a re-initialization of the Todos tables */
+CREATE TABLE IF NOT EXISTS SheetRows (
+    Sheet      TEXT        NOT NULL
+   ,RowNo      INTEGER     NOT NULL -- 1-based row number in the worksheet, row 1 holds the column titles
+   ,Cells      TEXT        NOT NULL -- JSON array of the cell values as strings, like get_all_values() returns them
+   ,PRIMARY KEY (Sheet, RowNo)
+) WITHOUT ROWID;
+
+/* rows are only ever appended to the worksheets: the next sync asks for the rows after RowCount */
+CREATE TABLE IF NOT EXISTS SheetSync (
+    Sheet      TEXT        PRIMARY KEY
+   ,RowCount   INTEGER     NOT NULL DEFAULT 0
+   ,Revision   INTEGER     NOT NULL DEFAULT 0 -- incremented whenever the mirrored rows change
+   ,DatTimSync INTEGER(4)      NULL
+);
+
+/* form submissions waiting to be appended to the worksheets with one append_rows call per sheet */
+CREATE TABLE IF NOT EXISTS SheetOutbox (
+    OutboxId   INTEGER     PRIMARY KEY
+   ,Sheet      TEXT        NOT NULL
+   ,Cells      TEXT        NOT NULL
+   ,ClaimedBy  TEXT            NULL -- worker which is sending the row, rows of a failed flush are released
+   ,DatTimClaim INTEGER(4)     NULL
+   ,Attempts   INTEGER     NOT NULL DEFAULT 0 -- failed flushes, added by ensure_mirror_tables() to older databases
+   ,DatTimIns  INTEGER (4) NOT NULL DEFAULT (strftime('%s', DateTime('Now','UTC')))
+);
+
+/* outbox rows which are not sent again: of an unknown worksheet or failed GSHEETS_OUTBOX_MAX_ATTEMPTS times */
+CREATE TABLE IF NOT EXISTS SheetOutboxFailed (
+    FailedId   INTEGER     PRIMARY KEY
+   ,OutboxId   INTEGER     NOT NULL -- the outbox reuses the ids of the removed rows
+   ,Sheet      TEXT        NOT NULL
+   ,Cells      TEXT        NOT NULL
+   ,Attempts   INTEGER     NOT NULL
+   ,Error      TEXT            NULL
+   ,DatTimIns  INTEGER (4) NOT NULL
+   ,DatTimFail INTEGER (4) NOT NULL DEFAULT (strftime('%s', DateTime('Now','UTC')))
+);
@@ -0,0 +1,210 @@
+""" cache of rendered page fragments, keyed by the version of the data they show """
+import os
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+import importlib
+from cachetools import LRUCache
+from flask import current_app, jsonify
+
+# a fragment is stored under "<name>:<data version>:<digest of its arguments>", so writing through
+# insert_row(), update_row(), delete_row(), save_celeb_to_db() or delete_celeb() bumps the data version
+# and the next request renders afresh; the old fragments are never read again and expire
+
+
+# Backends
+#==========
+class MemoryBackend:
+    """ fragments of this worker process only: use with one worker or for development """
+    def __init__(self, app):
+        self.fragments = LRUCache(maxsize=app.config["FRAGMENT_CACHE_SIZE"])
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.fragments.get(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.fragments[key] = (time.time()+ttl, value)
+
+    def version(self, name):
+        with self.lock:
+            return self.versions.get(name, 0)
+
+    def bump(self, name):
+        with self.lock:
+            self.versions[name] = self.versions.get(name, 0) + 1
+            return self.versions[name]
+
+
+class SQLiteBackend:
+    """ fragments and versions in a SQLite file shared by all worker processes of the host """
+    def __init__(self, app):
+        self.path = app.config["FRAGMENT_CACHE_DB"]
+        self.local = threading.local()
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS Fragments (
+                              Key     TEXT PRIMARY KEY
+                             ,Value   TEXT NOT NULL
+                             ,Expires REAL     NULL -- Unix time, NULL for the data versions
+                          ) WITHOUT ROWID;""")
+
+    def connect(self):
+        # one connection per thread in autocommit mode, reads never hold a transaction open
+        if getattr(self.local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL;")
+            # losing the cache in a power cut is fine
+            db.execute("PRAGMA synchronous=OFF;")
+            db.execute("PRAGMA busy_timeout=2000;")
+            self.local.db, self.local.pid = db, os.getpid()
+        return self.local.db
+
+    def get(self, key):
+        row = self.connect().execute("SELECT Value FROM Fragments WHERE Key=? AND Expires>?;", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        db = self.connect()
+        db.execute("INSERT OR REPLACE INTO Fragments (Key, Value, Expires) VALUES (?,?,?);", (key, value, time.time()+ttl))
+        # now and then drop the expired fragments, the ones of outdated versions included
+        if random.random() < 0.01:
+            db.execute("DELETE FROM Fragments WHERE Expires<?;", (time.time(),))
+
+    def version(self, name):
+        row = self.connect().execute("SELECT Value FROM Fragments WHERE Key=?;", ('version:'+name,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def bump(self, name):
+        db = self.connect()
+        db.execute("""INSERT INTO Fragments (Key, Value, Expires) VALUES (?, '1', NULL)
+                      ON CONFLICT (Key) DO UPDATE SET Value = CAST(Value AS INTEGER) + 1;""", ('version:'+name,))
+        return self.version(name)
+
+
+# other backends, e.g. Redis for several hosts, are added with register_backend() and selected by FRAGMENT_CACHE_BACKEND;
+# a backend is created with the app and offers get(key), set(key, value, ttl), version(name) and bump(name)
+_backend_factories = {'memory': MemoryBackend, 'sqlite': SQLiteBackend}
+
+
+def register_backend(name, factory):
+    """ make <factory>(app) available as FRAGMENT_CACHE_BACKEND=<name> """
+    _backend_factories[name] = factory
+
+
+# Cache
+#=======
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+# hits and misses per fragment name in this worker process
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_backend():
+    """ backend of this process, None if the cache is switched off """
+    global _backend, _backend_pid
+    if _backend_pid != os.getpid():
+        with _backend_lock:
+            if _backend_pid != os.getpid():
+                name = current_app.config["FRAGMENT_CACHE_BACKEND"]
+                if name in ('', 'none'):
+                    factory = None
+                elif name in _backend_factories:
+                    factory = _backend_factories[name]
+                else:
+                    # "package.module:Class"
+                    module, _, attr = name.partition(':')
+                    factory = getattr(importlib.import_module(module), attr)
+                _backend = factory(current_app) if factory else None
+                _backend_pid = os.getpid()
+    return _backend
+
+
+def reset_fragment_cache():
+    """ forget the backend and the counters of this process, e.g. after fork() """
+    global _backend, _backend_pid
+    _backend = None
+    _backend_pid = None
+    with _stats_lock:
+        _stats.clear()
+
+
+def count(name, outcome):
+    with _stats_lock:
+        counters = _stats.setdefault(name, {'hits': 0, 'misses': 0, 'errors': 0})
+        counters[outcome] += 1
+
+
+def get_fragment_stats():
+    """ hits, misses and errors per fragment name in this worker process """
+    with _stats_lock:
+        return {name: dict(counters) for name, counters in _stats.items()}
+
+
+def bump_version(name):
+    """ mark the data <name> as changed, the fragments showing it are rendered again """
+    try:
+        backend = get_backend()
+        if backend:
+            backend.bump(name)
+    except Exception as error:
+        # the write itself succeeded, the fragments catch up when they expire
+        print(f"Could not bump the fragment cache version of {name}: {error}")
+
+
+def cached_fragment(name, args, render, ttl=None):
+    """ the value of render() for data <name> and the arguments <args>, from the cache while the data is unchanged
+
+        render() returns (value, ttl or None), value has to be JSON serializable;
+        the ttl bounds how long the value is served, e.g. until relative times shown in it go out of date """
+    backend = get_backend()
+    if backend is None:
+        return render()[0]
+    try:
+        digest = hashlib.sha1(json.dumps(args, sort_keys=True).encode()).hexdigest()
+        key = f"{name}:{backend.version(name)}:{digest}"
+        value = backend.get(key)
+    except Exception as error:
+        print(f"Fragment cache read of {name} failed: {error}")
+        count(name, 'errors')
+        return render()[0]
+    if value is not None:
+        count(name, 'hits')
+        return json.loads(value)
+    count(name, 'misses')
+    value, value_ttl = render()
+    ttl = min(ttl or current_app.config["FRAGMENT_CACHE_TTL"], value_ttl or current_app.config["FRAGMENT_CACHE_TTL"])
+    try:
+        backend.set(key, json.dumps(value), ttl)
+    except Exception as error:
+        print(f"Fragment cache write of {name} failed: {error}")
+        count(name, 'errors')
+    return value
+
+
+def relative_time_ttl(timestamps):
+    """ seconds until a relative time of the youngest timestamp may change, e.g. 60 for "5 minutes ago" """
+    if not timestamps:
+        return None
+    age = time.time() - max(timestamps)
+    for limit, unit in ((60, 1), (3600, 60), (86400, 3600)):
+        if age < limit:
+            return unit
+    return 86400
+
+
+def init_app(app):
+    @app.route("/cache/stats")
+    def fragment_cache_stats():
+        """ hits and misses of the fragment cache in the serving worker """
+        return jsonify({'backend': app.config["FRAGMENT_CACHE_BACKEND"], 'pid': os.getpid(), 'fragments': get_fragment_stats()})
@@ -0,0 +1,24 @@
+# Gunicorn settings, see https://docs.gunicorn.org/en/stable/settings.html
+# start with: gunicorn --config gunicorn.conf.py "run:create_app()"
+import os
+import multiprocessing
+
+# the source 'PORT' name is mandated by Heroku app deployment
+bind = f"{os.environ.get('FLASK_IP', '0.0.0.0')}:{os.environ.get('PORT', '5000')}"
+
+# WEB_CONCURRENCY is set by Heroku according to the dyno size
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# the views mostly wait on SQLite, MongoDB and Google Sheets, threads keep a worker busy meanwhile
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "4"))
+timeout = int(os.environ.get("WEB_TIMEOUT", "30"))
+
+# import the app once in the master process, the workers share its memory pages
+preload_app = os.environ.get("WEB_PRELOAD", "True").lower() in {'1','true','t','yes','y'}
+accesslog = "-"
+
+
+def post_fork(server, worker):
+    # clients and connections are per process, never use the ones of the master
+    from run import reset_process_resources
+    reset_process_resources()
@@ -0,0 +1,159 @@
+""" HTTP caching of the responses: fingerprinted static URLs, ETags of the list pages and compression """
+import os
+import gzip
+import hashlib
+import threading
+from functools import wraps
+from flask import current_app, request, make_response
+
+# brotli is optional, pip install Brotli; gzip is used without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Static assets
+#===============
+# "<filename>" -> (mtime, size, content hash), a changed file gets a new URL
+_static_hashes = {}
+# (filename, hash, encoding) -> compressed file content
+_static_compressed = {}
+_static_lock = threading.Lock()
+
+
+def static_hash(filename):
+    """ first 12 hex digits of the SHA-256 of a file in the static folder, None if there is no such file """
+    path = os.path.join(current_app.static_folder, filename)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    with _static_lock:
+        cached = _static_hashes.get(filename)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    with open(path, 'rb') as f:
+        content_hash = hashlib.sha256(f.read()).hexdigest()[:12]
+    with _static_lock:
+        _static_hashes[filename] = (stat.st_mtime, stat.st_size, content_hash)
+    return content_hash
+
+
+def add_static_version(endpoint, values):
+    """ url_for('static', filename=...) gets ?v=<content hash>, the browser keeps each version for good """
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = static_hash(values['filename'])
+        if version:
+            values['v'] = version
+
+
+def cache_static(response):
+    # only the URL of the current content may be cached forever, an outdated ?v= is revalidated as usual
+    version = request.args.get('v')
+    if response.status_code in (200, 304) and version and version == static_hash(request.view_args['filename']):
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+        response.expires = None
+    return response
+
+
+# Conditional GET
+#=================
+def conditional_page(view):
+    """ answer a GET with 304 Not Modified when the page is the same as the one the browser has
+
+        the ETag is a digest of the rendered page: the page is still rendered, from the cached fragments,
+        but neither compressed nor sent again; weak, because the compressed forms of a page share it """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        if request.method == 'GET' and response.status_code == 200 and not response.is_streamed:
+            response.set_etag(hashlib.sha1(response.get_data()).hexdigest(), weak=True)
+            # flashed messages make the page specific to the session, and it has to be revalidated on every visit
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.make_conditional(request)
+        return response
+    return wrapper
+
+
+# Compression
+#=============
+def choose_encoding():
+    """ best content coding the client accepts, None for identity """
+    encodings = (['br'] if brotli and current_app.config["COMPRESS_BROTLI"] else []) + ['gzip']
+    return request.accept_encodings.best_match(encodings)
+
+
+def compress(data, encoding):
+    level = current_app.config["COMPRESS_LEVEL"]
+    if encoding == 'br':
+        # brotli quality 0-11, the gzip level maps onto it
+        return brotli.compress(data, quality=min(11, level + 1))
+    # no timestamp in the header, the same page compresses to the same bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def static_file_data(response):
+    """ content of a file sent by the static view, compressed once per version and encoding """
+    filename = request.view_args['filename']
+    encoding = response.headers['Content-Encoding']
+    key = (filename, static_hash(filename), encoding)
+    with _static_lock:
+        data = _static_compressed.get(key)
+    if data is None:
+        with open(os.path.join(current_app.static_folder, filename), 'rb') as f:
+            data = compress(f.read(), encoding)
+        with _static_lock:
+            _static_compressed[key] = data
+    return data
+
+
+def compress_response(response):
+    """ gzip or brotli for the text responses which are large enough to be worth it """
+    if response.mimetype not in current_app.config["COMPRESS_MIMETYPES"]:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    # files are sent as a stream by the static view, their length is in the header
+    static = request.endpoint == 'static' and response.direct_passthrough
+    if static:
+        length = response.content_length or 0
+    elif response.is_streamed:
+        # e.g. the bulk exports
+        return response
+    else:
+        length = len(response.get_data())
+    if length < current_app.config["COMPRESS_MIN_SIZE"]:
+        return response
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+    response.headers['Content-Encoding'] = encoding
+    if static:
+        response.response.close()
+        response.direct_passthrough = False
+        response.set_data(static_file_data(response))
+    else:
+        response.set_data(compress(response.get_data(), encoding))
+    # the bytes sent differ from the uncompressed ones
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    if app.config["STATIC_FINGERPRINT"]:
+        app.url_defaults(add_static_version)
+
+    @app.after_request
+    def http_cache_headers(response):
+        if request.endpoint == 'static':
+            cache_static(response)
+        if app.config["COMPRESS"]:
+            compress_response(response)
+        return response
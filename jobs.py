@@ -0,0 +1,324 @@
+""" in-process background jobs: a thread pool per worker, optionally persisted in SQLite, with retry and backoff """
+import os
+import json
+import time
+import uuid
+import heapq
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app, jsonify
+
+from sqlite_db import get_sqlite_db
+
+# a job is a registered function called with JSON serializable keyword arguments,
+# it must tolerate running twice: after a crash or an expired lease it is run again
+_handlers = {}
+# name -> config key of the interval in seconds, submitted by the dispatcher when due
+_periodic = {}
+
+_state_lock = threading.Lock()
+_dispatcher = None
+_pool = None
+_pid = None
+_wakeup = threading.Event()
+# jobs of the in-memory queue: heap of (run at, sequence, job)
+_memory_queue = []
+_memory_sequence = 0
+_running = 0
+_tables_pid = None
+# counters and recent timings of this worker process
+_stats = {'submitted': 0, 'succeeded': 0, 'retried': 0, 'failed': 0}
+_latencies = deque(maxlen=1000)
+_durations = deque(maxlen=1000)
+_last_periodic = {}
+
+
+def handler(name):
+    """ register the decorated function as job <name> """
+    def register(function):
+        _handlers[name] = function
+        return function
+    return register
+
+
+def periodic(name, interval_config):
+    """ submit job <name> every app.config[<interval_config>] seconds, 0 switches it off """
+    _periodic[name] = interval_config
+
+
+# Queue
+#=======
+def ensure_jobs_table():
+    global _tables_pid
+    if _tables_pid != os.getpid():
+        with current_app.open_resource(current_app.config["SQLITE_SCHEMA_JOBS"], mode='r') as f:
+            get_sqlite_db().executescript(f.read())
+        _tables_pid = os.getpid()
+
+
+def submit(name, unique=False, **kwargs):
+    """ queue job <name>(**kwargs) to run as soon as a thread is free, <unique>: not if one is pending already """
+    global _memory_sequence
+    if name not in _handlers:
+        raise ValueError(f"Unknown job {name}")
+    now = time.time()
+    job = {'id': None, 'name': name, 'args': kwargs, 'attempts': 0, 'run_at': now}
+    if current_app.config["JOBS_PERSIST"]:
+        ensure_jobs_table()
+        db = get_sqlite_db()
+        if unique and db.execute("SELECT 1 FROM Jobs WHERE Name=? AND Status='pending';", (name,)).fetchone():
+            return None
+        cur = db.execute("INSERT INTO Jobs (Name, Args, RunAt, DatTimIns) VALUES (?,?,?,?);", (name, json.dumps(kwargs), now, now))
+        db.commit()
+        job['id'] = cur.lastrowid
+    else:
+        with _state_lock:
+            if unique and any(queued['name'] == name for _,_,queued in _memory_queue):
+                return None
+            _memory_sequence += 1
+            job['id'] = _memory_sequence
+            heapq.heappush(_memory_queue, (now, _memory_sequence, job))
+    with _state_lock:
+        _stats['submitted'] += 1
+    start_dispatcher(current_app._get_current_object())
+    _wakeup.set()
+    return job['id']
+
+
+def claim_due_jobs(limit):
+    """ take up to <limit> due jobs off the queue, persisted ones are leased to this worker """
+    if limit < 1:
+        return []
+    now = time.time()
+    if not current_app.config["JOBS_PERSIST"]:
+        jobs = []
+        with _state_lock:
+            while _memory_queue and _memory_queue[0][0] <= now and len(jobs) < limit:
+                jobs.append(heapq.heappop(_memory_queue)[2])
+        return jobs
+    ensure_jobs_table()
+    names = tuple(_handlers)
+    due = f"""{handled_by_worker(names)}
+              AND ((Status='pending' AND RunAt<=?) OR (Status='running' AND LeaseUntil<?))"""
+    # most polls find nothing, those must not take the write lock from the requests
+    if not get_sqlite_db(readonly=True).execute(f"SELECT 1 FROM Jobs WHERE {due} LIMIT 1;", names + (now, now)).fetchone():
+        return []
+    db = get_sqlite_db()
+    claim = uuid.uuid4().hex
+    db.execute(f"""UPDATE Jobs SET Status='running', ClaimedBy=?, LeaseUntil=?
+                    WHERE JobId IN (SELECT JobId FROM Jobs WHERE {due} ORDER BY RunAt LIMIT ?);""",
+               (claim, now+current_app.config["JOBS_LEASE"]) + names + (now, now, limit))
+    db.commit()
+    return [{'id': row['JobId'], 'name': row['Name'], 'args': json.loads(row['Args']), 'attempts': row['Attempts'], 'run_at': row['RunAt']}
+            for row in db.execute("SELECT JobId, Name, Args, Attempts, RunAt FROM Jobs WHERE ClaimedBy=? AND Status='running';", (claim,))]
+
+
+def handled_by_worker(names):
+    # the jobs of features which are not enabled in this worker stay in the queue for the other workers
+    return f"Name IN ({','.join('?'*len(names))})"
+
+
+def next_due_in(default):
+    """ seconds until the next job this worker could claim is due, at most <default> """
+    if current_app.config["JOBS_PERSIST"]:
+        ensure_jobs_table()
+        names = tuple(_handlers)
+        # the same jobs as claim_due_jobs(): pending ones when they are due, running ones when their lease runs out
+        run_at = get_sqlite_db(readonly=True).execute(
+            f"""SELECT min(CASE Status WHEN 'pending' THEN RunAt ELSE LeaseUntil END) FROM Jobs
+                 WHERE {handled_by_worker(names)} AND Status IN ('pending','running');""", names).fetchone()[0]
+    else:
+        with _state_lock:
+            run_at = _memory_queue[0][0] if _memory_queue else None
+    if run_at is None:
+        return default
+    return min(max(run_at - time.time(), 0), default)
+
+
+def finish_job(job, error=None):
+    """ delete a finished job, or schedule the next attempt with exponential backoff, or give up """
+    attempts = job['attempts'] + 1
+    retry = error is not None and attempts < current_app.config["JOBS_MAX_ATTEMPTS"]
+    if retry:
+        # 1, 2, 4, ... times JOBS_BACKOFF seconds with jitter, so failing jobs do not retry in lockstep
+        delay = min(current_app.config["JOBS_BACKOFF"] * 2**(attempts-1), current_app.config["JOBS_BACKOFF_MAX"]) * random.uniform(0.5, 1.5)
+    with _state_lock:
+        _stats['succeeded' if error is None else 'retried' if retry else 'failed'] += 1
+    if error is not None and not retry:
+        print(f"Job {job['name']} {job['args']} failed after {attempts} attempt(s): {error}")
+    if current_app.config["JOBS_PERSIST"]:
+        db = get_sqlite_db()
+        if error is None:
+            db.execute("DELETE FROM Jobs WHERE JobId=?;", (job['id'],))
+        elif retry:
+            db.execute("UPDATE Jobs SET Status='pending', Attempts=?, RunAt=?, Error=?, ClaimedBy=NULL, LeaseUntil=NULL WHERE JobId=?;",
+                       (attempts, time.time()+delay, str(error), job['id']))
+        else:
+            # failed jobs are kept for inspection, see /jobs/stats
+            db.execute("UPDATE Jobs SET Status='failed', Attempts=?, Error=?, ClaimedBy=NULL, LeaseUntil=NULL WHERE JobId=?;",
+                       (attempts, str(error), job['id']))
+        db.commit()
+    elif retry:
+        with _state_lock:
+            heapq.heappush(_memory_queue, (time.time()+delay, job['id'], dict(job, attempts=attempts, run_at=time.time()+delay)))
+
+
+def run_job(app, job):
+    global _running
+    try:
+        with app.app_context():
+            started = time.time()
+            error = None
+            try:
+                _handlers[job['name']](**job['args'])
+            except Exception as job_error:
+                error = job_error
+            with _state_lock:
+                # how long the job waited after it was due, and how long it ran
+                _latencies.append(started - job['run_at'])
+                _durations.append(time.time() - started)
+            finish_job(job, error)
+    except Exception as error:
+        print(f"Job {job['name']} could not be finished: {error}")
+    finally:
+        with _state_lock:
+            _running -= 1
+        _wakeup.set()
+
+
+# Dispatcher
+#============
+def submit_periodic_jobs():
+    now = time.time()
+    for name, interval_config in _periodic.items():
+        interval = current_app.config[interval_config]
+        # the first run is one interval after the start, not in every worker that just booted
+        _last_periodic.setdefault(name, now)
+        if name in _handlers and interval and now - _last_periodic.get(name, 0) >= interval:
+            _last_periodic[name] = now
+            submit(name, unique=True)
+
+
+def dispatch_loop(app, pool, workers):
+    global _running
+    with app.app_context():
+        while _pid == os.getpid():
+            # cleared before looking at the queue, so a wake-up meanwhile is not lost
+            _wakeup.clear()
+            try:
+                submit_periodic_jobs()
+                with _state_lock:
+                    free = workers - _running
+                for job in claim_due_jobs(free):
+                    with _state_lock:
+                        _running += 1
+                    pool.submit(run_job, app, job)
+                with _state_lock:
+                    busy = _running >= workers
+                # with every thread busy a due job has to wait for run_job() to wake the dispatcher
+                wait = app.config["JOBS_POLL_INTERVAL"] if busy else next_due_in(app.config["JOBS_POLL_INTERVAL"])
+            except Exception as error:
+                print(f"Job dispatcher failed: {error}")
+                wait = app.config["JOBS_POLL_INTERVAL"]
+            _wakeup.wait(wait)
+
+
+def start_dispatcher(app):
+    """ start the thread pool and the dispatcher of this process, unless they are running already """
+    global _dispatcher, _pool, _pid, _running
+    if _pid == os.getpid() and _dispatcher is not None and _dispatcher.is_alive():
+        return
+    with _state_lock:
+        # threads do not survive fork(), every worker process starts its own
+        if _pid != os.getpid() or _dispatcher is None or not _dispatcher.is_alive():
+            _pid = os.getpid()
+            _running = 0
+            _last_periodic.clear()
+            workers = app.config["JOBS_WORKERS"]
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+            _dispatcher = threading.Thread(target=dispatch_loop, args=(app, _pool, workers), name="job-dispatcher", daemon=True)
+            _dispatcher.start()
+
+
+def drain(timeout=30):
+    """ wait until no job is due or running, True if that happened within <timeout> seconds """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with _state_lock:
+            running = _running
+        if not running and next_due_in(1) > 0:
+            return True
+        _wakeup.set()
+        time.sleep(0.01)
+    return False
+
+
+def reset_jobs():
+    """ forget the threads and the in-memory queue inherited from the parent process, e.g. after fork() """
+    global _dispatcher, _pool, _pid, _running, _tables_pid
+    with _state_lock:
+        _dispatcher = _pool = _pid = _tables_pid = None
+        _running = 0
+        _memory_queue.clear()
+        _last_periodic.clear()
+        for key in _stats:
+            _stats[key] = 0
+        _latencies.clear()
+        _durations.clear()
+
+
+# Metrics
+#=========
+def summarize(samples):
+    """ p50, p95 and max of the samples in ms """
+    if not samples:
+        return {'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+    ordered = sorted(samples)
+    return {'p50_ms': round(ordered[len(ordered)//2]*1000, 1), 'p95_ms': round(ordered[int(len(ordered)*0.95)]*1000, 1),
+            'max_ms': round(ordered[-1]*1000, 1)}
+
+
+def get_jobs_stats():
+    """ queue depth and the counters and timings of this worker """
+    if current_app.config["JOBS_PERSIST"]:
+        ensure_jobs_table()
+        depth = {row['Status']: row['Jobs'] for row in get_sqlite_db().execute("SELECT Status, count(*) AS Jobs FROM Jobs GROUP BY Status;")}
+    else:
+        with _state_lock:
+            depth = {'pending': len(_memory_queue)}
+    with _state_lock:
+        return {'pid': os.getpid(), 'persist': current_app.config["JOBS_PERSIST"], 'workers': current_app.config["JOBS_WORKERS"],
+                'running_here': _running, 'depth': {status: depth.get(status, 0) for status in ('pending', 'running', 'failed')},
+                'counters': dict(_stats), 'latency': summarize(_latencies), 'duration': summarize(_durations)}
+
+
+def init_app(app):
+    @app.before_request
+    def start_jobs():
+        # persisted jobs of an earlier run are picked up without waiting for the next submit
+        if app.config["JOBS_PERSIST"] and _pid != os.getpid():
+            start_dispatcher(app)
+
+    @app.route("/jobs/stats")
+    def jobs_stats():
+        return jsonify(get_jobs_stats())
+
+    @app.cli.command("jobs-drain")
+    @click.option("--timeout", type=int, default=600, show_default=True)
+    def jobs_drain_command(timeout):
+        """ Run the queued jobs in the foreground until none is due. """
+        start_dispatcher(app)
+        finished = drain(timeout)
+        click.echo(json.dumps(get_jobs_stats(), indent=2))
+        if not finished:
+            raise click.ClickException("jobs still running at the timeout")
+
+    @app.cli.command("jobs-submit")
+    @click.argument("name")
+    @click.argument("args", default="{}")
+    def jobs_submit_command(name, args):
+        """ Queue job NAME with the keyword arguments given as JSON object, e.g. todos.cleanup_uploads. """
+        click.echo(f"job {submit(name, **json.loads(args))} queued")
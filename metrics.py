@@ -0,0 +1,225 @@
+""" request, template and backend timings of this worker process, published in Prometheus text format at /metrics """
+import os
+import sys
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+from flask import request, Response, signals, has_request_context
+
+# backend calls are timed by sqlite_db (@timed), by the MongoDB CommandListener of mongo_monitoring
+# and by a response hook on the HTTP session of gspread; each call is counted for the request running
+# on the same thread as well, so the number of queries a page makes (N+1 patterns) shows up per route
+
+# upper bounds of the buckets of the per-request call counts
+CALL_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+
+class Histogram:
+    """ cumulative histogram with one series per tuple of label values """
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, values:tuple, amount):
+        index = bisect_left(self.buckets, amount)
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                # counts per bucket (the last one is +Inf), sum, count
+                series = self.series[values] = [[0] * (len(self.buckets)+1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += amount
+            series[2] += 1
+
+    def expose(self):
+        """ lines of the Prometheus text format """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {values: (list(counts), total, count) for values, (counts, total, count) in self.series.items()}
+        for values, (counts, total, count) in sorted(series.items()):
+            labels = format_labels(zip(self.labels, values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f"{self.name}_bucket{{{labels}{',' if labels else ''}le=\"{le}\"}} {cumulative}")
+            lines.append(f"{self.name}_sum{{{labels}}} {total!r}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+def format_labels(pairs):
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in pairs)
+
+
+def format_metric(name, help, kind, samples):
+    """ lines of a counter or gauge, <samples> is a list of (label pairs, value) """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for pairs, value in samples:
+        labels = format_labels(pairs)
+        lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    return lines
+
+
+# Recording
+#===========
+# the histograms are created by init_app(), until then and with METRICS=False nothing is recorded
+_requests = None
+_request_calls = None
+_backend_calls = None
+_templates = None
+# requests taking longer are printed with their backend calls, 0 switches it off
+_slow_request_ms = 0
+# backend calls and template timings of the request served by the current thread
+_local = threading.local()
+
+
+def observe_backend(backend, operation, seconds):
+    """ record one call to <backend>, e.g. ('sqlite', 'query_db', 0.0004) """
+    if _backend_calls is None:
+        return
+    _backend_calls.observe((backend, operation), seconds)
+    calls = getattr(_local, 'calls', None)
+    if calls is not None:
+        entry = calls.setdefault(backend, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+
+def timed(backend, operation=None):
+    """ decorator timing every call of the function as a call to <backend> """
+    def decorate(function):
+        name = operation or function.__name__
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe_backend(backend, name, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+def requests_hook(backend):
+    """ response hook of a requests.Session timing every HTTP call, e.g. the ones of gspread """
+    def hook(response, *args, **kwargs):
+        # ".../values:batchGet" -> batchGet, ".../values/stock!A5:F" -> get
+        path = response.request.path_url.split('?')[0].rsplit('/', 1)[-1]
+        operation = path.rsplit(':', 1)[-1] if ':' in path and '!' not in path else response.request.method.lower()
+        observe_backend(backend, operation, response.elapsed.total_seconds())
+    return hook
+
+
+def current_route():
+    # the rule and not the path, so the number of series stays bounded
+    if not has_request_context():
+        return 'none'
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def before_render(sender, template, context, **extra):
+    if _templates is not None:
+        _local.__dict__.setdefault('renders', []).append(time.perf_counter())
+
+
+def after_render(sender, template, context, **extra):
+    renders = getattr(_local, 'renders', None)
+    if _templates is not None and renders:
+        seconds = time.perf_counter() - renders.pop()
+        _templates.observe((current_route(), template.name or 'string'), seconds)
+        # nested renders are counted in their parent too
+        if not renders:
+            calls = getattr(_local, 'calls', None)
+            if calls is not None:
+                entry = calls.setdefault('template', [0, 0.0])
+                entry[0] += 1
+                entry[1] += seconds
+
+
+def start_request():
+    _local.started = time.perf_counter()
+    _local.calls = {}
+    _local.renders = []
+
+
+def finish_request(response):
+    started = getattr(_local, 'started', None)
+    calls = getattr(_local, 'calls', None)
+    _local.started = _local.calls = None
+    if started is None or calls is None:
+        return response
+    # streamed bodies, e.g. of the exports, are still to be sent: the time until the headers is recorded
+    seconds = time.perf_counter() - started
+    route = current_route()
+    _requests.observe((request.method, route, str(response.status_code)), seconds)
+    for backend, (count, _) in calls.items():
+        if backend != 'template':
+            _request_calls.observe((route, backend), count)
+    if _slow_request_ms and seconds * 1000 >= _slow_request_ms:
+        breakdown = ', '.join(f"{backend} {count} call(s) {total*1000:.1f} ms" for backend, (count, total) in sorted(calls.items()))
+        print(f"Slow request {request.method} {request.full_path.rstrip('?')} {response.status_code} {seconds*1000:.1f} ms: {breakdown or 'no backend calls'}")
+    return response
+
+
+def reset_metrics():
+    """ drop the series inherited from the parent process, e.g. after fork() """
+    for histogram in (_requests, _request_calls, _backend_calls, _templates):
+        if histogram is not None:
+            with histogram.lock:
+                histogram.series.clear()
+    _local.__dict__.clear()
+
+
+# Publishing
+#============
+def expose_metrics():
+    """ all metrics of this worker in the Prometheus text format """
+    lines = format_metric("process_pid", "Process id of the worker serving the scrape, the metrics are per worker", "gauge",
+                          [((), os.getpid())])
+    for histogram in (_requests, _request_calls, _backend_calls, _templates):
+        lines += histogram.expose()
+    # the modules of features which are not enabled were never imported
+    if 'fragment_cache' in sys.modules:
+        stats = sys.modules['fragment_cache'].get_fragment_stats()
+        lines += format_metric("fragment_cache_lookups_total", "Fragment cache lookups by outcome", "counter",
+                               [((('fragment', name), ('outcome', outcome)), value)
+                                for name, counters in sorted(stats.items()) for outcome, value in counters.items()])
+    if 'jobs' in sys.modules:
+        stats = sys.modules['jobs'].get_jobs_stats()
+        lines += format_metric("jobs_queue_depth", "Background jobs in the queue by status", "gauge",
+                               [((('status', status),), value) for status, value in stats['depth'].items()])
+        lines += format_metric("jobs_total", "Background job runs of this worker by outcome", "counter",
+                               [((('outcome', outcome),), value) for outcome, value in stats['counters'].items()])
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    global _requests, _request_calls, _backend_calls, _templates, _slow_request_ms
+    if not app.config["METRICS"]:
+        return
+    buckets = app.config["METRICS_BUCKETS"]
+    _requests = Histogram("http_request_duration_seconds", "Time until the response headers, per route", ('method', 'route', 'status'), buckets)
+    _request_calls = Histogram("http_request_backend_calls", "Backend calls made by one request, per route", ('route', 'backend'), CALL_BUCKETS)
+    _backend_calls = Histogram("backend_call_duration_seconds", "Duration of the SQLite, MongoDB and Google Sheets calls", ('backend', 'operation'), buckets)
+    _templates = Histogram("template_render_duration_seconds", "Jinja2 render time per route and template", ('route', 'template'), buckets)
+    _slow_request_ms = app.config["METRICS_SLOW_REQUEST_MS"]
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    # template signals need blinker
+    if signals.signals_available:
+        signals.before_render_template.connect(before_render, app, weak=False)
+        signals.template_rendered.connect(after_render, app, weak=False)
+    else:
+        print("Template render times are not recorded: pip install blinker")
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(expose_metrics(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,87 @@
+""" MongoDB driver event listeners, imported together with pymongo on first use """
+import threading
+import time
+
+import pymongo
+
+from metrics import observe_backend
+
+
+# inspired by https://pymongo.readthedocs.io/en/stable/api/pymongo/monitoring.html
+class MongoPoolStats(pymongo.monitoring.ConnectionPoolListener):
+    """ count connection pool events of this worker process """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.counters = dict.fromkeys(('connections_created', 'connections_closed',
+                                       'checkouts_started', 'checkouts', 'checkouts_failed', 'checkins',
+                                       'waits', 'pool_clears'), 0)
+        self.wait_ms_total = 0.0
+        self.wait_ms_max   = 0.0
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count('pool_clears')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count('connections_created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count('connections_closed')
+
+    def connection_check_out_started(self, event):
+        # check-out events of one request are published on the same thread
+        self._local.started = time.perf_counter()
+        self._count('checkouts_started')
+
+    def connection_check_out_failed(self, event):
+        self._count('checkouts_failed')
+
+    def connection_checked_out(self, event):
+        wait_ms = (time.perf_counter() - getattr(self._local, 'started', time.perf_counter())) * 1000
+        with self._lock:
+            self.counters['checkouts'] += 1
+            # a check-out which could not be served by an idle socket at once counts as a wait
+            if wait_ms >= 1:
+                self.counters['waits'] += 1
+            self.wait_ms_total += wait_ms
+            self.wait_ms_max = max(self.wait_ms_max, wait_ms)
+
+    def connection_checked_in(self, event):
+        self._count('checkins')
+
+    def snapshot(self):
+        """ return the counters and the derived gauges as a dict """
+        with self._lock:
+            stats = dict(self.counters)
+            stats['wait_ms_total'] = round(self.wait_ms_total, 3)
+            stats['wait_ms_max']   = round(self.wait_ms_max, 3)
+        stats['sockets_open']   = stats['connections_created'] - stats['connections_closed']
+        stats['sockets_in_use'] = stats['checkouts'] - stats['checkins']
+        stats['waiting']        = stats['checkouts_started'] - stats['checkouts'] - stats['checkouts_failed']
+        return stats
+
+
+class MongoCommandTimer(pymongo.monitoring.CommandListener):
+    """ time every command as a MongoDB call of the current request, see metrics.py """
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        # the events of an operation are published on the thread which runs it
+        observe_backend('mongo', event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        observe_backend('mongo', event.command_name, event.duration_micros / 1e6)
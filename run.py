@@ -1,508 +1,276 @@
-import os
-from flask import Flask, render_template, g, request, redirect, flash, send_from_directory, send_file
-from werkzeug.utils import secure_filename
-import time
-
-# Support for mongodb+srv:// URIs requires dnspython:
-#!pip install dnspython pymongo
-import pymongo
-from bson.objectid import ObjectId
-from bson.binary import Binary
-from io import BytesIO
-import json
-from datetime import date, datetime
-from math import floor
-from itertools import zip_longest
-
-# Support for Google Drive and Google Sheets API
-#!pip install gspread google-auth
-from google.oauth2.service_account import Credentials
-import gspread
-
-# env.py should exist only in Development
-if os.path.exists("env.py"):
-    import env
-
-
-app = Flask(__name__)
-
-# take app configuration from OS environment variables
-app.secret_key               = os.environ.get("FLASK_SECRET_KEY")            # => Heroku Congig Vars
-app.config["FLASK_IP"]       = os.environ.get("FLASK_IP",      "0.0.0.0")
-# the source 'PORT' name is mandated by Heroku app deployment
-app.config["FLASK_PORT"]     = int(os.environ.get("PORT"))
-app.config["FLASK_DEBUG"]    = os.environ.get("FLASK_DEBUG",   "False").lower() in {'1','true','t','yes','y'}
-app.config["UPLOAD_FOLDER"]  = os.environ.get("UPLOAD_FOLDER", "./data/")
-app.config["UPLOAD_EXTENSIONS"] = set(['png', 'jpg', 'jpeg', 'gif'])
-# SQLite parameters
-app.config["SQLITE_INIT"]    = os.environ.get("SQLITE_INIT",   "False").lower() in {'1','true','t','yes','y'}# => Heroku Congig Vars
-app.config["SQLITE_DB"]      = os.environ.get("SQLITE_DB",     "./data/taskmaster.sqlite") 
-app.config["SQLITE_SCHEMA"]  = os.environ.get("SQLITE_SCHEMA", "./data/sqlite_schema.sql")
-app.config["SQLITE_CONTENT"] = os.environ.get("SQLITE_CONTENT","./data/sqlite_content.sql")
-app.config["SQLITE_TABLE_TODOS"] = "Todos"
-app.config["COLUMNS_TODOS"]  = ('TaskId','Content','Completed','SourceFileName','LocalFileName','DatTimIns', 'DatTimUpd')
-# MongoDB parameters
-app.config["MONGO_INIT"]       = os.environ.get("MONGO_INIT",   "False").lower() in {'1','true','t','yes','y'}# => Heroku Congig Vars
-app.config["MONGO_CONTENT"]    = os.environ.get("MONGO_CONTENT","./data/mongo_content.json")
-app.config["MONGO_DB_NAME"]    = os.environ.get("MONGO_DB_NAME")
-app.config["MONGO_CLUSTER"]    = os.environ.get("MONGO_CLUSTER")
-app.config["MONGO_COLLECTION_CELEBS"] = 'celebrities'
-app.config["MONGO_URI"] = f"mongodb+srv:" + \
-                          f"//{os.environ.get('MONGO_DB_USER')}" + \
-                          f":{os.environ.get('MONGO_DB_PASS')}" + \
-                          f"@{app.config['MONGO_CLUSTER']}" + \
-                          f".ueffo.mongodb.net" + \
-                          f"/{app.config['MONGO_DB_NAME']}" + \
-                          f"?retryWrites=true&w=majority"
-# Google Sheets parameters
-app.config["GSHEETS_SCOPE"] = [
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive.file",
-    "https://www.googleapis.com/auth/drive"
-    ]
-
-app.config["GSHEETS_CREDITS"] = json.loads(os.environ.get("GSHEETS_CREDITS"))
-app.config["GSHEETS_SHEETS"]  = "Python CodeInstitute-love_sandwiches"
-app.config["GSHEETS_PAGE"] = {
-        "title":"Opening Stock - Sold = Surplus sandwiches on market days",
-        "columns":['sale'+str(i) for i in range(6)]
-}
-app.config["GSHEETS_SALES_LOOKBACK"] = 5
-app.config["GSHEETS_SALES_MARKUP"] = 1.1
-
-# SQLite3 DB helpers
-#=====================
-import sqlite3
-# SQLite pattern from https://flask.palletsprojects.com/en/1.1.x/patterns/sqlite3/
-def get_sqlite_db():
-    db = getattr(g, '_database_sqlite', None)
-    if db is None:
-        db = g._database_sqlite = sqlite3.connect(app.config["SQLITE_DB"])
-        # use built-in row translator
-        db.row_factory = sqlite3.Row
-    return db
-
-
-# inspired by SQLite pattern from https://flask.palletsprojects.com/en/1.1.x/patterns/sqlite3/
-def init_sqlite_db(load_content=False):
-    with app.app_context():
-        db = get_sqlite_db()
-        with app.open_resource(app.config["SQLITE_SCHEMA"], mode='r') as f:
-            db.cursor().executescript(f.read())
-        with app.open_resource(app.config["SQLITE_CONTENT"], mode='r') as f:
-            db.cursor().executescript(f.read())
-        db.commit()
-
-
-# inspired by SQLite pattern from https://flask.palletsprojects.com/en/1.1.x/patterns/sqlite3/        
-def query_db(query, args=(), one=False):
-    cur = get_sqlite_db().execute(query, args)
-    rv = cur.fetchone() if one else cur.fetchall()
-    cur.close()
-    return (rv[0] if type(rv)==list else rv) if one else rv
-
-
-# inspired by Example 1 from https://www.programcreek.com/python/example/3926/sqlite3.Row
-def create_row(columns, values):
-    """ convert column names and corresponding values into sqlite3.Row type object """
-    cur = get_sqlite_db().cursor()
-    if not cur:
-        return None
-    # generate "? AS <column>, ..."
-    col_list = ", ".join([f"? AS '{col}'" for col in columns])
-    query=f"SELECT {col_list};"
-    return cur.execute(query, values).fetchone()
-
-
-def insert_row(table:str, row:sqlite3.Row):
-    """ insert one row into given table """
-    cur = get_sqlite_db().cursor()
-    if not cur:
-        return 0
-    try:
-        columns = row.keys()
-        values  = tuple(row[key] for key in columns)
-        # generate list of column names
-        col_list = ",".join(columns)
-        # generate list of question marks
-        qmark_list = ','.join('?'*len(columns))
-        query=f"INSERT INTO {table} ({col_list}) VALUES ({qmark_list});"
-        cur.execute(query, values)
-        cur.connection.commit()
-        return cur.lastrowid
-    except sqlite3.Error as error:
-        cur.connection.rollback()
-        return error
- 
-
-def delete_row(table:str, id:int):
-    """ delete one row by <rowid> from given table """
-    cur = get_sqlite_db().cursor()
-    if not cur:
-        return ""
-    try:
-        query=f"DELETE FROM {table} WHERE rowid=?;"
-        cur.execute(query, (id,))
-        cur.connection.commit()
-        return cur.rowcount
-    except sqlite3.Error as error:
-        cur.connection.rollback()
-        return error
-
-
-def update_row(table:str, row:sqlite3.Row, id:int):
-    """ update one row by <rowid> from given table """
-    cur = get_sqlite_db().cursor()
-    if not cur:
-        return ""
-    try:
-        columns = row.keys()
-        values  = tuple([row[column] for column in columns]+[id])
-        # generate "<column>=?,..." list
-        set_list = ",".join([column+"=? " for column in columns])
-        cur.execute(f"UPDATE {table} SET {set_list} WHERE rowid=?;", values)
-        cur.connection.commit()
-        return cur.rowcount
-    except sqlite3.Error as error:
-        cur.connection.rollback()
-        return error
-
-# inspired by https://stackoverflow.com/questions/4830535/how-do-i-format-a-date-in-jinja2
-@app.template_filter('unix_time_ago')
-def _jinja2_filter_time_ago(unix_timestamp:int):
-    time_formats = (
-        (60, 'seconds', 1),                           # 60
-        (120, '1 minute ago', '1 minute from now'),   # 60*2
-        (3600, 'minutes', 60),                        # 60*60, 60
-        (7200, '1 hour ago', '1 hour from now'),      # 60*60*2
-        (86400, 'hours', 3600),                       # 60*60*24, 60*60
-        (172800, 'Yesterday', 'Tomorrow'),            # 60*60*24*2
-        (604800, 'days', 86400),                      # 60*60*24*7, 60*60*24
-        (1209600, 'Last week', 'Next week'),          # 60*60*24*7*4*2
-        (2419200, 'weeks', 604800),                   # 60*60*24*7*4, 60*60*24*7
-        (4838400, 'Last month', 'Next month'),        # 60*60*24*7*4*2
-        (29030400, 'months', 2419200),                # 60*60*24*7*4*12, 60*60*24*7*4
-        (58060800, 'Last year', 'Next year'),         # 60*60*24*7*4*12*2
-        (2903040000, 'years', 29030400),              # 60*60*24*7*4*12*100, 60*60*24*7*4*12
-        (5806080000, 'Last century', 'Next century'), # 60*60*24*7*4*12*100*2
-        (58060800000, 'centuries', 2903040000)        # 60*60*24*7*4*12*100*20, 60*60*24*7*4*12*100
-    )
-    seconds = datetime.utcnow().timestamp() - unix_timestamp
-    if 0 <= seconds < 1:
-        return 'Just now'
-    if seconds < 0 :
-        seconds = abs(seconds)
-        token = 'from now'
-        list_choice = 2
-    else:
-        token = 'ago'
-        list_choice = 1
-
-    for format in time_formats:
-        if seconds < format[0]:
-            if type(format[2]) == str:
-                return format[list_choice]
-            else:
-                return f"{floor(seconds / format[2])} {format[1]} {token}"
-    return time
-
-
-# App routing
-#==============
-@app.route("/")  # trigger point through webserver: "/"= root directory
-def index():
-    return render_template("index.html", page_title="Home")
-
-
-@app.route("/about")
-def about():
-    return render_template("about.html", page_title="About")
-
-
-@app.route("/todos", methods=['GET','POST'])
-def todos():
-    if request.method == 'POST':
-        task = save_task_to_db(request, None)
-    else:
-        # create an empty task
-        task = {}
-    # get all tasks from DB
-    tasks = query_db(f"SELECT * FROM {app.config['SQLITE_TABLE_TODOS']} ORDER BY Completed;")
-    if not tasks:
-        flash("There are no tasks. Create one above!")
-    return render_template("todos.html", page_title="Task Master", request_path=request.path, tasks=tasks, last_task=task)
-
-
-@app.route("/todos/update/<int:task_id>", methods=['GET','POST'])
-def update_task(task_id):
-    task = query_db(f"SELECT * FROM {app.config['SQLITE_TABLE_TODOS']} WHERE rowid=?;", (task_id,), one=True)
-    if task is None:
-        flash(f"Task {task_id} does not exist")
-        return redirect("/todos")
-
-    if request.method == 'POST':
-        task = save_task_to_db(request, task)
-        return redirect("/todos")
-
-    tasks = query_db(f"SELECT * FROM {app.config['SQLITE_TABLE_TODOS']} ORDER BY Completed;")
-    return render_template("todos.html", page_title="Task Master", tasks=tasks, last_task=task)
-
-
-def save_task_to_db(request, task_old):
-    columns = ['Content','Completed']
-    values  = [request.form.get(column,'') for column in columns]
-    # checkbox value conversion to integer
-    values[1] = 1 if values[1]=="on" else 0
-
-    # following instructions from https://flask.palletsprojects.com/en/1.1.x/patterns/fileuploads/
-    data = request.files['SourceFileName']
-    if data:
-        filename_source = secure_filename(data.filename)
-        extension = filename_source.rsplit('.', 1)[1] if '.' in filename_source else ''
-        if extension in app.config["UPLOAD_EXTENSIONS"]:
-            # generate a new image file name
-            filename_local = str(time.time()).replace('.','')+'.'+extension
-            columns += ['SourceFileName','LocalFileName']
-            values  += [filename_source, filename_local]
-
-    task_new = create_row(columns, values)
-    if task_old:
-        row_id = update_row(app.config["SQLITE_TABLE_TODOS"], task_new, task_old['TaskId'])
-    else:
-        row_id = insert_row(app.config["SQLITE_TABLE_TODOS"], task_new)
-    # update was successful
-    if type(row_id) == int:
-        # save new file
-        if data:
-            data.save(os.path.join(app.config["UPLOAD_FOLDER"], filename_local))
-            # delete old file
-            if task_old and task_old['LocalFileName']:
-                try:
-                    os.remove(os.path.join(app.config["UPLOAD_FOLDER"], task_old['LocalFileName']))
-                except FileNotFoundError as error:
-                    flash(f"Could not delete {task_old['SourceFileName']}: {error}")
-
-        # create empty task - this will be displayed, because the update was OK
-        task_new = {}
-        flash(f"One record successfully {'updated' if task_old else 'added'}")
-    else:
-        flash(f"Error in {'update' if task_old else 'insert'} operation: {row_id}")
-    return task_new
-
-
-@app.route("/todos/delete/<int:task_id>")
-def delete_task(task_id):
-    task = query_db(f"SELECT SourceFileName, LocalFileName FROM {app.config['SQLITE_TABLE_TODOS']} WHERE TaskId=?;", (task_id,), one=True)
-    if task is None:
-        flash(f"Task {task_id} does not exist")
-    else:
-        result = delete_row(app.config['SQLITE_TABLE_TODOS'], task_id)
-        if type(result) == int:
-            filename_local = task['LocalFileName']
-            if filename_local:
-                try:
-                    os.remove(os.path.join(app.config["UPLOAD_FOLDER"], filename_local))
-                except FileNotFoundError as error:
-                    flash(f"Could not delete {task['SourceFileName']}: {error}")
-            flash(f"{result} Record deleted")
-        else:
-            flash(f"Error in delete operation: {result}")
-    return redirect('/todos')
-
-
-@app.route("/uploads/<filename_local>")
-def uploads(filename_local):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename_local)
-
-
-@app.route("/contact", methods=['GET','POST'])
-def contact():
-    if request.method == 'POST':
-        flash(f"Thanks {request.form.get('name')}, we have received your message!")
-    return render_template("contact.html", page_title="Contact")
-
-
-# MongoDB helpers
-#=================
-def get_mongo_coll(collection):
-    conn = getattr(g, '_database_mongo', None)
-    if conn is None:
-        try:
-            conn = g._database_mongo = pymongo.MongoClient(app.config["MONGO_URI"])
-        except pymongo.errors.ConnectionFailure as e:
-            print(f"Could not connect to MongoDB {app.config['MONGO_DB_NAME']}: {e}")
-            return None
-    return conn[app.config["MONGO_DB_NAME"]][collection]
-
-
-def init_mongo_db(load_content=False):
-    with app.app_context():
-        with app.open_resource(app.config["MONGO_CONTENT"], mode='r') as f:
-            collections = json.loads(f.read())
-            for coll_name,coll_docs in collections.items():
-                coll = get_mongo_coll(coll_name)
-                coll.delete_many({})
-                coll.insert_many(coll_docs)
- 
-
-def save_celeb_to_db(request, celeb_old):
-    columns = ('first','last','dob','gender','hair_color','occupation','nationality')
-    celeb_new  = {column:request.form.get(column,'') for column in columns if request.form.get(column,'') != celeb_old.get(column,'')}
-    # following instructions from https://flask.palletsprojects.com/en/1.1.x/patterns/fileuploads/
-    data = request.files['SourceFileName']
-    if data:
-        filename_source = secure_filename(data.filename)
-        extension = filename_source.rsplit('.', 1)[1] if '.' in filename_source else ''
-        if extension in app.config["UPLOAD_EXTENSIONS"]:
-            # print(data)
-            # store image
-            celeb_new['Image'] = Binary(data.read())
-    coll = get_mongo_coll(app.config["MONGO_COLLECTION_CELEBS"])
-    try:
-        if celeb_old:
-            coll.update_one({'_id':celeb_old['_id']}, {"$set":celeb_new})
-        else:
-            coll.insert_one(celeb_new)
-        # create empty celeb - clear the input fields, because the update was OK
-        celeb_new = {}
-        flash(f"One document successfully {'updated' if celeb_old else 'added'}")
-    except:
-        flash(f"Error in {'update' if celeb_old else 'insert'} operation!")
-    return celeb_new
-
-# inspired by https://stackoverflow.com/questions/4830535/how-do-i-format-a-date-in-jinja2
-@app.template_filter('isodate_to_str')
-def _jinja2_filter_isodate_to_str(isodatestr, format):
-    if isodatestr:
-        return date.fromisoformat(isodatestr).strftime(format)
-    else:
-        return str()
-
-
-# MongoDB routes
-#=================
-@app.route("/celebs", methods=['GET','POST'])
-def celebs():
-    if request.method == 'POST':
-        celeb = save_celeb_to_db(request, {})
-    else:
-        celeb = {}
-    coll = get_mongo_coll(app.config["MONGO_COLLECTION_CELEBS"])
-    celebs = coll.find()
-    return render_template("celebs.html", page_title="Celebrities", celebs=celebs, last_celeb=celeb)
-
-
-@app.route("/celebs/update/<celeb_id>", methods=['GET','POST'])
-def update_celeb(celeb_id):
-    coll = get_mongo_coll(app.config["MONGO_COLLECTION_CELEBS"])
-    celeb = coll.find_one({"_id":ObjectId(celeb_id)})
-    if not celeb:
-        flash(f"Document {celeb_id} does not exist")
-        return redirect("/celebs")
-
-    if request.method == 'POST':
-        celeb = save_celeb_to_db(request, celeb)
-        return redirect("/celebs")
-
-    celebs = coll.find()
-    return render_template("celebs.html", page_title="Celebrities", celebs=celebs, last_celeb=celeb)
-
-
-@app.route("/celebs/delete/<celeb_id>")
-def delete_celeb(celeb_id):
-    coll = get_mongo_coll(app.config["MONGO_COLLECTION_CELEBS"])
-    celeb = coll.find_one({"_id":ObjectId(celeb_id)})
-    if not celeb:
-        flash(f"Document {celeb_id} does not exist")
-        return redirect("/celebs")
-    coll.delete_one({"_id":celeb["_id"]})
-    celebs = coll.find()
-    return render_template("celebs.html", page_title="Celebrities", celebs=celebs, last_celeb={})
-
-
-@app.route("/celebs/image/<celeb_id>")
-def image_celeb(celeb_id):
-    coll = get_mongo_coll(app.config["MONGO_COLLECTION_CELEBS"])
-    celeb = coll.find_one({"_id":ObjectId(celeb_id)})
-    if celeb and celeb['Image']:
-        return send_file(BytesIO(celeb['Image']), mimetype='application/octet-stream')
-
-# Google Sheets helpers
-#=======================
-def get_gsheet(sheet):
-    sheets = getattr(g, '_database_gsheets', None)
-    if sheets is None:
-        try:
-            CREDS = Credentials.from_service_account_info(app.config["GSHEETS_CREDITS"])
-            SCOPED_CREDS = CREDS.with_scopes(app.config["GSHEETS_SCOPE"])
-            GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
-            sheets = GSPREAD_CLIENT.open(app.config["GSHEETS_SHEETS"])
-        except:
-            print(f"Could not connect to Google Sheets {app.config['GSHEETS_SHEETS']}")
-            return None
-    return sheets.worksheet(sheet)
-
-
-def save_formdata_to_sheet(request, sheet, page):
-    row  = [int(request.form.get(column,0)) for column in page['columns']]
-    try:
-        gsheet = get_gsheet(sheet)
-        gsheet.append_row(row)
-        flash(f"One row successfully added to {sheet}")
-    except:
-        flash(f"Error in append operation!")
-
-
-# GoogleSheets routes
-#=====================
-@app.route("/sandwiches", methods=['GET','POST'])
-def sandwiches():
-    SHEET_SALES = 'sales'
-    SHEET_STOCK = 'stock'
-    if request.method == 'POST':
-        save_formdata_to_sheet(request, request.form['submit'], app.config['GSHEETS_PAGE'])
-        # stock_data = get_gsheet(SHEET_STOCK).get_all_values()
-        # stock_row = stock_data[-1]
-        # surplus_row = [int(stock)-sales for stock,sales in zip(stock_row,sales_row)]
-        # print(surplus_row)
-
-    stock_data = get_gsheet(SHEET_STOCK).get_all_values()
-    sales_data = get_gsheet(SHEET_SALES).get_all_values()
-    surplus_data = [[int(st)-int(sl) for st,sl in zip(stock,sales)] if i>0 else stock for i,(stock,sales) in enumerate(zip(stock_data,sales_data))]
-    lookback = app.config["GSHEETS_SALES_LOOKBACK"]
-    sales_lookback = [ [int(sales_data[row][col]) for row in range(-lookback, 0) ] for col in range(len(app.config["GSHEETS_PAGE"]["columns"]))]
-    stock_suggest = [round(sum(col)/lookback*app.config["GSHEETS_SALES_MARKUP"]) for col in sales_lookback]
-    return render_template("sandwiches.html", 
-                            page_title="Love Sandwiches",
-                            page_subtitle=app.config["GSHEETS_PAGE"]["title"],
-                            request_path=request.path,
-                            columns=app.config["GSHEETS_PAGE"]["columns"], 
-                            data=zip_longest(stock_data,sales_data,surplus_data, fillvalue=[]),
-                            suggest=stock_suggest
-                        )
-
-
-# Flask pattern from https://flask.palletsprojects.com/en/1.1.x/patterns/sqlite3/
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, '_database_sqlite', None)
-    if db is not None:
-        db.close()
-
-    db = getattr(g, '_database_mongo', None)
-    if db is not None:
-        db.close()
-
-# Run the App
-#=================
-if __name__ == "__main__":
-    if app.config["SQLITE_INIT"]:
-        init_sqlite_db()
-
-    if app.config["MONGO_INIT"]:
-        init_mongo_db()
-
-    app.run(
-        host  = app.config["FLASK_IP"],
-        port  = app.config["FLASK_PORT"],
-        debug = app.config["FLASK_DEBUG"])
\ No newline at end of file
+import os
+import sys
+import importlib
+import click
+from flask import Flask, render_template, request, flash
+
+import sqlite_db
+import fragment_cache
+import jobs
+import metrics
+import http_cache
+# imports numpy only when the first page view computes a forecast
+from sandwiches_analytics import FORECAST_METHODS
+
+# every feature is a blueprint in the module of the same name, imported only when enabled
+FEATURES = ('todos', 'celebs', 'sandwiches')
+
+# env.py should exist only in Development
+if os.path.exists("env.py"):
+    import env
+
+
+def load_config(app):
+    # take app configuration from OS environment variables
+    # comma separated subset of FEATURES, e.g. "todos" for a worker which serves only the task list
+    app.config["APP_FEATURES"]   = [feature.strip() for feature in os.environ.get("APP_FEATURES", ",".join(FEATURES)).split(',') if feature.strip()]
+    app.secret_key               = os.environ.get("FLASK_SECRET_KEY")            # => Heroku Congig Vars
+    app.config["FLASK_IP"]       = os.environ.get("FLASK_IP",      "0.0.0.0")
+    # the source 'PORT' name is mandated by Heroku app deployment
+    app.config["FLASK_PORT"]     = int(os.environ.get("PORT", "5000"))
+    app.config["FLASK_DEBUG"]    = os.environ.get("FLASK_DEBUG",   "False").lower() in {'1','true','t','yes','y'}
+    app.config["UPLOAD_FOLDER"]  = os.environ.get("UPLOAD_FOLDER", "./data/")
+    app.config["UPLOAD_EXTENSIONS"] = set(['png', 'jpg', 'jpeg', 'gif'])
+    # bounding box of the thumbnails shown in the task list, e.g. "200x200"
+    app.config["THUMBNAIL_SIZE"] = tuple(int(px) for px in os.environ.get("THUMBNAIL_SIZE", "200x200").split('x'))
+    # rendered tables of the list pages: "sqlite" shares them between the workers of a host, "memory" keeps them
+    # per process, "none" switches the cache off, "<module>:<factory>" plugs in another backend
+    app.config["FRAGMENT_CACHE_BACKEND"] = os.environ.get("FRAGMENT_CACHE_BACKEND", "sqlite")
+    app.config["FRAGMENT_CACHE_DB"]      = os.environ.get("FRAGMENT_CACHE_DB", "./data/fragments.sqlite")
+    app.config["FRAGMENT_CACHE_TTL"]     = int(os.environ.get("FRAGMENT_CACHE_TTL", "300"))
+    app.config["FRAGMENT_CACHE_SIZE"]    = int(os.environ.get("FRAGMENT_CACHE_SIZE", "1024"))  # fragments of the memory backend
+    # uploads are spooled here by the request and moved into UPLOAD_FOLDER by a background job
+    app.config["UPLOAD_INCOMING"] = os.environ.get("UPLOAD_INCOMING", os.path.join(app.config["UPLOAD_FOLDER"], "incoming"))
+    # background jobs (jobs.py): file writes and deletes, thumbnails, GridFS uploads and Sheets appends
+    app.config["JOBS_WORKERS"]  = int(os.environ.get("JOBS_WORKERS", "2"))  # threads per worker process
+    # keep the queue in the SQLite database, so jobs survive a restart and any worker process can run them
+    app.config["JOBS_PERSIST"]  = os.environ.get("JOBS_PERSIST", "True").lower() in {'1','true','t','yes','y'}
+    app.config["JOBS_MAX_ATTEMPTS"] = int(os.environ.get("JOBS_MAX_ATTEMPTS", "5"))
+    app.config["JOBS_BACKOFF"]      = float(os.environ.get("JOBS_BACKOFF", "2"))      # seconds before the first retry, doubled by each
+    app.config["JOBS_BACKOFF_MAX"]  = float(os.environ.get("JOBS_BACKOFF_MAX", "300"))
+    # seconds after which a job claimed by a worker which did not finish it is run again
+    app.config["JOBS_LEASE"]        = int(os.environ.get("JOBS_LEASE", "300"))
+    app.config["JOBS_POLL_INTERVAL"] = float(os.environ.get("JOBS_POLL_INTERVAL", "5"))
+    # orphaned uploads and images are looked for every JOBS_CLEANUP_INTERVAL seconds, 0 switches it off,
+    # and deleted when older than JOBS_ORPHAN_AGE seconds
+    app.config["JOBS_CLEANUP_INTERVAL"] = int(os.environ.get("JOBS_CLEANUP_INTERVAL", "3600"))
+    app.config["JOBS_ORPHAN_AGE"]       = int(os.environ.get("JOBS_ORPHAN_AGE", "3600"))
+    # static URLs carry ?v=<content hash> and are cached by the browsers for a year
+    app.config["STATIC_FINGERPRINT"] = os.environ.get("STATIC_FINGERPRINT", "True").lower() in {'1','true','t','yes','y'}
+    # gzip (or brotli, if installed) for the text responses of at least COMPRESS_MIN_SIZE bytes
+    app.config["COMPRESS"]           = os.environ.get("COMPRESS", "True").lower() in {'1','true','t','yes','y'}
+    app.config["COMPRESS_BROTLI"]    = os.environ.get("COMPRESS_BROTLI", "True").lower() in {'1','true','t','yes','y'}
+    app.config["COMPRESS_LEVEL"]     = int(os.environ.get("COMPRESS_LEVEL", "6"))
+    app.config["COMPRESS_MIN_SIZE"]  = int(os.environ.get("COMPRESS_MIN_SIZE", "500"))
+    app.config["COMPRESS_MIMETYPES"] = {'text/html', 'text/css', 'text/plain', 'application/json'}
+    # request, template and backend timings at /metrics, per worker process
+    app.config["METRICS"]         = os.environ.get("METRICS", "True").lower() in {'1','true','t','yes','y'}
+    # upper bounds in seconds of the latency histogram buckets
+    app.config["METRICS_BUCKETS"] = tuple(float(bound) for bound in os.environ.get("METRICS_BUCKETS", "0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10").split(","))
+    # print requests slower than this with their SQLite, MongoDB, Google Sheets and template times, 0 switches it off
+    app.config["METRICS_SLOW_REQUEST_MS"] = int(os.environ.get("METRICS_SLOW_REQUEST_MS", "0"))
+    # bulk import/export endpoints answer only requests with header "Authorization: Bearer <BULK_API_TOKEN>"
+    app.config["BULK_API_TOKEN"]  = os.environ.get("BULK_API_TOKEN")
+    # records per transaction or insert_many call
+    app.config["BULK_BATCH_SIZE"] = int(os.environ.get("BULK_BATCH_SIZE", "1000"))
+    # SQLite parameters
+    app.config["SQLITE_INIT"]    = os.environ.get("SQLITE_INIT",   "False").lower() in {'1','true','t','yes','y'}# => Heroku Congig Vars
+    app.config["SQLITE_DB"]      = os.environ.get("SQLITE_DB",     "./data/taskmaster.sqlite") 
+    app.config["SQLITE_SCHEMA"]  = os.environ.get("SQLITE_SCHEMA", "./data/sqlite_schema.sql")
+    app.config["SQLITE_CONTENT"] = os.environ.get("SQLITE_CONTENT","./data/sqlite_content.sql")
+    app.config["SQLITE_SCHEMA_FTS"]    = os.environ.get("SQLITE_SCHEMA_FTS",    "./data/sqlite_fts.sql")
+    app.config["SQLITE_SCHEMA_MIRROR"] = os.environ.get("SQLITE_SCHEMA_MIRROR", "./data/sqlite_mirror.sql")
+    app.config["SQLITE_SCHEMA_JOBS"]   = os.environ.get("SQLITE_SCHEMA_JOBS",   "./data/sqlite_jobs.sql")
+    # number of prepared statements kept per connection
+    app.config["SQLITE_CACHED_STATEMENTS"] = int(os.environ.get("SQLITE_CACHED_STATEMENTS", "256"))
+    # applied to every connection, see https://www.sqlite.org/pragma.html
+    app.config["SQLITE_PRAGMAS"] = {
+        "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),          # readers do not block the writer
+        "synchronous":  os.environ.get("SQLITE_SYNCHRONOUS",  "NORMAL"),       # safe in WAL mode, no fsync per commit
+        "cache_size":   int(os.environ.get("SQLITE_CACHE_SIZE",   "-16000")),  # negative: KiB of page cache
+        "mmap_size":    int(os.environ.get("SQLITE_MMAP_SIZE",    "67108864")),
+        "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", "5000")),    # ms to wait for a lock instead of failing
+        "recursive_triggers": "ON",  # rows deleted by INSERT OR REPLACE leave the full-text index through its delete trigger
+    }
+    app.config["SQLITE_TABLE_TODOS"] = "Todos"
+    app.config["SQLITE_TABLE_TODOS_FTS"] = "TodosFts"
+    app.config["COLUMNS_TODOS"]  = ('TaskId','Content','Completed','SourceFileName','LocalFileName','DatTimIns', 'DatTimUpd')
+    app.config["TODOS_PAGE_SIZE"] = int(os.environ.get("TODOS_PAGE_SIZE", "20"))
+    # MongoDB parameters
+    app.config["MONGO_INIT"]       = os.environ.get("MONGO_INIT",   "False").lower() in {'1','true','t','yes','y'}# => Heroku Congig Vars
+    # create missing indexes of the celebrities during `flask bootstrap`
+    app.config["MONGO_INDEXES"]    = os.environ.get("MONGO_INDEXES", "True").lower() in {'1','true','t','yes','y'}
+    app.config["MONGO_CONTENT"]    = os.environ.get("MONGO_CONTENT","./data/mongo_content.json")
+    app.config["MONGO_DB_NAME"]    = os.environ.get("MONGO_DB_NAME")
+    app.config["MONGO_CLUSTER"]    = os.environ.get("MONGO_CLUSTER")
+    app.config["MONGO_COLLECTION_CELEBS"] = 'celebrities'
+    app.config["CELEBS_PAGE_SIZE"]  = int(os.environ.get("CELEBS_PAGE_SIZE", "20"))
+    app.config["CELEBS_SORT_FIELDS"] = ('last','first','dob','occupation','nationality')
+    # most documents one /celebs/search answer may contain
+    app.config["CELEBS_SEARCH_LIMIT"] = int(os.environ.get("CELEBS_SEARCH_LIMIT", "100"))
+    # fields shown in the list - the image itself is fetched through /celebs/image/<id>
+    app.config["CELEBS_LIST_FIELDS"] = ('first','last','dob','gender','hair_color','occupation','nationality','has_image','ImageHash')
+    # celebrity pictures are stored either in GridFS ("gridfs") or embedded into the document ("inline")
+    app.config["CELEBS_IMAGE_STORAGE"] = os.environ.get("CELEBS_IMAGE_STORAGE", "gridfs").lower()
+    app.config["CELEBS_IMAGE_CHUNK"]   = 255 * 1024 # GridFS default chunk size
+    app.config["MONGO_URI"] = f"mongodb+srv:" + \
+                              f"//{os.environ.get('MONGO_DB_USER')}" + \
+                              f":{os.environ.get('MONGO_DB_PASS')}" + \
+                              f"@{app.config['MONGO_CLUSTER']}" + \
+                              f".ueffo.mongodb.net" + \
+                              f"/{app.config['MONGO_DB_NAME']}" + \
+                              f"?retryWrites=true&w=majority"
+    # MongoDB connection pool parameters, one pool per worker process
+    app.config["MONGO_POOL_MAX"]         = int(os.environ.get("MONGO_POOL_MAX",         "20"))
+    app.config["MONGO_POOL_MIN"]         = int(os.environ.get("MONGO_POOL_MIN",         "0"))
+    app.config["MONGO_POOL_IDLE_MS"]     = int(os.environ.get("MONGO_POOL_IDLE_MS",     "300000"))
+    app.config["MONGO_POOL_WAIT_MS"]     = int(os.environ.get("MONGO_POOL_WAIT_MS",     "2000"))
+    app.config["MONGO_CONNECT_TIMEOUT_MS"] = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+    app.config["MONGO_SELECT_TIMEOUT_MS"]  = int(os.environ.get("MONGO_SELECT_TIMEOUT_MS",  "5000"))
+    # Google Sheets parameters
+    app.config["GSHEETS_SCOPE"] = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive.file",
+        "https://www.googleapis.com/auth/drive"
+        ]
+
+    # JSON of the service account, parsed when the Sheets client is created
+    app.config["GSHEETS_CREDITS"] = os.environ.get("GSHEETS_CREDITS")
+    app.config["GSHEETS_SHEETS"]  = "Python CodeInstitute-love_sandwiches"
+    app.config["GSHEETS_PAGE"] = {
+            "title":"Opening Stock - Sold = Surplus sandwiches on market days",
+            "columns":['sale'+str(i) for i in range(6)]
+    }
+    app.config["GSHEETS_SALES_LOOKBACK"] = 5
+    app.config["GSHEETS_SALES_MARKUP"] = 1.1
+    # forecast of the next market day: "mean" of the lookback days or "ewma" of the whole history
+    app.config["GSHEETS_FORECAST_METHOD"] = os.environ.get("GSHEETS_FORECAST_METHOD", "mean").lower()
+    if app.config["GSHEETS_FORECAST_METHOD"] not in FORECAST_METHODS:
+        raise ValueError(f"Unknown forecast method {app.config['GSHEETS_FORECAST_METHOD']} in GSHEETS_FORECAST_METHOD, choose from {FORECAST_METHODS}")
+    app.config["GSHEETS_FORECAST_ALPHA"]  = float(os.environ.get("GSHEETS_FORECAST_ALPHA", "0.3"))
+    # sales percentiles shown per sandwich type
+    app.config["GSHEETS_PERCENTILES"] = tuple(int(p) for p in os.environ.get("GSHEETS_PERCENTILES", "25,50,75").split(",") if p.strip())
+    # seconds a worksheet read is served from memory before Google is asked again
+    app.config["GSHEETS_CACHE_TTL"] = int(os.environ.get("GSHEETS_CACHE_TTL", "60"))
+    # serve the page from a SQLite mirror of the worksheets and queue the appends in an outbox
+    app.config["GSHEETS_MIRROR"]        = os.environ.get("GSHEETS_MIRROR", "True").lower() in {'1','true','t','yes','y'}
+    # with several hosts keep the thread on one of them, or run `flask sandwiches-sync` from a scheduler
+    app.config["GSHEETS_SYNC_THREAD"]   = os.environ.get("GSHEETS_SYNC_THREAD", "True").lower() in {'1','true','t','yes','y'}
+    app.config["GSHEETS_SYNC_INTERVAL"] = int(os.environ.get("GSHEETS_SYNC_INTERVAL", "60"))
+    app.config["GSHEETS_OUTBOX_BATCH"]  = int(os.environ.get("GSHEETS_OUTBOX_BATCH", "100"))
+    # seconds after which rows claimed by a worker which did not finish the flush are sent again
+    app.config["GSHEETS_OUTBOX_LEASE"]  = int(os.environ.get("GSHEETS_OUTBOX_LEASE", "120"))
+    # failed flushes after which a row is moved to the SheetOutboxFailed table instead of being sent again
+    app.config["GSHEETS_OUTBOX_MAX_ATTEMPTS"] = int(os.environ.get("GSHEETS_OUTBOX_MAX_ATTEMPTS", "10"))
+
+
+def create_app():
+    """ application factory, used by `flask` and by the WSGI server (see gunicorn.conf.py) """
+    app = Flask(__name__)
+    load_config(app)
+
+    # first, so the timing starts before the other request hooks
+    metrics.init_app(app)
+    sqlite_db.init_app(app)
+    fragment_cache.init_app(app)
+    jobs.init_app(app)
+    http_cache.init_app(app)
+    for feature in app.config["APP_FEATURES"]:
+        if feature not in FEATURES:
+            raise ValueError(f"Unknown feature {feature} in APP_FEATURES, choose from {FEATURES}")
+        app.register_blueprint(importlib.import_module(feature).bp)
+
+    # App routing
+    #==============
+    @app.route("/")  # trigger point through webserver: "/"= root directory
+    def index():
+        return render_template("index.html", page_title="Home")
+
+
+    @app.route("/about")
+    def about():
+        return render_template("about.html", page_title="About")
+
+
+    @app.route("/contact", methods=['GET','POST'])
+    def contact():
+        if request.method == 'POST':
+            flash(f"Thanks {request.form.get('name')}, we have received your message!")
+        return render_template("contact.html", page_title="Contact")
+
+    # one-shot commands, run once per deployment and not on every worker start
+    @app.cli.command("bootstrap")
+    def bootstrap_command():
+        """ Initialize the databases flagged by SQLITE_INIT and MONGO_INIT. """
+        bootstrap(app)
+
+    @app.cli.command("init-sqlite")
+    def init_sqlite_command():
+        """ Recreate the SQLite database from its schema and content scripts. """
+        sqlite_db.init_sqlite_db()
+
+    @app.cli.command("init-mongo")
+    def init_mongo_command():
+        """ Reload the MongoDB collections from the content file. """
+        import celebs
+        celebs.init_mongo_db()
+
+    return app
+
+
+def bootstrap(app):
+    with app.app_context():
+        if app.config["SQLITE_INIT"]:
+            click.echo("Initializing SQLite database")
+            sqlite_db.init_sqlite_db()
+        elif 'todos' in app.config["APP_FEATURES"]:
+            import todos
+            import sqlite3
+            click.echo("Creating missing SQLite indexes")
+            try:
+                todos.ensure_todos_indexes()
+            except sqlite3.Error as error:
+                # the task list still works without them, only slower
+                click.echo(f"Could not create the SQLite indexes: {error}", err=True)
+
+        if app.config["MONGO_INIT"]:
+            import celebs
+            click.echo("Initializing MongoDB collections")
+            celebs.init_mongo_db()
+        elif app.config["MONGO_INDEXES"] and 'celebs' in app.config["APP_FEATURES"]:
+            import celebs
+            import pymongo
+            click.echo("Creating missing MongoDB indexes")
+            try:
+                celebs.ensure_celebs_indexes()
+            except pymongo.errors.PyMongoError as error:
+                # the celebrities page still works without them, only slower
+                click.echo(f"Could not create the MongoDB indexes: {error}", err=True)
+
+
+def reset_process_resources():
+    """ drop the clients and connections inherited from the parent process, called after fork() """
+    sqlite_db.reset_sqlite_connections()
+    fragment_cache.reset_fragment_cache()
+    jobs.reset_jobs()
+    metrics.reset_metrics()
+    # features which are not enabled were never imported
+    if 'celebs' in sys.modules:
+        sys.modules['celebs'].reset_mongo_client()
+    if 'sandwiches' in sys.modules:
+        sys.modules['sandwiches'].reset_gsheets_client()
+    if 'sandwiches_mirror' in sys.modules:
+        sys.modules['sandwiches_mirror'].reset_mirror()
+
+
+# Run the App
+#=================
+# development server only, production runs `gunicorn "run:create_app()"` (see Procfile)
+if __name__ == "__main__":
+    app = create_app()
+    bootstrap(app)
+
+    app.run(
+        host  = app.config["FLASK_IP"],
+        port  = app.config["FLASK_PORT"],
+        debug = app.config["FLASK_DEBUG"])
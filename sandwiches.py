@@ -0,0 +1,235 @@
+import os
+import json
+import hashlib
+import threading
+import click
+from itertools import zip_longest
+from flask import Blueprint, current_app, render_template, request, flash
+from cachetools import TTLCache
+
+import jobs
+from metrics import requests_hook
+
+# Support for Google Drive and Google Sheets API
+#!pip install gspread google-auth
+# gspread and google.oauth2 are imported when the first request needs the client
+
+bp = Blueprint("sandwiches", __name__, cli_group=None)
+
+SHEET_STOCK = 'stock'
+SHEET_SALES = 'sales'
+SHEETS = (SHEET_STOCK, SHEET_SALES)
+
+
+# Google Sheets helpers
+#=======================
+# one authorized client and opened spreadsheet per worker process, created on first use
+_gsheets_spreadsheet = None
+_gsheets_pid = None
+_gsheets_worksheets = {}
+_gsheets_lock = threading.Lock()
+# worksheet contents and their revision digest keyed by the tuple of worksheet names, invalidated on append
+_gsheets_values = None
+_gsheets_values_lock = threading.Lock()
+
+
+def get_gsheets_spreadsheet():
+    global _gsheets_spreadsheet, _gsheets_pid
+    if _gsheets_spreadsheet is None or _gsheets_pid != os.getpid():
+        with _gsheets_lock:
+            if _gsheets_spreadsheet is None or _gsheets_pid != os.getpid():
+                from google.oauth2.service_account import Credentials
+                import gspread
+                # the credentials are parsed here, a missing GSHEETS_CREDITS only breaks this page
+                CREDS = Credentials.from_service_account_info(json.loads(current_app.config["GSHEETS_CREDITS"]))
+                SCOPED_CREDS = CREDS.with_scopes(current_app.config["GSHEETS_SCOPE"])
+                # the client's AuthorizedSession refreshes the access token whenever it expires
+                GSPREAD_CLIENT = gspread.authorize(SCOPED_CREDS)
+                # every Sheets API call is timed, see metrics.py
+                GSPREAD_CLIENT.session.hooks['response'].append(requests_hook('gsheets'))
+                _gsheets_spreadsheet = GSPREAD_CLIENT.open(current_app.config["GSHEETS_SHEETS"])
+                _gsheets_worksheets.clear()
+                _gsheets_pid = os.getpid()
+    return _gsheets_spreadsheet
+
+
+def reset_gsheets_client():
+    """ forget the client of this process and the cached values, e.g. after fork() """
+    global _gsheets_spreadsheet, _gsheets_pid
+    _gsheets_spreadsheet = None
+    _gsheets_pid = None
+    _gsheets_worksheets.clear()
+    with _gsheets_values_lock:
+        if _gsheets_values is not None:
+            _gsheets_values.clear()
+
+
+def get_gsheet_values_cache():
+    # created on first use, the TTL comes from the app config; call with _gsheets_values_lock held
+    global _gsheets_values
+    if _gsheets_values is None:
+        _gsheets_values = TTLCache(maxsize=16, ttl=current_app.config["GSHEETS_CACHE_TTL"])
+    return _gsheets_values
+
+
+def get_gsheet(sheet):
+    try:
+        sheets = get_gsheets_spreadsheet()
+        if sheet not in _gsheets_worksheets:
+            _gsheets_worksheets[sheet] = sheets.worksheet(sheet)
+    except:
+        print(f"Could not connect to Google Sheets {current_app.config['GSHEETS_SHEETS']}")
+        return None
+    return _gsheets_worksheets[sheet]
+
+
+def sheet_revision(values):
+    """ digest of worksheet contents, changes whenever a cell does """
+    return hashlib.sha1(json.dumps(values, separators=(',',':')).encode()).hexdigest()
+
+
+def get_gsheet_snapshot(*sheets):
+    """ read all values of the given worksheets in one batch request, served from cache within TTL,
+        returns the values and their revision digest or None """
+    with _gsheets_values_lock:
+        snapshot = get_gsheet_values_cache().get(sheets)
+    if snapshot is None:
+        try:
+            response = get_gsheets_spreadsheet().values_batch_get(list(sheets))
+        except:
+            print(f"Could not read {sheets} from Google Sheets {current_app.config['GSHEETS_SHEETS']}")
+            return None
+        # the API leaves out trailing empty cells, pad them like get_all_values() does
+        import gspread.utils
+        values = tuple(gspread.utils.fill_gaps(value_range.get('values', [])) for value_range in response['valueRanges'])
+        # the digest is taken once per fetch, the analytics are memoized on it
+        snapshot = (values, sheet_revision(values))
+        with _gsheets_values_lock:
+            get_gsheet_values_cache()[sheets] = snapshot
+    return snapshot
+
+
+def get_gsheet_values(*sheets):
+    """ read all values of the given worksheets, see get_gsheet_snapshot() """
+    snapshot = get_gsheet_snapshot(*sheets)
+    return None if snapshot is None else snapshot[0]
+
+
+def save_formdata_to_sheet(request, sheet, page):
+    row  = [int(request.form.get(column,0)) for column in page['columns']]
+    if current_app.config["GSHEETS_MIRROR"]:
+        # queued locally, the sync thread appends it to the worksheet in the next batch
+        import sandwiches_mirror
+        outbox_id = sandwiches_mirror.enqueue_row(sheet, row)
+        if type(outbox_id)==int:
+            # without the sync thread of this process a background job sends the outbox
+            if not current_app.config["GSHEETS_SYNC_THREAD"]:
+                jobs.submit("sandwiches.flush_outbox", unique=True)
+            flash(f"One row queued for {sheet}")
+        else:
+            flash(f"Error in append operation! {outbox_id}")
+        return
+    try:
+        # the page shows the row once the job appended it
+        jobs.submit("sandwiches.append_row", sheet=sheet, row=row)
+        flash(f"One row queued for {sheet}")
+    except:
+        flash(f"Error in append operation!")
+
+
+# Background jobs
+#=================
+# run by jobs.py after the request returned, a failed append is retried with backoff
+@jobs.handler("sandwiches.append_row")
+def append_row_job(sheet, row):
+    gsheet = get_gsheet(sheet)
+    if gsheet is None:
+        raise ConnectionError(f"Could not connect to Google Sheets {current_app.config['GSHEETS_SHEETS']}")
+    gsheet.append_row(row)
+    with _gsheets_values_lock:
+        get_gsheet_values_cache().clear()
+
+
+@jobs.handler("sandwiches.flush_outbox")
+def flush_outbox_job():
+    import sandwiches_mirror
+    while sandwiches_mirror.flush_outbox(get_gsheet, SHEETS):
+        pass
+    # the sent rows leave the outbox, the sync brings them back into the mirror
+    sandwiches_mirror.sync_mirror(get_gsheet, SHEETS)
+    # rows which could not be sent are released by flush_outbox(), the job is retried for them
+    unsent = sandwiches_mirror.count_outbox()
+    if unsent:
+        raise ConnectionError(f"{unsent} row(s) still queued for Google Sheets")
+
+
+def read_sheets_mirror(*sheets):
+    """ the worksheets from the local SQLite mirror, synced from Google in a background thread """
+    import sandwiches_mirror
+    if current_app.config["GSHEETS_SYNC_THREAD"]:
+        sandwiches_mirror.start_sync_thread(current_app._get_current_object(), get_gsheet, sheets)
+    snapshot = sandwiches_mirror.read_mirror(*sheets)
+    if snapshot is None:
+        # nothing mirrored yet, this one request waits for Google
+        try:
+            sandwiches_mirror.sync_mirror(get_gsheet, sheets)
+        except Exception as error:
+            print(f"Could not sync {sheets} from Google Sheets {current_app.config['GSHEETS_SHEETS']}: {error}")
+            return None
+        snapshot = sandwiches_mirror.read_mirror(*sheets)
+    return snapshot
+
+
+@bp.cli.command("sandwiches-sync")
+@click.option("--full", is_flag=True, help="Copy all rows again instead of the appended ones only.")
+def sandwiches_sync_command(full):
+    """ Flush the outbox to Google Sheets and sync the local mirror. """
+    import sandwiches_mirror
+    sent = sandwiches_mirror.flush_outbox(get_gsheet, SHEETS)
+    synced = sandwiches_mirror.sync_mirror(get_gsheet, SHEETS, full)
+    print(f"{sent} queued row(s) appended, new rows mirrored: {synced}")
+
+
+# GoogleSheets routes
+#=====================
+@bp.route("/sandwiches", methods=['GET','POST'])
+def sandwiches():
+    if request.method == 'POST':
+        # the sheet comes from the button pressed, nothing else may end up in the outbox
+        if request.form.get('submit') in SHEETS:
+            save_formdata_to_sheet(request, request.form['submit'], current_app.config['GSHEETS_PAGE'])
+        else:
+            flash(f"Unknown worksheet {request.form.get('submit')}")
+        # stock_data = get_gsheet(SHEET_STOCK).get_all_values()
+        # stock_row = stock_data[-1]
+        # surplus_row = [int(stock)-sales for stock,sales in zip(stock_row,sales_row)]
+        # print(surplus_row)
+
+    if current_app.config["GSHEETS_MIRROR"]:
+        snapshot = read_sheets_mirror(SHEET_STOCK, SHEET_SALES)
+    else:
+        snapshot = get_gsheet_snapshot(SHEET_STOCK, SHEET_SALES)
+    if snapshot is None:
+        flash(f"Could not read {SHEET_STOCK} and {SHEET_SALES} from Google Sheets")
+        snapshot = (([], []), None)
+    (stock_data, sales_data), revision = snapshot
+    import sandwiches_analytics
+    analytics = sandwiches_analytics.get_analytics(revision, stock_data, sales_data,
+                                                   ncols=len(current_app.config["GSHEETS_PAGE"]["columns"]),
+                                                   lookback=current_app.config["GSHEETS_SALES_LOOKBACK"],
+                                                   markup=current_app.config["GSHEETS_SALES_MARKUP"],
+                                                   method=current_app.config["GSHEETS_FORECAST_METHOD"],
+                                                   alpha=current_app.config["GSHEETS_FORECAST_ALPHA"],
+                                                   percentiles=current_app.config["GSHEETS_PERCENTILES"])
+    # the first row holds the column titles
+    surplus_data = stock_data[:1] + analytics['surplus'].tolist()
+    return render_template("sandwiches.html", 
+                            page_title="Love Sandwiches",
+                            page_subtitle=current_app.config["GSHEETS_PAGE"]["title"],
+                            request_path=request.path,
+                            columns=current_app.config["GSHEETS_PAGE"]["columns"], 
+                            data=zip_longest(stock_data,sales_data,surplus_data, fillvalue=[]),
+                            suggest=analytics['suggest'],
+                            forecast_method=current_app.config["GSHEETS_FORECAST_METHOD"],
+                            percentiles=analytics['percentiles']
+                        )
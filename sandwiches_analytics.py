@@ -0,0 +1,84 @@
+import threading
+from cachetools import LRUCache
+
+# Sandwich stock analytics
+#==========================
+# the stock and sales worksheets are converted once into integer arrays (rows = market days,
+# columns = sandwich types) and every figure of the page is computed column-wise on them.
+# Results are memoized on the revision digest of the sheet contents, so a page view
+# costs one dictionary lookup until somebody appends a row.
+# numpy is imported by the functions, so run.py can check FORECAST_METHODS without loading it
+_analytics = LRUCache(maxsize=8)
+_analytics_lock = threading.Lock()
+
+FORECAST_METHODS = ('mean', 'ewma')
+
+
+def sheet_to_array(rows, ncols):
+    """ convert worksheet rows without the title row into an int array of ncols columns """
+    import numpy as np
+    if len(rows) < 2:
+        return np.zeros((0, ncols), dtype=np.int64)
+    cells = np.array([row[:ncols] for row in rows[1:]], dtype=str)
+    # empty cells count as zero
+    cells[np.char.str_len(cells) == 0] = '0'
+    return cells.astype(np.int64)
+
+
+def window_mean(data, window):
+    """ column means of the last <window> rows """
+    import numpy as np
+    if window < 1 or len(data) < window:
+        return np.zeros(data.shape[1])
+    return data[-window:].mean(axis=0)
+
+
+def ewma_forecast(data, alpha):
+    """ exponentially weighted mean of all rows, the most recent row weighs the most """
+    import numpy as np
+    if len(data) == 0:
+        return np.zeros(data.shape[1])
+    weights = np.power(1.0 - alpha, np.arange(len(data) - 1, -1, -1, dtype=np.float64))
+    return weights @ data / weights.sum()
+
+
+def compute_analytics(stock_rows, sales_rows, ncols, lookback, markup, method='mean', alpha=0.3, percentiles=()):
+    """ surplus, forecast and percentiles of the sales, as arrays """
+    import numpy as np
+    stock = sheet_to_array(stock_rows, ncols)
+    sales = sheet_to_array(sales_rows, ncols)
+    days = min(len(stock), len(sales))
+    surplus = stock[:days] - sales[:days]
+    suggest = []
+    # like before, nothing is suggested until there is a full lookback of sales
+    if len(sales) >= lookback:
+        if method == 'ewma':
+            forecast = ewma_forecast(sales, alpha)
+        else:
+            forecast = window_mean(sales, lookback)
+        suggest = np.rint(forecast * markup).astype(np.int64).tolist()
+    if len(sales) and percentiles:
+        quantiles = np.percentile(sales, percentiles, axis=0)
+    else:
+        quantiles = np.zeros((len(percentiles), ncols))
+    return {
+        'stock': stock,
+        'sales': sales,
+        'surplus': surplus,
+        'suggest': suggest,
+        'percentiles': dict(zip(percentiles, quantiles.tolist())),
+    }
+
+
+def get_analytics(revision, stock_rows, sales_rows, ncols, lookback, markup, method='mean', alpha=0.3, percentiles=()):
+    """ compute_analytics() memoized on the sheet revision and the parameters """
+    if method not in FORECAST_METHODS:
+        raise ValueError(f"Unknown forecast method {method}, use one of {FORECAST_METHODS}")
+    key = (revision, ncols, lookback, markup, method, alpha, tuple(percentiles))
+    with _analytics_lock:
+        result = _analytics.get(key)
+    if result is None:
+        result = compute_analytics(stock_rows, sales_rows, ncols, lookback, markup, method, alpha, tuple(percentiles))
+        with _analytics_lock:
+            _analytics[key] = result
+    return result
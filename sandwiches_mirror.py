@@ -0,0 +1,227 @@
+""" SQLite mirror of the sandwiches worksheets: incremental sync and an outbox for appends """
+import os
+import json
+import uuid
+import sqlite3
+import threading
+from flask import current_app
+
+from sqlite_db import get_sqlite_db, query_db
+
+# the worksheets are reached only through the get_worksheet(sheet) callable passed in,
+# which returns an object with the gspread Worksheet methods get(range) and append_rows(rows)
+
+_mirror_tables_pid = None
+# rows read from the mirror, kept per process while the revision of the sheets does not change
+_mirror_values = {}
+_mirror_lock = threading.Lock()
+# background sync of the current process and the event which wakes it up early
+_sync_thread = None
+_sync_pid = None
+_sync_wakeup = threading.Event()
+
+
+def ensure_mirror_tables():
+    """ create the mirror tables once per process, they are never dropped """
+    global _mirror_tables_pid
+    if _mirror_tables_pid != os.getpid():
+        db = get_sqlite_db()
+        with current_app.open_resource(current_app.config["SQLITE_SCHEMA_MIRROR"], mode='r') as f:
+            db.executescript(f.read())
+        # the outbox of an older database has no attempt counter yet
+        if 'Attempts' not in {column['name'] for column in db.execute("PRAGMA table_info(SheetOutbox);")}:
+            db.execute("ALTER TABLE SheetOutbox ADD COLUMN Attempts INTEGER NOT NULL DEFAULT 0;")
+            db.commit()
+        _mirror_tables_pid = os.getpid()
+
+
+def column_letter(col:int):
+    """ A1 notation letter(s) of the 1-based column number """
+    letters = ''
+    while col:
+        col, rem = divmod(col-1, 26)
+        letters = chr(ord('A')+rem) + letters
+    return letters
+
+
+# Sync
+#======
+def sync_sheet(sheet:str, worksheet, ncols:int, full=False):
+    """ copy the rows appended to the worksheet since the last sync into the mirror, return their number """
+    ensure_mirror_tables()
+    db = get_sqlite_db()
+    row = db.execute("SELECT RowCount FROM SheetSync WHERE Sheet=?;", (sheet,)).fetchone()
+    known = 0 if full or row is None else row['RowCount']
+    # an open ended range, e.g. "A6:F", returns everything from row 6 down to the last filled row
+    rows = worksheet.get(f"A{known+1}:{column_letter(ncols)}")
+    # the API leaves out trailing empty cells
+    rows = [[str(cell) for cell in cells[:ncols]] + ['']*(ncols-len(cells)) for cells in rows]
+    try:
+        if full:
+            db.execute("DELETE FROM SheetRows WHERE Sheet=?;", (sheet,))
+        # INSERT OR REPLACE: another worker may have mirrored the same rows meanwhile
+        db.executemany("INSERT OR REPLACE INTO SheetRows (Sheet, RowNo, Cells) VALUES (?,?,?);",
+                       [(sheet, known+i+1, json.dumps(cells)) for i,cells in enumerate(rows)])
+        db.execute("INSERT OR IGNORE INTO SheetSync (Sheet) VALUES (?);", (sheet,))
+        db.execute("""UPDATE SheetSync
+                         SET RowCount = CASE WHEN :full THEN :count ELSE max(RowCount, :count) END
+                            ,Revision = Revision + (:changed OR :full)
+                            ,DatTimSync = strftime('%s', DateTime('Now','UTC'))
+                       WHERE Sheet=:sheet;""",
+                   {'sheet':sheet, 'count':known+len(rows), 'changed':len(rows)>0, 'full':full})
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()
+        raise
+    return len(rows)
+
+
+def sync_mirror(get_worksheet, sheets, full=False):
+    """ sync the given worksheets, return the number of new rows per sheet """
+    ncols = len(current_app.config["GSHEETS_PAGE"]["columns"])
+    return {sheet: sync_sheet(sheet, get_worksheet(sheet), ncols, full) for sheet in sheets}
+
+
+# Outbox
+#========
+def enqueue_row(sheet:str, row:list):
+    """ store a row to be appended to the worksheet by the next flush, return its id """
+    ensure_mirror_tables()
+    db = get_sqlite_db()
+    try:
+        cur = db.execute("INSERT INTO SheetOutbox (Sheet, Cells) VALUES (?,?);", (sheet, json.dumps(row)))
+        db.commit()
+    except sqlite3.Error as error:
+        db.rollback()
+        return error
+    _sync_wakeup.set()
+    return cur.lastrowid
+
+
+def flush_outbox(get_worksheet, sheets):
+    """ append the queued rows to their worksheets, one append_rows call per sheet, return the number sent
+
+        rows of a sheet not in <sheets> and rows which failed GSHEETS_OUTBOX_MAX_ATTEMPTS times
+        are moved to SheetOutboxFailed, otherwise they would be claimed first by every flush """
+    ensure_mirror_tables()
+    db = get_sqlite_db()
+    claim = uuid.uuid4().hex
+    # claim a batch first: with several workers every row is sent by only one of them,
+    # rows claimed by a worker which died are taken over after the lease ran out
+    db.execute("""UPDATE SheetOutbox SET ClaimedBy=:claim, DatTimClaim=strftime('%s','now')
+                   WHERE OutboxId IN (SELECT OutboxId FROM SheetOutbox
+                                       WHERE ClaimedBy IS NULL OR DatTimClaim < strftime('%s','now') - :lease
+                                       ORDER BY OutboxId LIMIT :batch);""",
+               {'claim':claim, 'lease':current_app.config["GSHEETS_OUTBOX_LEASE"], 'batch':current_app.config["GSHEETS_OUTBOX_BATCH"]})
+    db.commit()
+    batches = {}
+    for row in db.execute("SELECT OutboxId, Sheet, Cells FROM SheetOutbox WHERE ClaimedBy=? ORDER BY OutboxId;", (claim,)):
+        batches.setdefault(row['Sheet'], []).append((row['OutboxId'], json.loads(row['Cells'])))
+    sent = 0
+    for sheet, rows in batches.items():
+        ids = [(id,) for id,_ in rows]
+        if sheet not in sheets:
+            dead_letter(db, ids, f"Unknown worksheet {sheet}")
+            db.commit()
+            continue
+        try:
+            get_worksheet(sheet).append_rows([cells for _,cells in rows])
+        except Exception as error:
+            print(f"Could not append {len(rows)} row(s) to {sheet}: {error}")
+            db.executemany("UPDATE SheetOutbox SET ClaimedBy=NULL, DatTimClaim=NULL, Attempts=Attempts+1 WHERE OutboxId=?;", ids)
+            dead_letter(db, ids, str(error), current_app.config["GSHEETS_OUTBOX_MAX_ATTEMPTS"])
+        else:
+            db.executemany("DELETE FROM SheetOutbox WHERE OutboxId=?;", ids)
+            sent += len(rows)
+        db.commit()
+    return sent
+
+
+def dead_letter(db, ids, error, min_attempts=0):
+    """ move the outbox rows of <ids> which failed at least <min_attempts> times to SheetOutboxFailed """
+    failed = [(error, id, min_attempts) for (id,) in ids]
+    cur = db.executemany("""INSERT INTO SheetOutboxFailed (OutboxId, Sheet, Cells, Attempts, Error, DatTimIns)
+                            SELECT OutboxId, Sheet, Cells, Attempts, ?, DatTimIns FROM SheetOutbox WHERE OutboxId=? AND Attempts>=?;""", failed)
+    if cur.rowcount > 0:
+        db.executemany("DELETE FROM SheetOutbox WHERE OutboxId=? AND Attempts>=?;", [row[1:] for row in failed])
+        print(f"{cur.rowcount} row(s) not sent to Google Sheets, kept in SheetOutboxFailed: {error}")
+
+
+def count_outbox():
+    """ number of queued rows no worker is sending right now """
+    ensure_mirror_tables()
+    return query_db("SELECT count(*) FROM SheetOutbox WHERE ClaimedBy IS NULL;", one=True)[0]
+
+
+# Reading
+#=========
+def get_mirror_revision(sheets):
+    """ cheap fingerprint of the mirrored sheets and of the pending outbox rows, None until every sheet was synced once """
+    ensure_mirror_tables()
+    synced = {row['Sheet']: (row['RowCount'], row['Revision'])
+              for row in query_db(f"SELECT Sheet, RowCount, Revision FROM SheetSync WHERE Sheet IN ({','.join('?'*len(sheets))});", sheets)}
+    if len(synced) < len(sheets):
+        return None
+    pending = tuple(query_db("SELECT count(*), max(OutboxId) FROM SheetOutbox;", one=True))
+    return ('mirror',) + tuple(synced[sheet] for sheet in sheets) + (pending,)
+
+
+def read_mirror(*sheets):
+    """ all rows of the given worksheets from the mirror with the queued rows appended,
+        returns the values and their revision or None if a sheet was never synced """
+    revision = get_mirror_revision(sheets)
+    if revision is None:
+        return None
+    with _mirror_lock:
+        snapshot = _mirror_values.get(sheets)
+    if snapshot is None or snapshot[1] != revision:
+        values = tuple([json.loads(row['Cells']) for row in query_db(
+                            """SELECT Cells FROM (SELECT Cells, 0 AS Queued, RowNo AS Seq FROM SheetRows WHERE Sheet=:sheet
+                                                  UNION ALL
+                                                  SELECT Cells, 1, OutboxId FROM SheetOutbox WHERE Sheet=:sheet)
+                                ORDER BY Queued, Seq;""", {'sheet':sheet})]
+                       for sheet in sheets)
+        snapshot = (values, revision)
+        with _mirror_lock:
+            _mirror_values[sheets] = snapshot
+    return snapshot
+
+
+# Background sync
+#=================
+def sync_loop(app, get_worksheet, sheets):
+    with app.app_context():
+        while _sync_pid == os.getpid():
+            try:
+                # the outbox goes first, the sync right after brings the appended rows back into the mirror
+                flush_outbox(get_worksheet, sheets)
+                sync_mirror(get_worksheet, sheets)
+            except Exception as error:
+                print(f"Google Sheets mirror sync failed: {error}")
+            _sync_wakeup.wait(app.config["GSHEETS_SYNC_INTERVAL"])
+            _sync_wakeup.clear()
+
+
+def start_sync_thread(app, get_worksheet, sheets):
+    """ run the sync in a daemon thread of the current process, unless it is running already """
+    global _sync_thread, _sync_pid
+    if _sync_pid == os.getpid() and _sync_thread is not None and _sync_thread.is_alive():
+        return _sync_thread
+    with _mirror_lock:
+        # threads do not survive fork(), every worker process starts its own
+        if _sync_pid != os.getpid() or _sync_thread is None or not _sync_thread.is_alive():
+            _sync_pid = os.getpid()
+            _sync_thread = threading.Thread(target=sync_loop, args=(app, get_worksheet, tuple(sheets)),
+                                            name="gsheets-sync", daemon=True)
+            _sync_thread.start()
+    return _sync_thread
+
+
+def reset_mirror():
+    """ forget the state inherited from the parent process, e.g. after fork() """
+    global _mirror_tables_pid, _sync_thread, _sync_pid
+    _mirror_tables_pid = None
+    _sync_thread = None
+    _sync_pid = None
+    with _mirror_lock:
+        _mirror_values.clear()
@@ -0,0 +1,195 @@
+""" SQLite3 DB helpers shared by the blueprints: per-thread connections and single-statement CRUD """
+import os
+import sqlite3
+import threading
+from functools import lru_cache
+from flask import current_app
+
+from fragment_cache import bump_version
+from metrics import timed
+
+# connections of the current worker thread, kept open across requests
+_sqlite_local = threading.local()
+
+
+def open_sqlite_db(readonly=False):
+    if readonly:
+        # a separate read-only connection: list queries never queue behind a write transaction
+        db = sqlite3.connect(f"file:{os.path.abspath(current_app.config['SQLITE_DB'])}?mode=ro", uri=True,
+                             cached_statements=current_app.config["SQLITE_CACHED_STATEMENTS"])
+    else:
+        db = sqlite3.connect(current_app.config["SQLITE_DB"], cached_statements=current_app.config["SQLITE_CACHED_STATEMENTS"])
+    # use built-in row translator
+    db.row_factory = sqlite3.Row
+    for pragma,value in current_app.config["SQLITE_PRAGMAS"].items():
+        # the journal mode is stored in the database file, only a writer can change it
+        if readonly and pragma == 'journal_mode':
+            continue
+        db.execute(f"PRAGMA {pragma}={value};")
+    if readonly:
+        db.execute("PRAGMA query_only=1;")
+    return db
+
+
+# SQLite pattern from https://flask.palletsprojects.com/en/1.1.x/patterns/sqlite3/
+def get_sqlite_db(readonly=False):
+    # connections inherited through fork() belong to the parent process
+    if getattr(_sqlite_local, 'pid', None) != os.getpid():
+        _sqlite_local.__dict__.clear()
+        _sqlite_local.pid = os.getpid()
+    name = 'db_readonly' if readonly else 'db'
+    db = getattr(_sqlite_local, name, None)
+    if db is None:
+        if readonly:
+            # the writer switches the database to WAL mode before the first reader opens it
+            get_sqlite_db()
+        db = open_sqlite_db(readonly)
+        setattr(_sqlite_local, name, db)
+    return db
+
+
+# inspired by SQLite pattern from https://flask.palletsprojects.com/en/1.1.x/patterns/sqlite3/
+def init_sqlite_db(load_content=False):
+    db = get_sqlite_db()
+    with current_app.open_resource(current_app.config["SQLITE_SCHEMA"], mode='r') as f:
+        db.cursor().executescript(f.read())
+    # the triggers of the full-text index have to exist before the content is loaded
+    init_sqlite_fts()
+    with current_app.open_resource(current_app.config["SQLITE_CONTENT"], mode='r') as f:
+        db.cursor().executescript(f.read())
+    db.commit()
+    bump_version(current_app.config["SQLITE_TABLE_TODOS"])
+
+
+def init_sqlite_fts():
+    """ create the full-text index and its triggers if missing, then rebuild the index from the table """
+    db = get_sqlite_db()
+    with current_app.open_resource(current_app.config["SQLITE_SCHEMA_FTS"], mode='r') as f:
+        db.cursor().executescript(f.read())
+    db.commit()
+
+
+# inspired by SQLite pattern from https://flask.palletsprojects.com/en/1.1.x/patterns/sqlite3/        
+# every helper is timed as a SQLite call of the current request, see metrics.py
+@timed("sqlite")
+def query_db(query, args=(), one=False):
+    cur = get_sqlite_db(readonly=True).execute(query, args)
+    rv = cur.fetchone() if one else cur.fetchall()
+    cur.close()
+    return (rv[0] if type(rv)==list else rv) if one else rv
+
+
+# the SQL text of every (table, column set) is generated once, so the statement cache of the connection hits
+@lru_cache(maxsize=256)
+def sql_insert(table:str, columns:tuple, conflict:str=''):
+    # generate "INSERT [OR <conflict>] INTO <table> (<column>,...) VALUES (:<column>,...)"
+    return f"INSERT{' OR '+conflict if conflict else ''} INTO {table} ({','.join(columns)}) VALUES ({','.join(':'+column for column in columns)});"
+
+
+@lru_cache(maxsize=256)
+def sql_update(table:str, columns:tuple):
+    # generate "<column>=:<column>,..." list
+    set_list = ",".join([f"{column}=:{column}" for column in columns])
+    return f"UPDATE {table} SET {set_list} WHERE rowid=:_rowid;"
+
+
+@lru_cache(maxsize=256)
+def sql_delete(table:str, returning:tuple):
+    return f"DELETE FROM {table} WHERE rowid=?" + (f" RETURNING {','.join(returning)};" if returning else ";")
+
+
+# RETURNING is available from SQLite 3.35
+SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+@timed("sqlite")
+def insert_row(table:str, row:dict):
+    """ insert one row into given table """
+    cur = get_sqlite_db().cursor()
+    if not cur:
+        return 0
+    try:
+        cur.execute(sql_insert(table, tuple(row.keys())), row)
+        cur.connection.commit()
+        bump_version(table)
+        return cur.lastrowid
+    except sqlite3.Error as error:
+        cur.connection.rollback()
+        return error
+ 
+
+@timed("sqlite")
+def insert_rows(table:str, columns:tuple, rows:list, conflict:str=''):
+    """ insert many rows into given table in one transaction, every row is a dict of <columns> """
+    # conflict: '' fails the whole batch on a constraint violation, 'IGNORE' skips the row, 'REPLACE' overwrites
+    cur = get_sqlite_db().cursor()
+    if not cur:
+        return 0
+    try:
+        cur.executemany(sql_insert(table, columns, conflict), rows)
+        cur.connection.commit()
+        bump_version(table)
+        # summed up over all rows, the ones skipped by IGNORE do not count
+        return cur.rowcount
+    except sqlite3.Error as error:
+        cur.connection.rollback()
+        return error
+
+
+@timed("sqlite")
+def delete_row(table:str, id:int, returning:tuple=()):
+    """ delete one row by <rowid> from given table, return the <returning> columns of the deleted row """
+    cur = get_sqlite_db().cursor()
+    if not cur:
+        return ""
+    try:
+        if returning and not SQLITE_RETURNING:
+            row = cur.execute(f"SELECT {','.join(returning)} FROM {table} WHERE rowid=?;", (id,)).fetchone()
+            cur.execute(sql_delete(table, ()), (id,))
+        elif returning:
+            # step the statement to its end before the commit
+            rows = cur.execute(sql_delete(table, returning), (id,)).fetchall()
+            row = rows[0] if rows else None
+        else:
+            cur.execute(sql_delete(table, ()), (id,))
+            row = cur.rowcount
+        cur.connection.commit()
+        bump_version(table)
+        return row
+    except sqlite3.Error as error:
+        cur.connection.rollback()
+        return error
+
+
+@timed("sqlite")
+def update_row(table:str, row:dict, id:int):
+    """ update one row by <rowid> from given table """
+    cur = get_sqlite_db().cursor()
+    if not cur:
+        return ""
+    try:
+        cur.execute(sql_update(table, tuple(row.keys())), dict(row, _rowid=id))
+        cur.connection.commit()
+        bump_version(table)
+        return cur.rowcount
+    except sqlite3.Error as error:
+        cur.connection.rollback()
+        return error
+
+
+def reset_sqlite_connections():
+    """ forget the connections of this thread, e.g. after fork() """
+    _sqlite_local.__dict__.clear()
+
+
+# Flask pattern from https://flask.palletsprojects.com/en/1.1.x/patterns/sqlite3/
+def close_connection(exception):
+    # connections stay open for the next request of this thread, only unfinished transactions are dropped
+    if getattr(_sqlite_local, 'pid', None) == os.getpid():
+        for db in (getattr(_sqlite_local, 'db', None), getattr(_sqlite_local, 'db_readonly', None)):
+            if db is not None and db.in_transaction:
+                db.rollback()
+
+
+def init_app(app):
+    app.teardown_appcontext(close_connection)
@@ -0,0 +1,582 @@
+import os
+import time
+import threading
+import hashlib
+import glob
+import shutil
+from datetime import datetime
+from math import floor, isfinite
+import click
+from flask import Blueprint, current_app, render_template, request, redirect, url_for, flash, send_from_directory, abort, \
+                  jsonify, Response, stream_with_context
+from werkzeug.utils import secure_filename
+from markupsafe import Markup, escape
+from cachetools import LRUCache
+import sqlite3
+
+# Support for thumbnail generation
+#!pip install Pillow
+# PIL is imported by the thumbnail helpers on first use
+
+import jobs
+from http_cache import conditional_page
+from fragment_cache import cached_fragment, relative_time_ttl, bump_version
+from sqlite_db import query_db, insert_row, insert_rows, update_row, delete_row, init_sqlite_fts, get_sqlite_db
+from bulk_io import FORMATS, MIMETYPES, get_format, check_bulk_token, read_records, import_records, write_records, echo_report
+
+bp = Blueprint("todos", __name__, cli_group=None)
+
+
+# SQLite helpers
+#================
+# keyset pagination, see https://use-the-index-luke.com/no-offset
+def query_tasks_page(show='all', after=None):
+    """ one page of tasks ordered by (Completed, TaskId), starting behind the <after> cursor """
+    conditions = []
+    args = []
+    if show == 'open':
+        conditions.append("Completed=0")
+    elif show == 'completed':
+        conditions.append("Completed=1")
+    cursor = parse_task_cursor(after)
+    if cursor:
+        # row value comparison seeks in index idxTodosCompleted
+        conditions.append("(Completed, TaskId) > (?, ?)")
+        args += cursor
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    page_size = current_app.config["TODOS_PAGE_SIZE"]
+    # read one extra row to find out whether there is a next page
+    tasks = query_db(f"SELECT * FROM {current_app.config['SQLITE_TABLE_TODOS']} {where} ORDER BY Completed, TaskId LIMIT ?;", args+[page_size+1])
+    next_cursor = None
+    if len(tasks) > page_size:
+        tasks = tasks[:page_size]
+        next_cursor = f"{tasks[-1]['Completed']}.{tasks[-1]['TaskId']}"
+    return tasks, next_cursor
+
+
+def parse_task_cursor(cursor):
+    """ convert "<Completed>.<TaskId>" into a tuple of integers, None if malformed """
+    try:
+        completed, task_id = cursor.split('.')
+        return int(completed), int(task_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+# full-text search in the FTS5 index TodosFts, see data/sqlite_fts.sql
+# highlight() wraps the matches into these private use characters, they become <mark> after HTML escaping
+MARK_START, MARK_END = '\ue000', '\ue001'
+
+
+def fts_query(q):
+    """ FTS5 query of the words typed in: every word has to occur, as the beginning of a word of the task """
+    # each word is quoted, FTS5 operators and punctuation in the input are searched for literally
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in q.split())
+
+
+def query_tasks_search(q, show='all', after=None):
+    """ one page of the tasks matching the words of <q>, best match first, starting behind the <after> cursor """
+    conditions = [f"{current_app.config['SQLITE_TABLE_TODOS_FTS']} MATCH ?"]
+    args = [MARK_START, MARK_END, fts_query(q)]
+    if show == 'open':
+        conditions.append("t.Completed=0")
+    elif show == 'completed':
+        conditions.append("t.Completed=1")
+    cursor = parse_search_cursor(after)
+    seek = ""
+    if cursor:
+        seek = "WHERE (Rank, TaskId) > (?, ?)"
+        args += cursor
+    page_size = current_app.config["TODOS_PAGE_SIZE"]
+    fts = current_app.config['SQLITE_TABLE_TODOS_FTS']
+    # bm25() is smaller for better matches
+    tasks = query_db(f"""SELECT * FROM (SELECT t.*, highlight({fts}, 0, ?, ?) AS ContentMarked, bm25({fts}) AS Rank
+                                          FROM {fts} JOIN {current_app.config['SQLITE_TABLE_TODOS']} t ON t.TaskId = {fts}.rowid
+                                         WHERE {' AND '.join(conditions)}) {seek}
+                          ORDER BY Rank, TaskId LIMIT ?;""", args+[page_size+1])
+    next_cursor = None
+    if len(tasks) > page_size:
+        tasks = tasks[:page_size]
+        next_cursor = f"{tasks[-1]['Rank']!r}_{tasks[-1]['TaskId']}"
+    return [dict(task, ContentMarked=mark_highlights(task['ContentMarked'])) for task in tasks], next_cursor
+
+
+def parse_search_cursor(cursor):
+    """ convert "<Rank>_<TaskId>" into a (float, int) tuple, None if malformed """
+    try:
+        rank, task_id = cursor.rsplit('_', 1)
+        rank = float(rank)
+        return (rank, int(task_id)) if isfinite(rank) else None
+    except (AttributeError, ValueError):
+        return None
+
+
+def mark_highlights(text):
+    """ HTML of the highlighted text with the matches in <mark> """
+    return Markup(str(escape(text or '')).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>'))
+
+
+def get_page_args(request):
+    """ pagination and filter arguments to carry over into links of the task list """
+    page_args = {'show': request.args.get('show', 'all'), 'after': request.args.get('after'), 'q': request.args.get('q', '').strip()}
+    return {key:value for key,value in page_args.items() if value and value != 'all'}
+
+
+# Jinja2 filters
+#================
+# inspired by https://stackoverflow.com/questions/4830535/how-do-i-format-a-date-in-jinja2
+@bp.app_template_filter('unix_time_ago')
+def _jinja2_filter_time_ago(unix_timestamp:int):
+    time_formats = (
+        (60, 'seconds', 1),                           # 60
+        (120, '1 minute ago', '1 minute from now'),   # 60*2
+        (3600, 'minutes', 60),                        # 60*60, 60
+        (7200, '1 hour ago', '1 hour from now'),      # 60*60*2
+        (86400, 'hours', 3600),                       # 60*60*24, 60*60
+        (172800, 'Yesterday', 'Tomorrow'),            # 60*60*24*2
+        (604800, 'days', 86400),                      # 60*60*24*7, 60*60*24
+        (1209600, 'Last week', 'Next week'),          # 60*60*24*7*4*2
+        (2419200, 'weeks', 604800),                   # 60*60*24*7*4, 60*60*24*7
+        (4838400, 'Last month', 'Next month'),        # 60*60*24*7*4*2
+        (29030400, 'months', 2419200),                # 60*60*24*7*4*12, 60*60*24*7*4
+        (58060800, 'Last year', 'Next year'),         # 60*60*24*7*4*12*2
+        (2903040000, 'years', 29030400),              # 60*60*24*7*4*12*100, 60*60*24*7*4*12
+        (5806080000, 'Last century', 'Next century'), # 60*60*24*7*4*12*100*2
+        (58060800000, 'centuries', 2903040000)        # 60*60*24*7*4*12*100*20, 60*60*24*7*4*12*100
+    )
+    seconds = datetime.utcnow().timestamp() - unix_timestamp
+    if 0 <= seconds < 1:
+        return 'Just now'
+    if seconds < 0 :
+        seconds = abs(seconds)
+        token = 'from now'
+        list_choice = 2
+    else:
+        token = 'ago'
+        list_choice = 1
+
+    for format in time_formats:
+        if seconds < format[0]:
+            if type(format[2]) == str:
+                return format[list_choice]
+            else:
+                return f"{floor(seconds / format[2])} {format[1]} {token}"
+    return time
+
+
+# SQLite routes
+#===============
+@bp.route("/todos", methods=['GET','POST'])
+@conditional_page
+def todos():
+    if request.method == 'POST':
+        task = save_task_to_db(request, None)
+    else:
+        # create an empty task
+        task = {}
+    return render_todos(task)
+
+
+@bp.route("/todos/update/<int:task_id>", methods=['GET','POST'])
+def update_task(task_id):
+    if request.method == 'POST':
+        save_task_to_db(request, task_id)
+        return redirect(url_for('.todos', **get_page_args(request)))
+
+    task = query_db(f"SELECT * FROM {current_app.config['SQLITE_TABLE_TODOS']} WHERE rowid=?;", (task_id,), one=True)
+    if task is None:
+        flash(f"Task {task_id} does not exist")
+        return redirect(url_for('.todos', **get_page_args(request)))
+
+    # show the page of the list the update was started from, not the whole list
+    return render_todos(task)
+
+
+def render_todos(task):
+    page_args = get_page_args(request)
+    # the table is only queried and rendered when the tasks changed since it was cached
+    table = cached_fragment(current_app.config["SQLITE_TABLE_TODOS"], page_args, lambda: render_todos_table(page_args))
+    if table['error']:
+        flash(table['error'])
+    elif not table['count'] and page_args.get('q'):
+        flash(f"No task matches {page_args['q']}")
+    elif not table['count'] and not page_args:
+        flash("There are no tasks. Create one above!")
+    # the form posts back to the current page of the list
+    request_path = url_for(request.endpoint, **request.view_args, **page_args)
+    return render_template("todos.html", page_title="Task Master", request_path=request_path, last_task=task,
+                           page_args=page_args, table_html=Markup(table['html']))
+
+
+def render_todos_table(page_args):
+    """ HTML of one page of the task list and the number of tasks on it, with the seconds until a relative time in it changes """
+    error = None
+    # get one page of tasks from DB
+    if page_args.get('q'):
+        try:
+            tasks, next_cursor = query_tasks_search(page_args['q'], page_args.get('show', 'all'), page_args.get('after'))
+        except sqlite3.OperationalError as error_fts:
+            # databases created before the full-text index
+            error = f"Search is not available: {error_fts}, run `flask todos-fts-rebuild`"
+            tasks, next_cursor = [], None
+    else:
+        tasks, next_cursor = query_tasks_page(page_args.get('show', 'all'), page_args.get('after'))
+    html = render_template("todos_table.html", tasks=tasks, page_args=page_args, next_cursor=next_cursor)
+    # "2 minutes ago" turns into "3 minutes ago", the cached table has to be rendered again by then
+    ttl = relative_time_ttl([timestamp for task in tasks for timestamp in (task['DatTimIns'], task['DatTimUpd']) if timestamp])
+    return {'html': html, 'count': len(tasks), 'error': error}, ttl
+
+
+def save_task_to_db(request, task_id):
+    task_new = {'Content':   request.form.get('Content',''),
+                # checkbox value conversion to integer
+                'Completed': 1 if request.form.get('Completed','')=="on" else 0}
+
+    # following instructions from https://flask.palletsprojects.com/en/1.1.x/patterns/fileuploads/
+    data = request.files['SourceFileName']
+    task_old = None
+    if data:
+        filename_source = secure_filename(data.filename)
+        extension = filename_source.rsplit('.', 1)[1] if '.' in filename_source else ''
+        if extension in current_app.config["UPLOAD_EXTENSIONS"]:
+            # generate a new image file name
+            filename_local = str(time.time()).replace('.','')+'.'+extension
+            task_new['SourceFileName'] = filename_source
+            task_new['LocalFileName']  = filename_local
+            # the file being replaced is only looked up when there is a new one
+            if task_id:
+                task_old = query_db(f"SELECT SourceFileName, LocalFileName FROM {current_app.config['SQLITE_TABLE_TODOS']} WHERE rowid=?;", (task_id,), one=True)
+        else:
+            data = None
+
+    if task_id:
+        row_id = update_row(current_app.config["SQLITE_TABLE_TODOS"], task_new, task_id)
+    else:
+        row_id = insert_row(current_app.config["SQLITE_TABLE_TODOS"], task_new)
+    # update was successful
+    if type(row_id) == int and row_id:
+        # only spool the new file, a job moves it into place, creates its thumbnail and deletes the old file
+        if data:
+            os.makedirs(current_app.config["UPLOAD_INCOMING"], exist_ok=True)
+            data.save(os.path.join(current_app.config["UPLOAD_INCOMING"], filename_local))
+            try:
+                jobs.submit("todos.store_upload", filename_local=filename_local,
+                            replaced=task_old['LocalFileName'] if task_old else None)
+            except sqlite3.Error as error:
+                # the file is served from the spool, the orphan cleanup removes the replaced one
+                flash(f"Could not queue the processing of {filename_source}: {error}")
+
+        # create empty task - this will be displayed, because the update was OK
+        task_new = {}
+        flash(f"One record successfully {'updated' if task_id else 'added'}")
+    elif type(row_id) == int:
+        flash(f"Task {task_id} does not exist")
+    else:
+        flash(f"Error in {'update' if task_id else 'insert'} operation: {row_id}")
+    return task_new
+
+
+@bp.route("/todos/delete/<int:task_id>")
+def delete_task(task_id):
+    task = delete_row(current_app.config['SQLITE_TABLE_TODOS'], task_id, returning=('SourceFileName','LocalFileName'))
+    if task is None:
+        flash(f"Task {task_id} does not exist")
+    elif isinstance(task, sqlite3.Row):
+        filename_local = task['LocalFileName']
+        if filename_local:
+            try:
+                jobs.submit("todos.delete_upload", filename_local=filename_local)
+            except sqlite3.Error as error:
+                # left to the orphan cleanup
+                flash(f"Could not queue the deletion of {task['SourceFileName']}: {error}")
+        flash("1 Record deleted")
+    else:
+        flash(f"Error in delete operation: {task}")
+    return redirect(url_for('.todos', **get_page_args(request)))
+
+
+@bp.route("/uploads/<filename_local>")
+def uploads(filename_local):
+    filename_local = secure_filename(filename_local)
+    # the upload folder holds the databases and the spool the celebrity pictures too
+    if not is_upload_name(filename_local):
+        abort(404)
+    folder = current_app.config["UPLOAD_FOLDER"]
+    # until its job ran, a new upload is still in the spool
+    if not os.path.isfile(os.path.join(folder, filename_local)):
+        folder = current_app.config["UPLOAD_INCOMING"]
+    response = send_from_directory(folder, filename_local, cache_timeout=31536000, conditional=True)
+    # every upload gets a new local file name, the content of a name never changes
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@bp.route("/uploads/thumbs/<filename_local>")
+def thumbnail(filename_local):
+    filename_local = secure_filename(filename_local)
+    # only uploads have thumbnails, not the database or the thumbnails themselves
+    if not is_upload_name(filename_local):
+        abort(404)
+    thumb_name = get_thumbnail(filename_local)
+    if thumb_name is None:
+        abort(404)
+    response = send_from_directory(current_app.config["UPLOAD_FOLDER"], thumb_name, cache_timeout=31536000, conditional=True)
+    # uploads get a new local file name every time, the thumbnail of a name never changes
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def ensure_todos_indexes():
+    """ create the indexes of the task list in a database created before they existed, see sqlite_schema.sql """
+    db = get_sqlite_db()
+    db.execute(f"CREATE INDEX IF NOT EXISTS idxTodosCompleted ON {current_app.config['SQLITE_TABLE_TODOS']} (Completed, TaskId);")
+    db.commit()
+
+
+@bp.cli.command("todos-fts-rebuild")
+def todos_fts_rebuild_command():
+    """ Create the full-text index of the tasks if missing and rebuild it from the table. """
+    init_sqlite_fts()
+    bump_version(current_app.config["SQLITE_TABLE_TODOS"])
+    count = query_db(f"SELECT count(*) FROM {current_app.config['SQLITE_TABLE_TODOS']};", one=True)[0]
+    print(f"Full-text index rebuilt over {count} task(s)")
+
+
+# Bulk import/export
+#====================
+# what happens to a record whose TaskId exists already: the batch fails, the record is skipped or it replaces the task
+BULK_CONFLICTS = {'error':'', 'skip':'IGNORE', 'replace':'REPLACE'}
+
+
+def prepare_task(record):
+    """ Todos row of an imported record, CSV delivers every value as a string """
+    columns = current_app.config["COLUMNS_TODOS"]
+    unknown = [str(column) for column in record if column not in columns]
+    if unknown:
+        raise ValueError(f"Unknown column(s) {', '.join(unknown)}")
+    task = {column: (None if record.get(column) == '' else record.get(column)) for column in columns}
+    if not task['Content']:
+        raise ValueError("Content is missing")
+    for column in ('TaskId','Completed','DatTimIns','DatTimUpd'):
+        if task[column] is not None:
+            task[column] = int(task[column])
+    if task['Completed'] not in (None, 0, 1):
+        raise ValueError(f"Completed must be 0 or 1, not {task['Completed']}")
+    task['Completed'] = task['Completed'] or 0
+    if task['DatTimIns'] is None:
+        task['DatTimIns'] = int(time.time())
+    return task
+
+
+def import_tasks(records, conflict='error', batch_size=None):
+    """ store the (line number, record, error) tuples of read_records() in batched transactions, return a report """
+    table = current_app.config["SQLITE_TABLE_TODOS"]
+    columns = current_app.config["COLUMNS_TODOS"]
+
+    def insert_batch(tasks):
+        # one executemany per batch: a failing batch is rolled back as a whole
+        result = insert_rows(table, columns, tasks, BULK_CONFLICTS[conflict])
+        return (result, []) if type(result) == int else (0, [(None, str(result))])
+
+    return import_records(records, prepare_task, insert_batch, batch_size or current_app.config["BULK_BATCH_SIZE"])
+
+
+def iter_tasks(batch_size=None):
+    """ all tasks in TaskId order, read in keyset pages so no query keeps the whole table """
+    batch_size = batch_size or current_app.config["BULK_BATCH_SIZE"]
+    table = current_app.config["SQLITE_TABLE_TODOS"]
+    tasks = query_db(f"SELECT * FROM {table} ORDER BY TaskId LIMIT ?;", (batch_size,))
+    while tasks:
+        for task in tasks:
+            yield dict(task)
+        tasks = query_db(f"SELECT * FROM {table} WHERE TaskId > ? ORDER BY TaskId LIMIT ?;", (tasks[-1]['TaskId'], batch_size))
+
+
+@bp.route("/todos/export")
+def export_tasks():
+    check_bulk_token()
+    try:
+        fmt = get_format(request.args.get('format'))
+    except ValueError as error:
+        abort(400, str(error))
+    response = Response(stream_with_context(write_records(iter_tasks(), fmt, current_app.config["COLUMNS_TODOS"])),
+                        mimetype=MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = f"attachment; filename=todos.{fmt}"
+    return response
+
+
+@bp.route("/todos/import", methods=['POST'])
+def import_tasks_upload():
+    """ NDJSON or CSV as request body or as multipart upload <file>, answered with the import report """
+    check_bulk_token()
+    upload = request.files.get('file')
+    conflict = request.args.get('conflict', 'error')
+    try:
+        fmt = get_format(request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else None),
+                         upload.filename if upload else None)
+        if conflict not in BULK_CONFLICTS:
+            raise ValueError(f"Unknown conflict handling {conflict}, use one of {tuple(BULK_CONFLICTS)}")
+    except ValueError as error:
+        abort(400, str(error))
+    # the body is decoded and stored batch by batch while it is read
+    report = import_tasks(read_records(upload.stream if upload else request.stream, fmt), conflict)
+    return jsonify(report)
+
+
+@bp.cli.command("todos-import")
+@click.argument("file", type=click.File('rb'))
+@click.option("--format", "fmt", type=click.Choice(FORMATS), help="Default: by file extension, else ndjson.")
+@click.option("--batch-size", type=int, help="Records per transaction, default BULK_BATCH_SIZE.")
+@click.option("--conflict", type=click.Choice(tuple(BULK_CONFLICTS)), default='error', show_default=True,
+              help="What to do with a record whose TaskId exists.")
+def todos_import_command(file, fmt, batch_size, conflict):
+    """ Import tasks from an NDJSON or CSV file, '-' reads stdin. """
+    echo_report(import_tasks(read_records(file, get_format(fmt, getattr(file, 'name', None))), conflict, batch_size))
+
+
+@bp.cli.command("todos-export")
+@click.argument("file", type=click.File('w', encoding='utf-8'), default='-')
+@click.option("--format", "fmt", type=click.Choice(FORMATS), help="Default: by file extension, else ndjson.")
+def todos_export_command(file, fmt):
+    """ Export all tasks as NDJSON or CSV, to stdout by default. """
+    for chunk in write_records(iter_tasks(), get_format(fmt, getattr(file, 'name', None)), current_app.config["COLUMNS_TODOS"]):
+        file.write(chunk)
+
+
+# Upload derivatives helpers
+#============================
+# name of the thumbnail of each uploaded file, saves hashing the original on every request
+_thumbnails = LRUCache(maxsize=4096)
+_thumbnails_lock = threading.Lock()
+
+
+def get_thumbnail(filename_local):
+    """ name of the thumbnail of an uploaded file, generated on first request, None if there is no such upload """
+    with _thumbnails_lock:
+        thumb_name = _thumbnails.get(filename_local)
+    folder = current_app.config["UPLOAD_FOLDER"]
+    if thumb_name and os.path.isfile(os.path.join(folder, thumb_name)):
+        return thumb_name
+
+    # until its job ran, a new upload is still in the spool; looked up in the order the job moves it
+    for path in (os.path.join(current_app.config["UPLOAD_INCOMING"], filename_local), os.path.join(folder, filename_local)):
+        # content-addressed: <original>.<hash of original>.<size>.thumb.<format>
+        content_hash = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    content_hash.update(chunk)
+            break
+        except FileNotFoundError:
+            continue
+    else:
+        return None
+    width, height = current_app.config["THUMBNAIL_SIZE"]
+    extension = 'jpg' if filename_local.rsplit('.', 1)[-1] in ('jpg', 'jpeg') else 'png'
+    thumb_name = f"{filename_local}.{content_hash.hexdigest()[:16]}.{width}x{height}.thumb.{extension}"
+    thumb_path = os.path.join(folder, thumb_name)
+    if not os.path.isfile(thumb_path):
+        from PIL import Image
+        try:
+            make_thumbnail(path, thumb_path, extension)
+        except (OSError, Image.DecompressionBombError) as error:
+            print(f"Could not create thumbnail of {filename_local}: {error}")
+            return None
+    with _thumbnails_lock:
+        _thumbnails[filename_local] = thumb_name
+    return thumb_name
+
+
+def make_thumbnail(path, thumb_path, extension):
+    from PIL import Image
+    with Image.open(path) as image:
+        image.thumbnail(current_app.config["THUMBNAIL_SIZE"])
+        if extension == 'jpg':
+            image = image.convert('RGB')
+            options = {'format':'JPEG', 'quality':85, 'optimize':True}
+        else:
+            options = {'format':'PNG', 'optimize':True}
+        # write next to the target and rename, so concurrent requests never see half a file
+        temp_path = f"{thumb_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        image.save(temp_path, **options)
+    os.replace(temp_path, thumb_path)
+
+
+def delete_upload(filename_local):
+    """ delete an uploaded file together with the files derived from it """
+    folder = current_app.config["UPLOAD_FOLDER"]
+    for derived_path in glob.glob(os.path.join(folder, glob.escape(filename_local) + '.*.thumb.*')):
+        try:
+            os.remove(derived_path)
+        except FileNotFoundError:
+            pass
+    with _thumbnails_lock:
+        _thumbnails.pop(filename_local, None)
+    os.remove(os.path.join(folder, filename_local))
+
+
+def is_upload_name(filename):
+    """ True for the local file names given to the uploads by save_task_to_db(), e.g. 1617181920123.png """
+    stem, _, extension = filename.partition('.')
+    return stem.isdigit() and extension in current_app.config["UPLOAD_EXTENSIONS"]
+
+
+# Background jobs
+#=================
+# run by jobs.py after the request which changed the task returned, safe to run twice
+@jobs.handler("todos.store_upload")
+def store_upload_job(filename_local, replaced=None):
+    """ move a spooled upload into UPLOAD_FOLDER, create its thumbnail and delete the upload it replaced """
+    spool_path = os.path.join(current_app.config["UPLOAD_INCOMING"], filename_local)
+    if os.path.isfile(spool_path):
+        shutil.move(spool_path, os.path.join(current_app.config["UPLOAD_FOLDER"], filename_local))
+    # the list shows the thumbnail without making the viewer wait for it, nothing is done if the task was deleted meanwhile
+    get_thumbnail(filename_local)
+    if replaced:
+        delete_upload_job(replaced)
+
+
+@jobs.handler("todos.delete_upload")
+def delete_upload_job(filename_local):
+    """ delete an upload with its thumbnails, from the spool too """
+    try:
+        delete_upload(filename_local)
+    except FileNotFoundError:
+        # deleted by an earlier attempt
+        pass
+    try:
+        os.remove(os.path.join(current_app.config["UPLOAD_INCOMING"], filename_local))
+    except FileNotFoundError:
+        pass
+
+
+@jobs.handler("todos.cleanup_uploads")
+def cleanup_uploads_job():
+    """ delete the uploads and thumbnails older than JOBS_ORPHAN_AGE which no task refers to, e.g. left by a crash """
+    referenced = {row[0] for row in query_db(f"SELECT LocalFileName FROM {current_app.config['SQLITE_TABLE_TODOS']} WHERE LocalFileName IS NOT NULL;")}
+    cutoff = time.time() - current_app.config["JOBS_ORPHAN_AGE"]
+    orphans = set()
+    for folder in (current_app.config["UPLOAD_FOLDER"], current_app.config["UPLOAD_INCOMING"]):
+        if not os.path.isdir(folder):
+            continue
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                # the upload folder holds the databases too, only names given to uploads are considered
+                # derived files are named "<upload>.<hash>.<size>.thumb.<format>[.<pid>.<thread>.tmp]"
+                filename_local = '.'.join(entry.name.split('.')[:2])
+                if is_upload_name(filename_local) and filename_local not in referenced \
+                   and entry.is_file() and entry.stat().st_mtime < cutoff:
+                    orphans.add(filename_local)
+                    if entry.name != filename_local:
+                        try:
+                            os.remove(entry.path)
+                        except FileNotFoundError:
+                            pass
+    for filename_local in orphans:
+        delete_upload_job(filename_local)
+    print(f"{len(orphans)} orphaned upload(s) deleted")
+
+
+jobs.periodic("todos.cleanup_uploads", "JOBS_CLEANUP_INTERVAL")